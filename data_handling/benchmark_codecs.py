@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*
+"""
+Benchmark the codecs supported by `extra.utils.os_utils.save_piece_blob` on a
+dataset and, optionally, re-encode the dataset with one of them.
+
+Example:
+    python -m data_handling.benchmark_codecs data/mozart --reencode npz \\
+        --outdir data/mozart_npz
+"""
+import os
+import time
+import tempfile
+
+from extra.utils.os_utils import (load_piece_blob, save_piece_blob,
+                                  BLOB_EXTENSIONS, lzma)
+
+
+def find_files(path, extensions):
+    file_list = []
+    for root, subdirs, files in os.walk(path):
+        file_list += [os.path.join(root, fp)
+                      for fp in files if fp.endswith(extensions)]
+    return sorted(file_list)
+
+
+def available_codecs():
+    return [codec for codec, ext in BLOB_EXTENSIONS
+            if codec != 'lzma' or lzma is not None]
+
+
+def benchmark(file_list, codecs, repeat=3):
+    """
+    Encode each file in *file_list* with each codec in *codecs* and measure
+    the loading time (best of *repeat*) and the size on disk.
+
+    RETURNS :
+        a dict codec -> (total size in bytes, total loading time in seconds)
+    """
+    pieces = [load_piece_blob(fn) for fn in file_list]
+    tmpdir = tempfile.mkdtemp()
+    results = {}
+    for codec in codecs:
+        size = 0
+        load_time = 0.0
+        for i, piece in enumerate(pieces):
+            fn = os.path.join(tmpdir, str(i) + dict(BLOB_EXTENSIONS)[codec])
+            save_piece_blob(piece, fn, codec=codec)
+            size += os.path.getsize(fn)
+            times = []
+            for r in range(repeat):
+                start = time.time()
+                load_piece_blob(fn)
+                times.append(time.time() - start)
+            load_time += min(times)
+            os.remove(fn)
+        results[codec] = (size, load_time)
+    os.rmdir(tmpdir)
+    return results
+
+
+def reencode(file_list, path, outdir, codec):
+    """
+    Re-encode all files in *file_list* with *codec*, keeping the directory
+    structure relative to *path* in *outdir*.
+    """
+    ext = dict(BLOB_EXTENSIONS)[codec]
+    for fn in file_list:
+        rel = os.path.relpath(fn, path)
+        for _codec, old_ext in BLOB_EXTENSIONS:
+            if rel.endswith(old_ext):
+                rel = rel[:-len(old_ext)]
+                break
+        out_fn = os.path.join(outdir, rel + ext)
+        if not os.path.exists(os.path.dirname(out_fn)):
+            os.makedirs(os.path.dirname(out_fn))
+        print('Re-encoding {0} to {1}'.format(fn, out_fn))
+        save_piece_blob(load_piece_blob(fn), out_fn, codec=codec)
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        'Benchmark loading time and size of pickled pieces per codec')
+
+    parser.add_argument('path',
+                        help='Directory containing the pickled pieces')
+
+    parser.add_argument('--extension', default='.pyc.bz',
+                        help='Extension of the files to be loaded')
+
+    parser.add_argument('--codecs', nargs='+', default=None,
+                        help='Codecs to be benchmarked (default: all)')
+
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of loads per file (the best is taken)')
+
+    parser.add_argument('--reencode', metavar='CODEC', default=None,
+                        help='Re-encode the dataset with CODEC')
+
+    parser.add_argument('--outdir', default=None,
+                        help='Directory for the re-encoded dataset')
+
+    args = parser.parse_args()
+
+    file_list = find_files(args.path, args.extension)
+    if len(file_list) == 0:
+        raise Exception("No files found with this extension!")
+
+    if args.reencode is not None:
+        if args.outdir is None:
+            args.outdir = args.path.rstrip(os.sep) + '_' + args.reencode
+        reencode(file_list, args.path, args.outdir, args.reencode)
+    else:
+        codecs = args.codecs or available_codecs()
+        results = benchmark(file_list, codecs, args.repeat)
+        print('{0} files'.format(len(file_list)))
+        print('{0:<8}{1:>14}{2:>14}{3:>16}'.format(
+            'codec', 'size (MB)', 'load (s)', 'load/file (ms)'))
+        for codec in codecs:
+            size, load_time = results[codec]
+            print('{0:<8}{1:>14.3f}{2:>14.3f}{3:>16.3f}'.format(
+                codec, size / 1e6, load_time,
+                1e3 * load_time / len(file_list)))
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*
+"""
+Compare the native parsers used by `data_handling.parse_data.load_piece` with
+the music21 route, both in parsing time and in the resulting notes.
+
+Example:
+    python -m data_handling.benchmark_parsers data/midi --extension .mid .midi
+"""
+import os
+import time
+
+import numpy as np
+
+from data_handling.parse_data import convert_from_m21, select_parser
+
+
+def find_files(path, extensions):
+    file_list = []
+    for root, subdirs, files in os.walk(path):
+        file_list += [os.path.join(root, fp)
+                      for fp in files if fp.lower().endswith(extensions)]
+    return sorted(file_list)
+
+
+def _note_set(d):
+    return set(zip(d['pitch'], d['onset'], d['duration'], d['soprano']))
+
+
+def parse_with_music21(fn):
+    """
+    Same as `data_handling.parse_data.parse_with_music21`, but ignoring the
+    pickled scores that music21 keeps in its scratch directory
+    """
+    import music21.converter as converter
+    return convert_from_m21(converter.parse(fn, forceSource=True))
+
+
+def compare(file_list):
+    """
+    Parse each file in *file_list* with music21 and with the native parser.
+
+    RETURNS :
+        a list of tuples (file, parser, music21 time, native time, number of
+        music21 notes, number of native notes, fraction of music21 notes found
+        identical by the native parser)
+    """
+    results = []
+    for fn in file_list:
+        parser, parse = select_parser(fn, native=True)
+        if parser == 'music21':
+            print("No native parser for " + fn + ", skipping it")
+            continue
+
+        start = time.time()
+        d_m21 = parse_with_music21(fn)
+        m21_time = time.time() - start
+
+        start = time.time()
+        d_native = parse(fn)
+        native_time = time.time() - start
+
+        notes_m21 = _note_set(d_m21)
+        notes_native = _note_set(d_native)
+        agreement = len(notes_m21 & notes_native) / float(max(1, len(notes_m21)))
+
+        results.append((fn, parser, m21_time, native_time,
+                        len(d_m21['pitch']), len(d_native['pitch']), agreement))
+        print("{0}: music21 {1:.3f}s, {2} {3:.3f}s, agreement {4:.3f}".format(
+            fn, m21_time, parser, native_time, agreement))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        'Benchmark native parsers against music21')
+
+    parser.add_argument('path',
+                        help='Directory containing the scores')
+
+    parser.add_argument('--extension', nargs='+', default=['.mid', '.midi'],
+                        help='Extensions of the files to be loaded')
+
+    args = parser.parse_args()
+
+    file_list = find_files(args.path, tuple(args.extension))
+    if len(file_list) == 0:
+        raise Exception("No files found with this extension!")
+
+    results = compare(file_list)
+    if len(results) > 0:
+        m21_time = np.sum([r[2] for r in results])
+        native_time = np.sum([r[3] for r in results])
+        print("")
+        print("Files: " + str(len(results)))
+        print("Total music21 time: {0:.3f}s".format(m21_time))
+        print("Total native time: {0:.3f}s".format(native_time))
+        print("Speed-up: {0:.1f}x".format(m21_time / max(native_time, 1e-9)))
+        print("Average agreement: {0:.3f}".format(
+            np.mean([r[6] for r in results])))
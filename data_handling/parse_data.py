@@ -2,11 +2,41 @@
 """
 Functions for parsing the dataset
 """
+import hashlib
+import logging
+import os
 import numpy as np
 from copy import deepcopy
 
 
-from extra.utils.os_utils import load_pyc_bz, save_pyc_bz
+from extra.utils.os_utils import (load_piece_blob, save_piece_blob_atomic,
+                                  BLOB_EXTENSIONS)
+
+LOGGER = logging.getLogger(__name__)
+
+# extensions of files loaded through `load_piece_blob` instead of music21
+PICKLE_EXTENSIONS = tuple(ext for codec, ext in BLOB_EXTENSIONS)
+
+# directory where parsed scores are cached; it can be set through the
+# environment variable `MELODY_CACHE_DIR`
+CACHE_DIR = os.environ.get(
+    'MELODY_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'melody_extractor'))
+
+# increase this every time the output of the parsers changes, so that old
+# cached pieces are not used anymore
+PARSER_VERSION = 2
+
+# extension (and then codec) of the cached pieces
+CACHE_EXTENSION = '.pyc.zlib'
+
+# if True, formats having a native parser (see `select_parser`) are not
+# parsed with music21
+USE_NATIVE_PARSERS = True
+
+MIDI_EXTENSIONS = ('.mid', '.midi')
+
+MUSICXML_EXTENSIONS = ('.xml', '.mxl', '.musicxml')
 
 
 def convert_to_midi(note_array, tracks=None, save=None):
@@ -213,22 +243,41 @@ def convert_from_m21(s):
 
     Initial pauses are discarded, that is the first notes always have onset 0.
 
+    Tied notes are merged in a single note, as the native parsers in
+    `data_handling.parse_midi` and `data_handling.parse_musicxml` do.
+
     """
     from music21 import note, chord, key
 
-    def add_note(n, midi_pitch):
-        pitch.append(midi_pitch)
-        onset.append(round(float(n.offset), 7))
-        duration.append(round(float(n.duration.quarterLength), 7))
-        if n_parts > 1 and hasattr(n, 'melody'):
-            soprano.append(1)
+    def add_note(n, midi_pitch, tie):
+        n_onset = round(float(n.offset), 7)
+        n_duration = round(float(n.duration.quarterLength), 7)
+        n_soprano = 1 if n_parts > 1 and hasattr(n, 'melody') else 0
+        tie_type = tie.type if tie is not None else None
+
+        # a tied note continuing the previous one with the same pitch; other
+        # notes with the same pitch (e.g. in other parts) do not end the tie
+        tie_key = (midi_pitch, n_soprano)
+        i = None
+        if tie_type in ('stop', 'continue'):
+            i = tied.pop(tie_key, None)
+        if i is not None and abs(onset[i] + duration[i] - n_onset) < 1e-6:
+            duration[i] = round(duration[i] + n_duration, 7)
         else:
-            soprano.append(0)
+            i = len(pitch)
+            pitch.append(midi_pitch)
+            onset.append(n_onset)
+            duration.append(n_duration)
+            soprano.append(n_soprano)
+        if tie_type in ('start', 'continue'):
+            tied[tie_key] = i
 
     pitch = []
     onset = []
     duration = []
     soprano = []
+    # (pitch, soprano) -> index of a note whose tie is not ended yet
+    tied = {}
 
     n_parts = len(s.parts)
 
@@ -237,13 +286,14 @@ def convert_from_m21(s):
         for melody_note in s.parts[0].recurse().getElementsByClass(['Chord', 'Note']):
             melody_note.melody = True
 
-    # parsing all notes
-    for e in s.recurse().getElementsByClass(['Chord', 'Note']):
+    # parsing all notes; offsets are taken in the flat stream, so that they
+    # are not relative to measures
+    for e in s.flat.getElementsByClass(['Chord', 'Note']):
         if type(e) is chord.Chord:
             for n in e.pitches:
-                add_note(e, n.midi)
+                add_note(e, n.midi, e.getTie(n))
         else:
-            add_note(e, e.pitch.midi)
+            add_note(e, e.pitch.midi, e.tie)
 
     keys = s.recurse().getElementsByClass('KeySignature')
     if len(keys) > 0:
@@ -262,12 +312,117 @@ def convert_from_m21(s):
     return d
 
 
-def load_piece(fn, save=True):
+def cache_path(fn, parser='music21', cache_dir=None):
+    """
+    Return the path of the cached parsed score for the file *fn*. The name of
+    the cached file is the hash of the content of *fn*, of the name of the
+    *parser* and of `PARSER_VERSION`, so that moved or renamed files share the
+    same cached piece and edited files or new parsers never get a stale one.
+    """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+
+    h = hashlib.sha1()
+    h.update('{0}:{1}:'.format(parser, PARSER_VERSION))
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    return os.path.join(cache_dir, h.hexdigest() + CACHE_EXTENSION)
+
+
+def _load_cached(path):
+    """
+    Return the piece cached at *path* or None if it does not exist or cannot
+    be loaded
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        return load_piece_blob(path)
+    except Exception:
+        LOGGER.warning('Cannot load cached piece {0}, ignoring it'.format(path))
+        return None
+
+
+def _save_cached(d, path):
+    """
+    Atomically write *d* to *path*, so that concurrent processes never see a
+    partially written file. Failures (e.g. read-only cache directory) are
+    logged and ignored.
+    """
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another process could have created it in the meanwhile
+                if not os.path.isdir(directory):
+                    raise
+        save_piece_blob_atomic(d, path)
+    except (IOError, OSError) as e:
+        LOGGER.warning('Cannot cache piece to {0}: {1}'.format(path, e))
+
+
+def parse_with_music21(fn):
+    """
+    Parse *fn* with music21 and convert it with `convert_from_m21`
+    """
+    import music21.converter as converter
+    return convert_from_m21(converter.parse(fn))
+
+
+def parse_midi_native(fn):
+    """
+    Parse the MIDI file *fn* with `data_handling.parse_midi.convert_from_midi`
+    """
+    from data_handling.parse_midi import convert_from_midi
+    return convert_from_midi(fn)
+
+
+def parse_musicxml_native(fn):
+    """
+    Parse the MusicXML file *fn* with
+    `data_handling.parse_musicxml.convert_from_musicxml`, falling back to
+    music21 for constructs that it does not support
+    """
+    from data_handling.parse_musicxml import (convert_from_musicxml,
+                                              UnsupportedMusicXML)
+    try:
+        return convert_from_musicxml(fn)
+    except UnsupportedMusicXML as e:
+        LOGGER.warning('Falling back to music21: {0}'.format(e))
+        return parse_with_music21(fn)
+
+
+def select_parser(fn, native=None):
+    """
+    Return a tuple (name, function) with the parser to be used for *fn*.
+    If *native* is False, music21 is always used; if it is None,
+    `USE_NATIVE_PARSERS` is used.
+    """
+    if native is None:
+        native = USE_NATIVE_PARSERS
+
+    if native and fn.lower().endswith(MIDI_EXTENSIONS):
+        return 'native-midi', parse_midi_native
+    if native and fn.lower().endswith(MUSICXML_EXTENSIONS):
+        return 'native-musicxml', parse_musicxml_native
+    return 'music21', parse_with_music21
+
+
+def load_piece(fn, save=True, cache_dir=None):
     """
     Load a piece based on extension.
-    If extension is '.pyc.bz', it consider it a compressed pickle
-    format containing the structered array returned by this
-    function, otherwise it try to load the file with music21.
+    If extension is one of `PICKLE_EXTENSIONS` (e.g. '.pyc.bz' or '.npz'), it
+    consider it a compressed pickle format containing the structered array
+    returned by this function (the codec is detected by
+    `extra.utils.os_utils.load_piece_blob`), otherwise it try to load the file
+    with music21 or, for MIDI and MusicXML files, with the native parsers in
+    `data_handling.parse_midi.convert_from_midi` and
+    `data_handling.parse_musicxml.convert_from_musicxml` (see
+    `select_parser`).
 
     In any non-pickled format, you should care that music21 loads the melody
     as the Part object with index 0 in the stream, otherwise, if just one part
@@ -278,8 +433,14 @@ def load_piece(fn, save=True):
 
     Initial pauses are discarded, that is the first notes always have onset 0.
 
-    If *save* is True, then it pickles to file the structured array (if loaded
-    from non-pickled format).
+    Pieces loaded from non-pickled formats are cached in *cache_dir*
+    (`CACHE_DIR` by default), keyed by the content of the file and by
+    `PARSER_VERSION` (see `cache_path`), so that successive loads of the same
+    score do not need music21. If *save* is True, then it pickles the
+    structured array to the cache (if loaded from non-pickled format); the
+    cache is read in any case. Cached files are written atomically, so that
+    this function can be used by concurrent processes, and the directory
+    containing *fn* is never written.
 
     TODO : remove grace notes  from the output
 
@@ -306,20 +467,19 @@ def load_piece(fn, save=True):
 
         Initial pauses are discarded, that is the first notes always have onset 0.
     """
-    if fn.endswith('.pyc.bz'):
-        return load_pyc_bz(fn)
+    if fn.endswith(PICKLE_EXTENSIONS):
+        return load_piece_blob(fn)
 
     else:
-        import music21.converter as converter
-        # loading file
-        s = converter.parse(fn)
+        parser, parse = select_parser(fn)
+        cached_fn = cache_path(fn, parser, cache_dir)
+        d = _load_cached(cached_fn)
+        if d is not None:
+            return d
 
-        s.write('midi', fp='temp.mid')
-        d = convert_from_m21(s)
+        # loading file
+        d = parse(fn)
 
         if save:
-            from pathlib import Path
-            p = Path(fn)
-            p = p.with_suffix('.pyc.bz')
-            save_pyc_bz(d, str(p))
+            _save_cached(d, cached_fn)
         return d
@@ -42,6 +42,14 @@ def get_score_from_midi(fn, flatten=True):
     # if flatten:
     #     m = midi.convert_midi_to_type_0(m)
 
+    return _score_from_midifile(m, flatten)
+
+
+def _score_from_midifile(m, flatten=True):
+    """
+    Same as `get_score_from_midi` but starting from a `midi.MidiFile` object
+    """
+
     div = float(m.header.time_division)
 
     note_information = []
@@ -69,6 +77,93 @@ def get_score_from_midi(fn, flatten=True):
     return note_information
 
 
+def quantize(values, divisors=(4, 3)):
+    """
+    Quantize *values* (in quarters) to the nearest multiple of 1/d for d in
+    *divisors*, as music21 does when parsing MIDI files with default options.
+    """
+    values = np.asarray(values, dtype=np.float)
+    best = np.round(values * divisors[0]) / divisors[0]
+    for d in divisors[1:]:
+        q = np.round(values * d) / d
+        closer = np.abs(q - values) < np.abs(best - values)
+        best[closer] = q[closer]
+    return best
+
+
+def _get_signatures(m):
+    """
+    Return the first time signature and the first key signature found in the
+    tracks of the `midi.MidiFile` *m* as music21 objects, as `convert_from_m21`
+    does. Defaults are 4/4 and no accidentals.
+    """
+    from music21 import meter, key
+
+    time_events = []
+    key_events = []
+    for track in m.tracks:
+        time_events += track.get_events(midi.TimeSigEvent)
+        key_events += track.get_events(midi.KeySigEvent)
+
+    if len(time_events) > 0:
+        e = min(time_events, key=lambda x: x.time)
+        timesignature = meter.TimeSignature(
+            '{0}/{1}'.format(e.num, 2 ** e.den))
+    else:
+        timesignature = meter.TimeSignature('4/4')
+
+    if len(key_events) > 0:
+        e = min(key_events, key=lambda x: x.time)
+        # sharps/flats are stored as a signed byte
+        sharps = e.key - 256 if e.key > 127 else e.key
+        keysignature = key.KeySignature(sharps)
+    else:
+        keysignature = key.KeySignature(0)
+
+    return timesignature, keysignature
+
+
+def convert_from_midi(fn, quantize_divisors=(4, 3)):
+    """
+    Load a MIDI file with `extra.data_handling.midi` and convert it to the
+    same dictionary returned by `data_handling.parse_data.convert_from_m21`,
+    without using music21 for parsing.
+
+    As in music21, each MIDI track containing notes is a part and the first
+    one is considered as melody if there are at least two of them; onsets and
+    durations (in quarters) are quantized according to *quantize_divisors*
+    (see `quantize`); use None to skip quantization.
+    """
+    m = midi.MidiFile(fn)
+    notes = _score_from_midifile(m, flatten=False)
+
+    onset = notes['onset']
+    duration = notes['duration']
+    if quantize_divisors is not None:
+        offset = quantize(onset + duration, quantize_divisors)
+        onset = quantize(onset, quantize_divisors)
+        duration = offset - onset
+        # notes shorter than the grid are not grace notes
+        duration[duration <= 0] = 1.0 / max(quantize_divisors)
+
+    tracks_with_notes = np.unique(notes['track'])
+    soprano = np.zeros(len(notes), dtype=np.int)
+    if len(tracks_with_notes) > 1:
+        soprano[notes['track'] == tracks_with_notes[0]] = 1
+
+    timesignature, keysignature = _get_signatures(m)
+
+    d = {
+        'pitch': notes['pitch'],
+        'onset': np.round(onset, 7),
+        'duration': np.round(duration, 7),
+        'soprano': soprano,
+        'timesignature': timesignature,
+        'keysignature': keysignature
+    }
+    return d
+
+
 if __name__ == '__main__':
 
     import argparse
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*
+"""
+Functions for loading MusicXML files without music21
+"""
+import os
+import zipfile
+from cStringIO import StringIO
+
+import numpy as np
+
+from extra.data_handling.musicxml import parse_music_xml
+from extra.data_handling.scoreontology import (get_all_score_parts,
+                                               TimeSignature, KeySignature,
+                                               Divisions)
+
+
+class UnsupportedMusicXML(Exception):
+    """
+    Raised when a MusicXML file contains constructs that the native parser
+    cannot convert; callers should fall back to music21.
+    """
+    pass
+
+
+def open_musicxml(fn):
+    """
+    Return a file object with the MusicXML document contained in *fn*; for
+    compressed files (.mxl), the root file listed in `META-INF/container.xml`
+    is returned.
+    """
+    if not zipfile.is_zipfile(fn):
+        return open(fn, 'rb')
+
+    from lxml import etree
+    with zipfile.ZipFile(fn) as z:
+        names = z.namelist()
+        root_fn = None
+        if 'META-INF/container.xml' in names:
+            container = etree.fromstring(z.read('META-INF/container.xml'))
+            paths = container.xpath('//*[local-name()="rootfile"]/@full-path')
+            if len(paths) > 0:
+                root_fn = paths[0]
+        if root_fn is None:
+            xmls = [n for n in names
+                    if n.endswith('.xml') and not n.startswith('META-INF')]
+            if len(xmls) == 0:
+                raise UnsupportedMusicXML('No MusicXML file in ' + fn)
+            root_fn = xmls[0]
+        return StringIO(z.read(root_fn))
+
+
+def _quarter_map(part):
+    """
+    Return a function mapping timeline times (in divisions) of the `ScorePart`
+    *part* to quarters from the first point of the timeline, taking into
+    account changes of <divisions>.
+    """
+    divs = sorted((d.start.t, d.divs)
+                  for d in part.timeline.get_all_of_type(Divisions))
+    start = part.timeline.points[0].t
+    if len(divs) == 0 or divs[0][0] > start:
+        divs.insert(0, (start, divs[0][1] if len(divs) > 0 else 1))
+
+    times = np.array([t for t, d in divs], dtype=np.float)
+    values = np.array([d for t, d in divs], dtype=np.float)
+    # quarters elapsed at each change of divisions
+    cum_quarters = np.r_[0, np.cumsum(np.diff(times) / values[:-1])]
+
+    def f(t):
+        t = np.asarray(t, dtype=np.float)
+        k = np.clip(np.searchsorted(times, t, side='right') - 1,
+                    0, len(times) - 1)
+        return cum_quarters[k] + (t - times[k]) / values[k]
+    return f
+
+
+def _get_signatures(part):
+    """
+    Return the first time signature and the first key signature of the
+    `ScorePart` *part* as music21 objects, as `convert_from_m21` does.
+    Defaults are 4/4 and no accidentals.
+    """
+    from music21 import meter, key
+
+    time_signatures = part.timeline.get_all_of_type(TimeSignature)
+    if len(time_signatures) > 0:
+        ts = time_signatures[0]
+        timesignature = meter.TimeSignature(
+            '{0}/{1}'.format(ts.beats, ts.beat_type))
+    else:
+        timesignature = meter.TimeSignature('4/4')
+
+    key_signatures = part.timeline.get_all_of_type(KeySignature)
+    if len(key_signatures) > 0:
+        keysignature = key.KeySignature(int(key_signatures[0].fifths))
+    else:
+        keysignature = key.KeySignature(0)
+
+    return timesignature, keysignature
+
+
+def convert_from_musicxml(fn):
+    """
+    Load a MusicXML file (.xml or .mxl) with
+    `extra.data_handling.musicxml.parse_music_xml` and convert it to the same
+    dictionary returned by `data_handling.parse_data.convert_from_m21`.
+
+    Onsets and durations are in quarters, starting from the beginning of the
+    first measure. As in music21, each staff of each score part is a part and
+    the notes of the first one are considered as melody if there are at least
+    two parts. Tied notes are merged in a single note.
+
+    Raises `UnsupportedMusicXML` if the file cannot be converted (e.g. it is
+    not score-partwise, parts have different number of measures or notes have
+    no end).
+    """
+    f = open_musicxml(fn)
+    try:
+        structure = parse_music_xml(f)
+    except UnsupportedMusicXML:
+        raise
+    except Exception as e:
+        raise UnsupportedMusicXML('Cannot parse {0}: {1!r}'.format(fn, e))
+    finally:
+        f.close()
+
+    if not structure:
+        raise UnsupportedMusicXML(fn + ' is not score-partwise')
+
+    parts = get_all_score_parts(structure.constituents)
+    parts = [p for p in parts if len(p.timeline.points) > 0]
+    if len(parts) == 0:
+        raise UnsupportedMusicXML('No parts in ' + fn)
+
+    pitch = []
+    onset = []
+    duration = []
+    staff_ids = []
+    for i, part in enumerate(parts):
+        notes = part.notes
+        if any(n.end is None for n in notes):
+            raise UnsupportedMusicXML('Notes without end in ' + fn)
+
+        quarter_map = _quarter_map(part)
+        if len(notes) > 0:
+            onsets = quarter_map([n.start.t for n in notes])
+            offsets = quarter_map([n.end.t for n in notes])
+        else:
+            onsets = offsets = np.array([])
+
+        pitch += [n.midi_pitch for n in notes]
+        onset.append(onsets)
+        duration.append(offsets - onsets)
+        staff_ids += [(i, n.staff or 0) for n in notes]
+
+    # music21 splits score parts with more staves in different parts
+    staves = sorted(set(staff_ids))
+    soprano = np.zeros(len(pitch), dtype=np.int)
+    if len(staves) > 1:
+        soprano[[s == staves[0] for s in staff_ids]] = 1
+
+    timesignature, keysignature = _get_signatures(parts[0])
+
+    d = {
+        'pitch': np.array(pitch),
+        'onset': np.round(np.hstack(onset), 7),
+        'duration': np.round(np.hstack(duration), 7),
+        'soprano': soprano,
+        'timesignature': timesignature,
+        'keysignature': keysignature
+    }
+    return d
@@ -986,16 +986,25 @@ class ScorePartBuilder(object):
             # `key` looks like: ('tie', ('E', None, 6, 1)),
             # that is ('tie', (step, alter, octave, staff))
             tie_key = _get_tie_key(e)
+            tietypes = [tie.attrib['type'] for tie in e.xpath('tie')]
 
             if tie_key in self.ongoing:
-                self.timeline.add_ending_object(self.position + measure_position, self.ongoing[tie_key])
-                if symbolic_duration is not None:
-                    self.ongoing[tie_key].symbolic_durations.append(symbolic_duration)
+                o = self.ongoing[tie_key]
+                if 'stop' in tietypes:
+                    # this note continues the tied note, which ends with it
+                    # unless the tie goes on
+                    if symbolic_duration is not None:
+                        o.symbolic_durations.append(symbolic_duration)
+                    if 'start' not in tietypes:
+                        self.timeline.add_ending_object(
+                            self.position + measure_position + duration, o)
+                        del self.ongoing[tie_key]
+                    return measure_position + duration, (measure_position, duration)
+                # a tie without stop ends where the same note is found again
+                self.timeline.add_ending_object(self.position + measure_position, o)
                 del self.ongoing[tie_key]
 
-            if len(e.xpath('tie')) > 0:    # look for a <tie> tag.
-                tietypes = [tie.attrib['type'] for tie in e.xpath('tie')]
-                tie_key = _get_tie_key(e)
+            if len(tietypes) > 0:    # look for a <tie> tag.
 
                 # TG: NOTE: it may be useful to integrate the `voice`
                 # number into the `key`. However, when a multipart, i.e.
@@ -14,16 +14,48 @@ import re
 from collections import defaultdict
 import signal
 import logging
+import tempfile
+from contextlib import contextmanager
 from functools import wraps
 
 import cPickle
 import bz2
 import gzip
+import zlib
 
 from cPickle import UnpicklingError
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
 LOGGER = logging.getLogger(__name__)
 
+# magic bytes at the beginning of a file for each supported codec; `npz` files
+# are zip archives, `zlib` streams start with 0x78 followed by a byte that
+# depends on the compression level
+BLOB_MAGIC = [
+    ('bz2', ('BZh',)),
+    ('gzip', ('\x1f\x8b',)),
+    ('lzma', ('\xfd7zXZ\x00',)),
+    ('npz', ('PK\x03\x04',)),
+    ('zlib', ('\x78\x01', '\x78\x5e', '\x78\x9c', '\x78\xda')),
+]
+
+# extension used for each codec when saving; the codec of a file is always
+# detected from its content when loading, so extensions are only a hint
+BLOB_EXTENSIONS = [
+    ('bz2', '.pyc.bz'),
+    ('gzip', '.pyc.gz'),
+    ('lzma', '.pyc.xz'),
+    ('zlib', '.pyc.zlib'),
+    ('npz', '.npz'),
+]
+
 
 def load_pyc_bz(fn):
     return cPickle.load(bz2.BZ2File(fn, 'r'))
@@ -41,10 +73,207 @@ def save_pyc_gz(d, fn):
     cPickle.dump(d, gzip.GzipFile(fn, 'w'), cPickle.HIGHEST_PROTOCOL)
 
 
+def detect_blob_codec(fn):
+    """
+    Return the codec used to write the file `fn` by looking at its magic
+    bytes: one of 'bz2', 'gzip', 'lzma', 'zlib', 'npz' or 'pickle' for plain
+    uncompressed pickle files.
+    """
+    with open(fn, 'rb') as f:
+        header = f.read(6)
+
+    for codec, magics in BLOB_MAGIC:
+        if header.startswith(magics):
+            return codec
+    return 'pickle'
+
+
+def blob_codec_from_extension(fn, default='bz2'):
+    """
+    Return the codec associated to the extension of `fn` in `BLOB_EXTENSIONS`
+    or `default` if the extension is unknown.
+    """
+    for codec, ext in BLOB_EXTENSIONS:
+        if fn.endswith(ext):
+            return codec
+    return default
+
+
+def _lzma_module():
+    if lzma is None:
+        raise ImportError('lzma codec needs python3 or `backports.lzma`')
+    return lzma
+
+
+def _dump_npz(d, f):
+    # dicts are stored field by field, other objects (e.g. structured arrays)
+    # in a single entry; non-array values (e.g. music21 objects) are stored as
+    # 0-d object arrays
+    import numpy as np
+    if isinstance(d, dict):
+        arrays = {}
+        for k, v in d.items():
+            if isinstance(v, np.ndarray):
+                arrays[k] = v
+            else:
+                obj = np.empty((), dtype=object)
+                obj[()] = v
+                arrays[k] = obj
+        np.savez(f, **arrays)
+    else:
+        np.savez(f, __array__=np.asarray(d))
+
+
+def _load_npz(fn):
+    import numpy as np
+    with np.load(fn, allow_pickle=True) as data:
+        if data.files == ['__array__']:
+            return data['__array__']
+        d = {}
+        for k in data.files:
+            v = data[k]
+            if v.dtype == object and v.ndim == 0:
+                v = v[()]
+            d[k] = v
+        return d
+
+
+def load_piece_blob(fn):
+    """
+    Load an object written by `save_piece_blob` (or by `save_pyc_bz` and
+    `save_pyc_gz`). The codec is detected from the magic bytes of the file, so
+    that old `.pyc.bz` files and re-encoded datasets can be loaded by the same
+    function whatever their extension.
+
+    Parameters
+    ----------
+    fn : str
+        path to the file
+
+    Returns
+    -------
+    object
+        the unpickled object
+    """
+    codec = detect_blob_codec(fn)
+    if codec == 'bz2':
+        return load_pyc_bz(fn)
+    elif codec == 'gzip':
+        return load_pyc_gz(fn)
+    elif codec == 'lzma':
+        return cPickle.load(_lzma_module().LZMAFile(fn, 'r'))
+    elif codec == 'zlib':
+        with open(fn, 'rb') as f:
+            return cPickle.loads(zlib.decompress(f.read()))
+    elif codec == 'npz':
+        return _load_npz(fn)
+    else:
+        with open(fn, 'rb') as f:
+            return cPickle.load(f)
+
+
+def save_piece_blob(d, fn, codec=None):
+    """
+    Save `d` to `fn` with the specified codec.
+
+    Parameters
+    ----------
+    d : object
+        the object to be saved; for the 'npz' codec it should be a dict of
+        arrays (as returned by `data_handling.parse_data.load_piece`) or an
+        array
+    fn : str or file object
+        where to write
+    codec : str or None
+        one of 'bz2', 'gzip', 'lzma', 'zlib', 'npz' or 'pickle'; if None, the
+        codec is inferred from the extension of `fn` (see `BLOB_EXTENSIONS`)
+        and 'bz2' is used for unknown extensions
+    """
+    if codec is None:
+        if isinstance(fn, basestring):
+            codec = blob_codec_from_extension(fn)
+        else:
+            codec = 'bz2'
+
+    if isinstance(fn, basestring):
+        with open(fn, 'wb') as f:
+            _write_piece_blob(d, f, codec)
+    else:
+        _write_piece_blob(d, fn, codec)
+
+
+def _write_piece_blob(d, f, codec):
+    if codec == 'gzip':
+        out = gzip.GzipFile(fileobj=f, mode='wb')
+        cPickle.dump(d, out, cPickle.HIGHEST_PROTOCOL)
+        out.close()
+    elif codec == 'npz':
+        _dump_npz(d, f)
+    elif codec == 'pickle':
+        cPickle.dump(d, f, cPickle.HIGHEST_PROTOCOL)
+    elif codec in ('bz2', 'lzma', 'zlib'):
+        # bz2.BZ2File cannot wrap file objects in python2, so we compress the
+        # whole pickle in memory; pieces are small enough for this
+        if codec == 'bz2':
+            compress = bz2.compress
+        elif codec == 'lzma':
+            compress = _lzma_module().compress
+        else:
+            compress = zlib.compress
+        f.write(compress(cPickle.dumps(d, cPickle.HIGHEST_PROTOCOL)))
+    else:
+        raise ValueError('Unknown codec: {0}'.format(codec))
+
+
+@contextmanager
+def atomic_open(fn, mode='wb'):
+    """
+    Open a temporary file in the directory of `fn` and rename it to `fn` once
+    the `with` block exits without errors. Readers (and concurrent writers)
+    will see either the old or the new complete content of `fn`, never a
+    partially written one.
+
+    Example
+    -------
+
+    >>> with atomic_open('data.pkl') as f:
+    ...     cPickle.dump(obj, f)
+
+    """
+    directory = os.path.dirname(os.path.abspath(fn))
+    fd, tmp_fn = tempfile.mkstemp(dir=directory, suffix='.tmp',
+                                  prefix='.' + os.path.basename(fn) + '.')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        if os.name == 'nt' and os.path.exists(fn):
+            # rename does not overwrite on Windows
+            os.remove(fn)
+        os.rename(tmp_fn, fn)
+    except BaseException:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        raise
+
+
+def save_piece_blob_atomic(d, fn, codec=None):
+    """
+    Same as `save_piece_blob`, but `fn` is replaced atomically (see
+    `atomic_open`).
+    """
+    if codec is None:
+        codec = blob_codec_from_extension(fn)
+    with atomic_open(fn) as f:
+        save_piece_blob(d, f, codec)
+
+
 def get_from_cache_or_compute(cache_fn, func, args=(), kwargs={}, refresh_cache=False):
     """
     If `cache_fn` exists, return the unpickled contents of that file
-    (the cache file is treated as a bzipped pickle file). If this
+    (the codec is detected by `load_piece_blob`, new cache files are
+    bzipped pickle files). If this
     fails, compute `func`(*`args`), pickle the result to `cache_fn`,
     and return the result.
 
@@ -78,7 +307,7 @@ def get_from_cache_or_compute(cache_fn, func, args=(), kwargs={}, refresh_cache=
             os.remove(cache_fn)
         else:
             try:
-                result = load_pyc_bz(cache_fn)
+                result = load_piece_blob(cache_fn)
             except UnpicklingError as e:
                 LOGGER.error(('The file {0} exists, but cannot be unpickled. Is it readable? Is this a pickle file?'
                               '').format(cache_fn))
@@ -104,6 +333,23 @@ def debug_mode(logger):
     return logger.getEffectiveLevel() == logging.DEBUG
 
 
+def available_memory():
+    """
+    Return the bytes of memory available for new processes without
+    swapping, or None if they cannot be known on this platform (only Linux
+    is supported).
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    # in kB
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
 def init_worker():
     """
     Setup a worker to ignore signals
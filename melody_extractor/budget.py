@@ -0,0 +1,172 @@
+"""
+Wall-clock and CPU time budget of a whole run (`--train`, crossvalidation or
+hyper-optimization). The budget is divided among the jobs of the run (folds,
+trials) as deadlines, which `nn_models.cnn.CNN.fit` respects by stopping
+before an epoch that would not end in time, and a report of how the budget
+was spent is written at the end.
+"""
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+import settings
+from extra.utils.os_utils import atomic_open
+
+
+def cpu_time(children=False):
+    """
+    Return the CPU seconds (user and system) used by this process and, if
+    `children` is True, by its terminated child processes.
+    """
+    t = os.times()
+    if children:
+        return t[0] + t[1] + t[2] + t[3]
+    return t[0] + t[1]
+
+
+def clock():
+    """
+    Return the current wall-clock and CPU times of this process, to be
+    passed to `usage`.
+    """
+    return time.time(), cpu_time()
+
+
+def usage(start):
+    """
+    Return the wall-clock and CPU seconds spent since `start`, as returned
+    by `clock`.
+    """
+    wall, cpu = clock()
+    return wall - start[0], cpu - start[1]
+
+
+class Budget(object):
+    """The time budget of a run, starting at its creation.
+
+    Parameters
+    ----------
+
+    seconds : float or None
+        The wall-clock budget, None if unlimited
+
+    cpu_hours : float or None
+        The CPU budget, None if unlimited. CPU time is charged as clusters
+        do: the maximum between the CPU time actually used and `workers`
+        times the elapsed wall-clock time
+
+    workers : int
+        The number of processes running jobs at the same time
+    """
+
+    def __init__(self, seconds=None, cpu_hours=None, workers=1):
+        self.seconds = seconds
+        self.cpu_hours = cpu_hours
+        self.workers = workers
+        self.start = time.time()
+        self.start_cpu = cpu_time(children=True)
+        # one record for each job, see `record`
+        self.jobs = []
+
+    @property
+    def limited(self):
+        return self.seconds is not None or self.cpu_hours is not None
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def cpu_used(self):
+        return cpu_time(children=True) - self.start_cpu
+
+    def cpu_charged(self):
+        return max(self.cpu_used(), self.workers * self.elapsed())
+
+    def remaining(self):
+        """
+        Return the wall-clock seconds left, np.inf if the budget is
+        unlimited.
+        """
+        left = np.inf
+        if self.seconds is not None:
+            left = min(left, self.seconds - self.elapsed())
+        if self.cpu_hours is not None:
+            left = min(left, (self.cpu_hours * 3600 - self.cpu_charged()) /
+                       float(self.workers))
+        return max(0.0, left)
+
+    def exhausted(self):
+        return self.remaining() <= 0
+
+    def end(self):
+        """
+        Return the time (as returned by `time.time()`) at which the budget
+        ends, None if unlimited.
+        """
+        if not self.limited:
+            return None
+        return time.time() + self.remaining()
+
+    def schedule(self, n_jobs):
+        """
+        Divide the remaining budget among `n_jobs` jobs, run `workers` at a
+        time in their order, and return the deadline of each job. Deadlines
+        are absolute, so that the time not used by a job is left to the
+        following ones. Returns a list of None if the budget is unlimited.
+        """
+        if not self.limited:
+            return [None] * n_jobs
+        now = time.time()
+        remaining = self.remaining()
+        rounds = int(math.ceil(n_jobs / float(self.workers)))
+        return [now + remaining * (i // self.workers + 1) / rounds
+                for i in range(n_jobs)]
+
+    def record(self, label, wall, cpu=None, stopped=False, skipped=False):
+        """
+        Record that job `label` took `wall` wall-clock and `cpu` CPU seconds;
+        `stopped` tells if it was stopped at its deadline and `skipped` if it
+        was not run at all since the budget was over.
+        """
+        self.jobs.append({'job': label, 'wall': wall, 'cpu': cpu,
+                          'stopped': stopped, 'skipped': skipped})
+
+    def report(self):
+        """
+        Return a dictionary describing how the budget was spent.
+        """
+        return {'budget_seconds': self.seconds,
+                'budget_cpu_hours': self.cpu_hours,
+                'workers': self.workers,
+                'elapsed': self.elapsed(),
+                'cpu_used': self.cpu_used(),
+                'cpu_charged': self.cpu_charged(),
+                'jobs_stopped': sum(j['stopped'] for j in self.jobs),
+                'jobs_skipped': sum(j['skipped'] for j in self.jobs),
+                'jobs': self.jobs}
+
+    def write_report(self, fn=None):
+        """
+        Print a summary of `report` and write it to `fn` (default
+        `settings.BUDGET_REPORT`) as JSON.
+        """
+        if fn is None:
+            fn = settings.BUDGET_REPORT
+        report = self.report()
+        print("Budget: {:.0f}s elapsed, {:.2f} CPU hours charged, {} jobs, "
+              "{} stopped at their deadline, {} skipped".format(
+                  report['elapsed'], report['cpu_charged'] / 3600.0,
+                  len(self.jobs), report['jobs_stopped'],
+                  report['jobs_skipped']))
+        with atomic_open(fn, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def from_settings(workers=1):
+    """
+    Return a `Budget` of `settings.BUDGET_SECONDS` and
+    `settings.BUDGET_CPU_HOURS` for `workers` processes
+    """
+    return Budget(settings.BUDGET_SECONDS, settings.BUDGET_CPU_HOURS, workers)
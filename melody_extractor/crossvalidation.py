@@ -4,6 +4,11 @@ This uses `trainer` and `melody_identification` to perform a whole
 Djikstra algorithm for DAG graphs with non-negative weigths
 """
 from copy import deepcopy
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
 
 from sklearn.model_selection import GroupShuffleSplit
 import numpy as np
@@ -13,6 +18,8 @@ import trainer
 import settings
 import misc_tools
 import math
+import budget as budget_tools
+from extra.utils.os_utils import atomic_open, available_memory, init_worker
 
 try:
     import cPickle as pickle
@@ -20,60 +27,255 @@ except ImportError:
     import pickle
 
 
-def crossvalidation(args, OUT_FILE=open("crossvalidation.txt", "w")):
+def fold_workers(n_folds, workers=None):
+    """
+    Return the number of processes used to run *n_folds* folds: at most
+    *workers* (default `settings.CROSSVALIDATION_WORKERS`), one per core and
+    as many as the available memory allows (see
+    `settings.CROSSVALIDATION_WORKER_MEMORY`). Folds are run in this process
+    if theano uses a GPU, whose CUDA context cannot be used by forked
+    processes (see `misc_tools.gpu_in_use`).
+    """
+    if workers is None:
+        workers = settings.CROSSVALIDATION_WORKERS
+    if workers > 1 and misc_tools.gpu_in_use():
+        print("Theano uses a GPU, running folds in this process")
+        return 1
+    n = min(workers, n_folds, multiprocessing.cpu_count())
+    memory = available_memory()
+    if memory is not None:
+        n = min(n, memory // settings.CROSSVALIDATION_WORKER_MEMORY)
+    return int(max(1, n))
+
+
+def build_model(args):
+    """
+    Build the model described by *args* according to `settings.MODEL_TYPE`
+    """
+    if settings.MODEL_TYPE == 'cnn':
+        return trainer.get_CNN_model(args)
+    else:
+        return trainer.build_RNN_model(args)
+
+
+def run_fold(k, NN_model, dataset, remaining, testing, groups, X, Y, notelists,
+             OUT_FILE, resume=False, deadline=None, store=None):
+    """
+    Train *NN_model* and test it on the fold number *k*, writing its
+    parameters to `nn_kernels_k.pkl` and its results to
+    `crossvalidation_fold_k.pkl`. If *resume* is True and both files exist,
+    the results are loaded instead.
+
+    If the training is stopped at *deadline* (see `nn_models.cnn.CNN.fit`),
+    the model is tested anyway, but no file is written, so that a resumed
+    crossvalidation continues the training from its checkpoint.
+
+    If *store* is not None, the predictions are saved in that directory as
+    fold *k* (see `prediction_store`).
+
+    Returns fmeasures, precisions and recalls of the pieces in *testing*.
+    """
+    results_fn = 'crossvalidation_fold_' + str(k) + '.pkl'
+    kernels_fn = 'nn_kernels_' + str(k) + '.pkl'
+    if resume and os.path.exists(results_fn) and os.path.exists(kernels_fn):
+        print('Fold number ' + str(k) + ' already completed, skipping it')
+        with open(results_fn, 'rb') as f:
+            results = pickle.load(f)
+        OUT_FILE.write("\nFold " + str(k) + " loaded from " + results_fn)
+        return results
+
+    print('Training on fold number ' + str(k))
+    results = trainer.train_and_test(
+        dataset, remaining, groups, X, Y, NN_model, testing, notelists, OUT_FILE,
+        checkpoint='checkpoint_fold_' + str(k) + '.pyc.bz', resume=resume,
+        deadline=deadline, store=store, fold=k)
+
+    if getattr(NN_model, 'stopped_at_deadline', False):
+        OUT_FILE.write("\nFold " + str(k) + " stopped at the deadline")
+        return results
+
+    parameters = NN_model.get_params()
+    with atomic_open(kernels_fn) as f:
+        pickle.dump(parameters, f)
+    with atomic_open(results_fn) as f:
+        pickle.dump(results, f)
+    print("Parameters written to file!")
+    return results
+
+
+def check_fold(k, fmeasures):
+    """
+    Raise an exception if the fmeasures of fold *k* contain a nan
+    """
+    if any([math.isnan(i) for i in fmeasures]):
+        raise Exception("nan in crossvalidation step" + str(k + 1))
+
+
+def _fold_usage(start, NN_model=None):
+    # the usage of a fold to be recorded in the budget; folds without a model
+    # were skipped
+    wall, cpu = budget_tools.usage(start)
+    return {'wall': wall, 'cpu': cpu, 'skipped': NN_model is None,
+            'stopped': getattr(NN_model, 'stopped_at_deadline', False)}
+
+
+def _fold_worker(job):
+    # runs a fold in a worker process with its own model; the output that
+    # would go to `OUT_FILE` is returned as a string
+    k, args, data, dataset, remaining, testing, groups, notelists, resume, \
+        deadline, store = job
+    start = budget_tools.clock()
+    if deadline is not None and time.time() >= deadline:
+        return k, None, '', _fold_usage(start)
+    X, Y = [np.load(d, mmap_mode='r') if isinstance(d, basestring) else d
+            for d in data]
+    NN_model = build_model(args)
+    out_fn = 'crossvalidation_fold_' + str(k) + '.txt'
+    with open(out_fn, 'w') as out:
+        results = run_fold(k, NN_model, dataset, remaining, testing, groups,
+                           X, Y, notelists, out, resume, deadline, store)
+    with open(out_fn) as f:
+        text = f.read()
+    os.remove(out_fn)
+    return k, results, text, _fold_usage(start, NN_model)
+
+
+def crossvalidation(args, OUT_FILE=open("crossvalidation.txt", "w"), resume=False,
+                    workers=None, budget=None, store=None):
     """
     This performs a 10-fold cross-validation, included graph test and saves
     results in the global `OUT_FILE` file object.
+
+    The training of each fold is checkpointed to `checkpoint_fold_k.pyc.bz`
+    and the results of each completed fold are saved to
+    `crossvalidation_fold_k.pkl`; if `resume` is True, completed folds are
+    skipped and an interrupted fold restarts from its checkpoint.
+
+    If `workers` (default `settings.CROSSVALIDATION_WORKERS`) is larger than
+    1, folds are run in parallel in that many processes (see
+    `fold_workers`), each one building and compiling its own model; the
+    windows are written to disk and read by all processes through a memory
+    map.
+
+    If `budget` (a `budget.Budget`) is not None, its remaining time is
+    divided among the folds (see `budget.Budget.schedule`): the training of
+    each fold stops at its deadline, folds starting after it are skipped and
+    the averages are computed on the folds which were run. The usage of each
+    fold is recorded in `budget`.
+
+    If `store` is not None, the predictions of each fold are saved in that
+    directory (see `prediction_store`), so that `prediction_store.rescore`
+    can test other settings of the graph stage without training again.
     """
     if settings.MODEL_TYPE == 'cnn':
         OVERLAP = True
     else:
         OVERLAP = False
 
-    print("Ok, we're ready to load files, let's start!")
-    X, Y, map_sw, notelists = misc_tools.load_files(
-        settings.DATA_PATH, return_notelists=True, overlap=OVERLAP)
+    X, Y, map_sw, notelists, dataset, groups = trainer.load_data(
+        settings.WIN_WIDTH, OVERLAP)
 
-    if settings.MODEL_TYPE == 'cnn':
-        NN_model = trainer.build_CNN_model(args)
-    else:
+    if settings.MODEL_TYPE != 'cnn':
         args['gradient_steps'] = int(min([len(i) for i in map_sw]))
         print("Gradient steps: " + str(args['gradient_steps']))
-        NN_model = trainer.build_RNN_model(args)
-    initial_params = NN_model.get_params()
 
     print("10 CROSS-VALIDATION")
     print("Separating training, validation and test set...")
 
     from sklearn.model_selection import GroupKFold
     kfold = GroupKFold(n_splits=10)
-    k = 1
 
-    dataset, groups = misc_tools.build_groups(map_sw)
+    folds = list(kfold.split(dataset, groups=groups))
+
+    workers = fold_workers(len(folds), workers)
+    if budget is not None:
+        # the budget is charged for all the processes
+        budget.workers = workers
+        deadlines = budget.schedule(len(folds))
+    else:
+        deadlines = [None] * len(folds)
+    # fold -> usage, see `_fold_usage`
+    usages = {}
+    results = {}
+    if workers > 1:
+        print("Running folds in " + str(workers) + " processes")
+        tmp_dir = tempfile.mkdtemp(prefix='crossvalidation_', dir='.')
+        try:
+            data = []
+            for name, arr in (('X', X), ('Y', Y)):
+                if isinstance(arr, np.ndarray):
+                    # lazy datasets are pickled instead
+                    fn = os.path.join(tmp_dir, name + '.npy')
+                    np.save(fn, arr)
+                    arr = fn
+                data.append(arr)
+            del X, Y
+
+            jobs = [(k, args, data, dataset, remaining, testing, groups,
+                     notelists, resume, deadline, store)
+                    for k, ((remaining, testing), deadline)
+                    in enumerate(zip(folds, deadlines), 1)]
+            # a new process for each fold, so that memory is released
+            pool = multiprocessing.Pool(workers, init_worker, maxtasksperchild=1)
+            try:
+                for k, fold_results, text, usage in pool.imap_unordered(
+                        _fold_worker, jobs):
+                    print("Fold number " + str(k) + " completed")
+                    results[k] = (fold_results, text)
+                    usages[k] = usage
+                pool.close()
+            except KeyboardInterrupt:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        finally:
+            shutil.rmtree(tmp_dir)
+    else:
+        NN_model = build_model(args)
+        initial_params = NN_model.get_params()
+        for k, ((remaining, testing), deadline) in enumerate(
+                zip(folds, deadlines), 1):
+            print("")
+            start = budget_tools.clock()
+            if deadline is not None and time.time() >= deadline:
+                usages[k] = _fold_usage(start)
+                results[k] = (None, '')
+                continue
+            NN_model.set_params(initial_params)
+            if hasattr(NN_model, 'reset_training_state'):
+                NN_model.reset_training_state()
+            # set again by the training, but not if the fold is resumed
+            NN_model.stopped_at_deadline = False
+            fold_results = run_fold(k, NN_model, dataset, remaining, testing,
+                                    groups, X, Y, notelists, OUT_FILE, resume,
+                                    deadline, store)
+            usages[k] = _fold_usage(start, NN_model)
+            check_fold(k, fold_results[0])
+            results[k] = (fold_results, '')
 
     fmeasures = []
     recalls = []
     precisions = []
-    for remaining, testing in kfold.split(dataset, groups=groups):
-        print("")
-        print('Training on fold number ' + str(k))
-        NN_model.set_params(initial_params)
-        fmeasure_chunk, precision_chunk, recall_chunk = trainer.train_and_test(
-            dataset, remaining, groups, X, Y, NN_model, testing, notelists, OUT_FILE)
-
-        parameters = NN_model.get_params()
-        with open('nn_kernels_' + str(k) + '.pkl', 'wb') as f:
-            pickle.dump(parameters, f)
-        print("Parameters written to file!")
-
+    for k in range(1, len(folds) + 1):
+        if budget is not None:
+            budget.record('fold ' + str(k), **usages[k])
+        fold_results, text = results[k]
+        if fold_results is None:
+            print("Fold number " + str(k) + " skipped, the budget is over")
+            OUT_FILE.write("\nFold " + str(k) + " skipped, the budget is over")
+            continue
+        fmeasure_chunk, precision_chunk, recall_chunk = fold_results
+        OUT_FILE.write(text)
         fmeasures += fmeasure_chunk
         recalls += recall_chunk
         precisions += precision_chunk
-        k += 1
 
         # if results contain a nan throw an exception
-        if any([math.isnan(i) for i in fmeasure_chunk]):
-            raise Exception("nan in crossvalidation step" + str(k))
+        check_fold(k, fmeasure_chunk)
+
+    if len(fmeasures) == 0:
+        raise Exception("No fold was run within the budget")
 
     OUT_FILE.write("\nAverage precision: " + str(np.mean(precisions)))
     OUT_FILE.write("\nAverage recall: " + str(np.mean(recalls)))
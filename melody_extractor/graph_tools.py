@@ -11,6 +11,7 @@ from sklearn.model_selection import train_test_split
 
 import misc_tools
 import settings
+from utils.pianoroll_utils import SparseRoll
 
 try:
     import cPickle as pickle
@@ -207,6 +208,9 @@ def iqr(ys):
 
 def set_threshold(arr, CLUSTERING='single'):
     print("starting clustering")
+    if isinstance(arr, SparseRoll):
+        # pixels not stored are 0 and would be discarded below
+        arr = arr.values()
     arr = arr.reshape(-1)
     arr = arr[arr > settings.MIN_TH]
     N_CLUSTER = 2
@@ -311,7 +315,7 @@ def predict_labels(pianoroll_prob, in_notelist):
         and a pianoroll probability distribution.
 
         PARAMETERS :
-        pianoroll_prob : 2d np.array
+        pianoroll_prob : 2d np.array or `utils.pianoroll_utils.SparseRoll`
             the pianoroll distribution
         in_notelist : 2d np.array
             the input list of notes as returned by
@@ -327,9 +331,13 @@ def predict_labels(pianoroll_prob, in_notelist):
     notelist = in_notelist[in_notelist[:, 1].argsort()]
 
     # changing all nan to 2 * EPS(0)
-    for i in np.nditer(pianoroll_prob, op_flags=['readwrite']):
-        if np.isnan(i):
-            i[...] = 2 * misc_tools.EPS(0)
+    if isinstance(pianoroll_prob, SparseRoll):
+        values = pianoroll_prob.values()
+        values[np.isnan(values)] = 2 * misc_tools.EPS(0)
+    else:
+        for i in np.nditer(pianoroll_prob, op_flags=['readwrite']):
+            if np.isnan(i):
+                i[...] = 2 * misc_tools.EPS(0)
     # np.nan_to_num(pianoroll_prob, copy=False)
 
     # looking for the first non empty column
@@ -367,7 +375,7 @@ def test_shortest_path(test_notelists, predictions, pieces_indices=None, OUT_FIL
     *test_notelists * and the avarage F_measure
 
     *test_notelists * must be an array-like of notelists as created by
-    *misc_tools.load_files*
+    *misc_tools.load_files* or *misc_tools.load_notelists*
 
     RETURNS:
         a tuple of three lists containing:
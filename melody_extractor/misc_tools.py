@@ -1,4 +1,6 @@
 import os
+import threading
+from collections import OrderedDict
 
 import numpy as np
 import sklearn.preprocessing
@@ -32,9 +34,16 @@ def recreate_pianorolls(array_of_windows, overlap=True):
 
     If *overlapping* is True, the windows will be thought as overlapping by 50%
 
+    *array_of_windows* can also be a list of 2D
+    `utils.pianoroll_utils.SparseRoll`, in which case a `SparseRoll` is
+    returned.
+
     RETURNS :
         a 2D array with dimensions (128, length of pianoroll)
     """
+    if len(array_of_windows) > 0 and \
+            isinstance(array_of_windows[0], utils.pianoroll_utils.SparseRoll):
+        return _recreate_sparse_pianorolls(array_of_windows, overlap)
 
     WIN_WIDTH = array_of_windows.shape[3]
     WIN_HEIGHT = array_of_windows.shape[2]
@@ -57,6 +66,33 @@ def recreate_pianorolls(array_of_windows, overlap=True):
     return output
 
 
+def _recreate_sparse_pianorolls(windows, overlap):
+    """
+    `recreate_pianorolls` for a list of `SparseRoll` windows: windows are
+    summed as in the dense version, but only their stored pixels are moved.
+    """
+    WIN_HEIGHT, WIN_WIDTH = windows[0].shape
+    pianoroll_width = WIN_WIDTH * len(windows)
+    hop = WIN_WIDTH
+    scale = 1.0
+    if overlap:
+        pianoroll_width /= 2
+        pianoroll_width += WIN_WIDTH / 2
+        hop = WIN_WIDTH / 2
+        scale = 0.5
+
+    rows, cols, values = [], [], []
+    for i, window in enumerate(windows):
+        r, c, v = window.coords()
+        rows.append(r)
+        cols.append(c + i * hop)
+        values.append(v * scale)
+
+    return utils.pianoroll_utils.SparseRoll.from_coords(
+        np.concatenate(rows), np.concatenate(cols), np.concatenate(values),
+        (WIN_HEIGHT, pianoroll_width))
+
+
 def split_windows(array2d, WIN_WIDTH, overlap):
     """
     Proxy function for `overlapping_split` and `no_overlap_split`
@@ -64,7 +100,17 @@ def split_windows(array2d, WIN_WIDTH, overlap):
 
     If WIN_WIDTH > array2d.shape[1] (the number of columns in the pianoroll),
     then it is just padded to WIN_WIDTH
+
+    If *array2d* is a `utils.pianoroll_utils.SparseRoll`, a list of
+    `SparseRoll` windows is returned.
     """
+    if isinstance(array2d, utils.pianoroll_utils.SparseRoll):
+        if WIN_WIDTH % 2 != 0:
+            return None
+        return [array2d.window(start, start + WIN_WIDTH)
+                for start in window_starts(array2d.shape[1], WIN_WIDTH,
+                                            overlap)]
+
     if overlap:
         if WIN_WIDTH > array2d.shape[1]:
             return _no_overlap_split(array2d, WIN_WIDTH)
@@ -142,6 +188,32 @@ def _overlapping_split(array2d, WIN_WIDTH):
     return splitted
 
 
+def find_files(path, extensions=settings.FILE_EXTENSIONS):
+    """
+    Recurse *path* and return the sorted list of files having one of
+    *extensions*. If `settings.DATASET_PERC` < 1, only a random (but fixed)
+    subset of files is returned.
+    """
+    file_list = []
+    # recurse all directories
+    for root, subdirs, files in os.walk(path):
+        # take just the files with the proper extension
+        file_list += [os.path.join(root, fp)
+                      for fp in files if fp.endswith(extensions)]
+
+    if len(file_list) == 0:
+        raise Exception("No files found with this extension!")
+
+    # extract random files
+    if settings.DATASET_PERC < 1:
+        num_files = int(settings.DATASET_PERC * len(file_list))
+        np.random.seed(1987)
+        file_list = np.random.choice(
+            file_list, num_files, replace=False)
+
+    return sorted(file_list)
+
+
 def load_files(path, WIN_WIDTH=settings.WIN_WIDTH, extensions=settings.FILE_EXTENSIONS, return_notelists=False, overlap=True):
     """
     Load files from path.
@@ -185,31 +257,15 @@ def load_files(path, WIN_WIDTH=settings.WIN_WIDTH, extensions=settings.FILE_EXTE
     map_score_window = []
     notelist_scores = []
 
-    file_list = []
-    # recurse all directories
-    print(extensions)
-    for root, subdirs, files in os.walk(path):
-        # take just the files with the proper extension
-        file_list += [os.path.join(root, fp)
-                      for fp in files if fp.endswith(extensions)]
-
-    if len(file_list) == 0:
-        raise Exception("No files found with this extension!")
-
-    # extract random files
-    if settings.DATASET_PERC < 1:
-        num_files = int(settings.DATASET_PERC * len(file_list))
-        np.random.seed(1987)
-        file_list = np.random.choice(
-            file_list, num_files, replacement=False)
+    file_list = find_files(path, extensions)
 
-    for f in sorted(file_list):
+    for f in file_list:
         print("I've found a new file: " + f)
 
         note_array = load_piece(f)
         # load pianorolls score and melody
         pr = utils.pianoroll_utils.make_pianorolls(
-            note_array, output_idxs=return_notelists)
+            note_array, output_idxs=return_notelists, output='roll')
         score = pr[0]
         melody = pr[1]
         if len(pr) == 4:
@@ -229,12 +285,14 @@ def load_files(path, WIN_WIDTH=settings.WIN_WIDTH, extensions=settings.FILE_EXTE
         score_list += score_splitted
         melody_list += melody_splitted
 
-    # reshaping output
-    score_out = np.ndarray(shape=(len(score_list), 1, settings.WIN_HEIGHT, WIN_WIDTH),
-                           buffer=np.array(score_list), dtype=settings.floatX)
-
-    melody_out = np.ndarray(shape=(len(melody_list), 1, settings.WIN_HEIGHT, WIN_WIDTH),
-                            buffer=np.array(melody_list), dtype=settings.floatX)
+    # windows are sparse up to here, the dense arrays are allocated once
+    score_out = np.zeros((len(score_list), 1, settings.WIN_HEIGHT, WIN_WIDTH),
+                         dtype=settings.floatX)
+    melody_out = np.zeros((len(melody_list), 1, settings.WIN_HEIGHT, WIN_WIDTH),
+                          dtype=settings.floatX)
+    for i in range(len(score_list)):
+        score_list[i].toarray(out=score_out[i, 0])
+        melody_list[i].toarray(out=melody_out[i, 0])
 
     if return_notelists:
         return score_out, melody_out, map_score_window, np.array(notelist_scores)
@@ -242,6 +300,288 @@ def load_files(path, WIN_WIDTH=settings.WIN_WIDTH, extensions=settings.FILE_EXTE
         return score_out, melody_out, map_score_window
 
 
+def load_notelists(path, extensions=settings.FILE_EXTENSIONS, beat_div=8):
+    """
+    Load files from path and return only their notelists, without building
+    pianorolls and windows. This is what consumers which do not need the
+    network input (e.g. skyline baselines, threshold and graph experiments)
+    should use.
+
+    *extensions* is a string or a tuple of extensions for files to be loaded
+
+    RETURNS :
+        an array of notelists, the same returned by *load_files* with
+        *return_notelists* set to True and in the same order
+    """
+    extensions = settings.FILE_EXTENSIONS
+    notelists = []
+    for f in find_files(path, extensions):
+        print("I've found a new file: " + f)
+        idx_score = utils.pianoroll_utils.get_piece_indices(
+            load_piece(f), beat_div=beat_div)[0]
+        notelists.append(idx_score)
+
+    return np.array(notelists)
+
+
+def window_starts(length, WIN_WIDTH, overlap):
+    """
+    Return the first column of each window that `split_windows` creates for
+    a pianoroll of *length* columns; columns before 0 and after *length* are
+    padding.
+    """
+    # splitting an empty-height array gives the windows without copying data
+    n_windows = len(split_windows(np.zeros((0, length)), WIN_WIDTH, overlap))
+    if overlap and WIN_WIDTH <= length:
+        return [(k - 1) * WIN_WIDTH / 2 for k in range(n_windows)]
+    else:
+        return [k * WIN_WIDTH for k in range(n_windows)]
+
+
+def _rasterize_window(notes, start, WIN_WIDTH, out):
+    """
+    Write in the 2D array *out* the window of width *WIN_WIDTH* starting at
+    column *start* of the pianoroll containing *notes* (as returned by
+    `utils.pianoroll_utils.get_pianoroll_indices`).
+    """
+    end = start + WIN_WIDTH
+    inside = (notes[:, 1] < end) & (notes[:, 2] > start)
+    shifted = notes[inside, :3] - [0, start, start]
+    out[:] = utils.pianoroll_utils.rasterize_indices(
+        shifted, out.shape, output='bool')
+
+
+class DatasetView(object):
+    """
+    Array-like view of the scores (`field` = 0) or of the melodies (`field` =
+    1) of a `Dataset`. It supports the indexing used by the training and
+    prediction functions: `view[i]` returns a 3D array with shape (1,
+    WIN_HEIGHT, WIN_WIDTH), `view[indices]` and `view[indices, :, :, :]` a 4D
+    array with one window per index.
+    """
+
+    def __init__(self, dataset, field):
+        self.dataset = dataset
+        self.field = field
+        self.dtype = dataset.dtype
+        self.ndim = 4
+
+    @property
+    def shape(self):
+        return (len(self.dataset), 1, self.dataset.WIN_HEIGHT,
+                self.dataset.WIN_WIDTH)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+
+        if isinstance(key, (int, long, np.integer)):
+            out = self.dataset.get_windows([key])[self.field][0]
+            return out[rest] if rest else out
+
+        if isinstance(key, slice):
+            key = range(*key.indices(len(self.dataset)))
+        out = self.dataset.get_windows(key)[self.field]
+        return out[(slice(None),) + rest] if rest else out
+
+    def __array__(self, dtype=None):
+        # materializing the whole dataset, avoid it if possible
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)
+
+
+class Dataset(object):
+    """
+    A dataset of pianoroll windows computed on demand from the note arrays of
+    the pieces, so that the memory needed scales with the number of notes
+    instead of with the number of windows.
+
+    Only the pianoroll indices of each piece are kept in memory (see
+    `notelists`); windows are rasterized when requested and the most
+    recently used ones are kept in a LRU cache of *cache_size* windows.
+
+    The fields `X` and `Y` are `DatasetView` objects which can be used in
+    place of the arrays returned by `load_files` (scores and melodies), while
+    `map_score_window` and `notelists` are the same lists returned by
+    `load_files`.
+
+    Windows that cannot be computed from the note arrays (e.g. the ones
+    created by data augmentation) can be added with `append`.
+    """
+
+    def __init__(self, file_list, WIN_WIDTH=settings.WIN_WIDTH, overlap=True,
+                 cache_size=settings.DATASET_CACHE_SIZE, beat_div=8,
+                 WIN_HEIGHT=settings.WIN_HEIGHT, dtype=settings.floatX):
+
+        self.WIN_WIDTH = WIN_WIDTH
+        self.WIN_HEIGHT = WIN_HEIGHT
+        self.dtype = dtype
+        self.cache_size = cache_size
+
+        self.notelists = []
+        self.melody_notelists = []
+        self.map_score_window = []
+        # for each window: (piece index, first column)
+        self._windows = []
+        for f in file_list:
+            print("I've found a new file: " + f)
+            idx_score, idx_melody, length = \
+                utils.pianoroll_utils.get_piece_indices(load_piece(f),
+                                                        beat_div=beat_div)
+            p = len(self.notelists)
+            self.notelists.append(idx_score)
+            self.melody_notelists.append(idx_melody)
+
+            starts = window_starts(length, WIN_WIDTH, overlap)
+            counter = len(self._windows)
+            self.map_score_window.append(
+                [c + counter for c in range(len(starts))])
+            self._windows += [(p, start) for start in starts]
+
+        self.notelists = np.array(self.notelists)
+        self._n_piece_windows = len(self._windows)
+        # windows added with `append`
+        self._extra_X = []
+        self._extra_Y = []
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._prefetcher = None
+
+        self.X = DatasetView(self, 0)
+        self.Y = DatasetView(self, 1)
+
+    def __len__(self):
+        return self._n_piece_windows + len(self._extra_X)
+
+    def append(self, X, Y):
+        """
+        Add the windows in the 4D arrays *X* and *Y* to the dataset, keeping
+        them in memory. Returns the list of their indices.
+        """
+        start = len(self)
+        self._extra_X += list(X)
+        self._extra_Y += list(Y)
+        return range(start, len(self))
+
+    def _compute_window(self, i):
+        if i >= self._n_piece_windows:
+            i -= self._n_piece_windows
+            return self._extra_X[i][0], self._extra_Y[i][0]
+
+        piece, start = self._windows[i]
+        x = np.empty((self.WIN_HEIGHT, self.WIN_WIDTH), dtype=self.dtype)
+        y = np.empty((self.WIN_HEIGHT, self.WIN_WIDTH), dtype=self.dtype)
+        _rasterize_window(self.notelists[piece], start, self.WIN_WIDTH, x)
+        _rasterize_window(self.melody_notelists[piece], start,
+                          self.WIN_WIDTH, y)
+        return x, y
+
+    def _get_window(self, i):
+        with self._lock:
+            window = self._cache.get(i)
+            if window is not None:
+                # mark as most recently used
+                del self._cache[i]
+                self._cache[i] = window
+                return window
+
+        window = self._compute_window(i)
+        if self.cache_size > 0:
+            with self._lock:
+                self._cache[i] = window
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return window
+
+    def get_windows(self, indices):
+        """
+        Return a tuple of 4D arrays (scores, melodies) with the windows at
+        *indices*.
+        """
+        indices = np.asarray(indices, dtype=np.int).reshape(-1)
+        X = np.empty((len(indices), 1, self.WIN_HEIGHT, self.WIN_WIDTH),
+                     dtype=self.dtype)
+        Y = np.empty_like(X)
+        for j, i in enumerate(indices):
+            if i < 0:
+                i += len(self)
+            X[j, 0], Y[j, 0] = self._get_window(i)
+        return X, Y
+
+    def prefetch(self, indices):
+        """
+        Compute in a background thread the windows at *indices* (usually the
+        next batch) so that they are in the cache when requested. The previous
+        prefetch is awaited before starting a new one.
+        """
+        if self.cache_size <= 0:
+            return
+        if self._prefetcher is not None:
+            self._prefetcher.join()
+
+        indices = list(indices)
+
+        def run():
+            for i in indices:
+                self._get_window(i)
+
+        self._prefetcher = threading.Thread(target=run)
+        self._prefetcher.daemon = True
+        self._prefetcher.start()
+
+    def __getstate__(self):
+        # threads and locks cannot be pickled, caches are not worth it
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        state['_lock'] = None
+        state['_prefetcher'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def load_dataset(path, WIN_WIDTH=settings.WIN_WIDTH, overlap=True,
+                 cache_size=settings.DATASET_CACHE_SIZE):
+    """
+    Same as `load_files` with `return_notelists=True`, but scores and
+    melodies are `DatasetView` objects of a lazy `Dataset` instead of arrays.
+
+    RETURNS :
+        (scores, melodies, map of windows, notelists) or `None` if *WIN_WIDTH*
+        is not even
+    """
+    if WIN_WIDTH % 2 != 0:
+        return None
+
+    dataset = Dataset(find_files(path, settings.FILE_EXTENSIONS), WIN_WIDTH,
+                      overlap, cache_size)
+    return dataset.X, dataset.Y, dataset.map_score_window, dataset.notelists
+
+
+def gpu_in_use():
+    """
+    Return True if theano computes on a GPU, selected through
+    `theano.config.device` or `theano.gpuarray.use`. Forked processes cannot
+    use the CUDA context of their parent, so they must not run theano
+    functions in this case.
+    """
+    import theano
+    if not theano.config.device.startswith('cpu'):
+        return True
+    try:
+        from theano.gpuarray.type import list_contexts
+    except ImportError:
+        return False
+    return len(list_contexts()) > 0
+
+
 def evaluate(prediction, ground_truth):
     """ INPUT: three 2D arrays
     RETURNS: true_positives, false_positives, true_negatives and false negatives
@@ -0,0 +1,174 @@
+"""
+Store of the pianorolls predicted for the test pieces of crossvalidation
+folds and of `--validate`, so that the graph stage (threshold, clustering,
+monophony...) can be rerun on them without retraining (see `rescore`).
+
+A store is a directory with two arrays for each fold `k`, written by
+`save_fold` as `.npy` files so that they can be memory mapped:
+    * `fold_k.index.npy` with a record for each piece: the `fold`, the
+      `piece` (its index in the files found by `misc_tools.find_files`), the
+      `width` of its pianoroll and the range `start:end` of its pixels
+    * `fold_k.pixels.npy` with the `row`, `col` and `value` of the stored
+      pixels of all the pieces; values are `settings.PREDICTIONS_DTYPE`
+"""
+from cStringIO import StringIO
+import multiprocessing
+import os
+import re
+
+import numpy as np
+
+import graph_tools
+import settings
+from extra.utils.os_utils import atomic_open, init_worker
+from utils.pianoroll_utils import SparseRoll
+
+INDEX_DTYPE = np.dtype([('fold', np.int32), ('piece', np.int32),
+                        ('width', np.int64), ('start', np.int64),
+                        ('end', np.int64)])
+
+
+def pixels_dtype(value_dtype):
+    return np.dtype([('row', np.uint8), ('col', np.int32),
+                     ('value', value_dtype)])
+
+
+def _fold_path(directory, fold, name):
+    return os.path.join(directory, 'fold_' + str(fold) + '.' + name + '.npy')
+
+
+def save_fold(directory, fold, pieces, predictions, dtype=None):
+    """
+    Write to the store *directory* the *predictions* (2D arrays or
+    `SparseRoll`, as returned by `trainer.predict`) of the pieces with
+    indices *pieces* tested in *fold*; values are converted to *dtype*
+    (default `settings.PREDICTIONS_DTYPE`).
+    """
+    if dtype is None:
+        dtype = settings.PREDICTIONS_DTYPE
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # created by another fold in the meantime
+            pass
+
+    index = np.zeros(len(pieces), dtype=INDEX_DTYPE)
+    coords = []
+    start = 0
+    for i, (piece, prediction) in enumerate(zip(pieces, predictions)):
+        if isinstance(prediction, SparseRoll):
+            rows, cols, values = prediction.coords()
+        else:
+            rows, cols = np.nonzero(prediction)
+            values = prediction[rows, cols]
+        coords.append((rows, cols, values))
+        index[i] = (fold, piece, prediction.shape[1], start, start + len(rows))
+        start += len(rows)
+
+    pixels = np.empty(start, dtype=pixels_dtype(dtype))
+    for (rows, cols, values), record in zip(coords, index):
+        sl = slice(record['start'], record['end'])
+        pixels['row'][sl] = rows
+        pixels['col'][sl] = cols
+        pixels['value'][sl] = values
+
+    # the index is written last, so that a fold is in the store only when
+    # its pixels are complete
+    with atomic_open(_fold_path(directory, fold, 'pixels')) as f:
+        np.save(f, pixels)
+    with atomic_open(_fold_path(directory, fold, 'index')) as f:
+        np.save(f, index)
+
+
+def folds(directory):
+    """
+    Return the sorted list of the folds in the store *directory*
+    """
+    found = [re.match(r'fold_(-?\d+)\.index\.npy$', fn)
+             for fn in os.listdir(directory)]
+    return sorted(int(m.group(1)) for m in found if m is not None)
+
+
+def load_fold(directory, fold, mmap_mode='r'):
+    """
+    Return the index and the pixels of *fold* in the store *directory*,
+    memory mapped according to *mmap_mode*.
+    """
+    return (np.load(_fold_path(directory, fold, 'index'), mmap_mode=mmap_mode),
+            np.load(_fold_path(directory, fold, 'pixels'), mmap_mode=mmap_mode))
+
+
+def get_roll(record, pixels):
+    """
+    Return the `SparseRoll` of the piece described by the index *record*
+    """
+    pix = pixels[record['start']:record['end']]
+    return SparseRoll.from_coords(
+        pix['row'].astype(int), pix['col'].astype(int), pix['value'],
+        (settings.WIN_HEIGHT, int(record['width'])))
+
+
+def _rescore_fold(job):
+    # the graph stage of a fold, its output is returned as a string
+    directory, fold, notelists = job
+    index, pixels = load_fold(directory, fold)
+    predictions = [get_roll(record, pixels) for record in index]
+    out = StringIO()
+    out.write("\nFold " + str(fold))
+    results = graph_tools.test_shortest_path(
+        notelists, predictions, index['piece'], out)
+    return fold, results, out.getvalue()
+
+
+def rescore(directory, notelists, OUT_FILE, workers=None):
+    """
+    Run `graph_tools.test_shortest_path` with the current settings on the
+    predictions in the store *directory*, one fold per process in at most
+    *workers* processes (default `settings.RESCORE_WORKERS`, or one per
+    core if None). *notelists* are the notelists of all the pieces, as
+    returned by `misc_tools.load_notelists` on the files used for the
+    predictions.
+
+    The results of each piece and their averages are written to *OUT_FILE*.
+    Returns the average fmeasure.
+    """
+    jobs = []
+    for fold in folds(directory):
+        index = np.load(_fold_path(directory, fold, 'index'))
+        if len(index) and index['piece'].max() >= len(notelists):
+            raise Exception("The store contains more pieces than the files "
+                            "found, are they the same used for predicting?")
+        jobs.append((directory, fold, notelists[index['piece']]))
+
+    if workers is None:
+        workers = settings.RESCORE_WORKERS
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(jobs)))
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, init_worker)
+        try:
+            results = pool.map(_rescore_fold, jobs)
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        results = map(_rescore_fold, jobs)
+
+    fmeasures, precisions, recalls = [], [], []
+    for fold, (fmeasure, precision, recall), text in results:
+        OUT_FILE.write(text)
+        fmeasures += fmeasure
+        precisions += precision
+        recalls += recall
+
+    OUT_FILE.write("\nAverage precision: " + str(np.mean(precisions)))
+    OUT_FILE.write("\nAverage recall: " + str(np.mean(recalls)))
+    OUT_FILE.write("\nAverage fmeasure: " + str(np.mean(fmeasures)) + "\n")
+    OUT_FILE.flush()
+    return np.mean(fmeasures)
@@ -0,0 +1,153 @@
+"""
+Multi-fidelity pruning of hyperopt trials. Trials are first trained on a
+subset of the files and promoted to the whole dataset only if they are among
+the best ones (successive halving); at each epoch, the training of a trial
+is stopped if its validation loss is worse than the median of the other
+trials at the same epoch (median stopping).
+
+Trials evaluated by different processes are compared through records
+appended to a shared file, one JSON object per line.
+"""
+import json
+import os
+
+import numpy as np
+
+
+class EpochReporter(object):
+    """Callable passed as `epoch_callback` to `nn_models.cnn.CNN.fit`: it
+    reports the validation loss of each epoch to a `Pruner` and returns True
+    when the training should be stopped. After the training, `pruned` tells
+    if that happened.
+    """
+
+    def __init__(self, pruner, trial, fidelity):
+        self.pruner = pruner
+        self.trial = trial
+        self.fidelity = fidelity
+        self.pruned = False
+
+    def __call__(self, epoch, train_loss, val_loss):
+        self.pruner.report_epoch(self.trial, self.fidelity, epoch, val_loss)
+        if self.pruner.should_stop(self.trial, self.fidelity, epoch):
+            print("Pruning trial at epoch " + str(epoch + 1))
+            self.pruned = True
+        return self.pruned
+
+
+class Pruner(object):
+    """Decide whether a trial should be stopped or promoted by comparing it
+    with the other trials recorded in the file `fn`.
+
+    Parameters
+    ----------
+
+    fn : str
+        The file shared by all processes evaluating trials
+
+    eta : int
+        Only the best `1 / eta` of the trials evaluated on a subset of the
+        files are promoted to the next fidelity
+
+    min_epochs : int
+        Trials are never stopped before this number of epochs
+
+    min_trials : int
+        No trial is stopped or discarded until this number of other trials
+        can be compared with it
+    """
+
+    def __init__(self, fn, eta=3, min_epochs=5, min_trials=5):
+        self.fn = fn
+        self.eta = eta
+        self.min_epochs = min_epochs
+        self.min_trials = min_trials
+        # bytes of `fn` already read
+        self._offset = 0
+        # (trial, fidelity) -> list of validation losses, one for each epoch
+        self.curves = {}
+        # fidelity -> {trial: loss}
+        self.rungs = {}
+
+    def _write(self, record):
+        # one write per line, so that lines of different processes appending
+        # to the same file are not interleaved
+        with open(self.fn, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def _add(self, record):
+        if record['type'] == 'epoch':
+            curve = self.curves.setdefault(
+                (record['trial'], record['fidelity']), [])
+            epoch = record['epoch']
+            if len(curve) <= epoch:
+                curve.extend([np.nan] * (epoch + 1 - len(curve)))
+            curve[epoch] = record['loss']
+        elif record['type'] == 'rung':
+            self.rungs.setdefault(record['fidelity'], {})[record['trial']] = \
+                record['loss']
+
+    def update(self):
+        """
+        Read the records appended to the file since the last call.
+        """
+        if not os.path.exists(self.fn):
+            return
+        with open(self.fn, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        # the last line could be still incomplete
+        end = data.rfind('\n') + 1
+        self._offset += end
+        for line in data[:end].splitlines():
+            self._add(json.loads(line))
+
+    def report_epoch(self, trial, fidelity, epoch, loss):
+        """
+        Record the validation `loss` of `trial` trained on the fraction
+        `fidelity` of the files after `epoch` (counted from 0)
+        """
+        self._write({'type': 'epoch', 'trial': trial, 'fidelity': fidelity,
+                     'epoch': epoch, 'loss': float(loss)})
+
+    def should_stop(self, trial, fidelity, epoch):
+        """
+        Return True if the best validation loss of `trial` up to `epoch` is
+        worse than the median of the best losses of the other trials with the
+        same `fidelity` up to the same epoch.
+        """
+        if epoch + 1 < self.min_epochs:
+            return False
+        self.update()
+        curve = self.curves.get((trial, fidelity), [])[:epoch + 1]
+        others = [np.nanmin(c[:epoch + 1])
+                  for (t, f), c in self.curves.items()
+                  if t != trial and f == fidelity and len(c) > epoch]
+        if len(curve) == 0 or len(others) < self.min_trials:
+            return False
+        return np.nanmin(curve) > np.median(others)
+
+    def epoch_callback(self, trial, fidelity):
+        """
+        Return an `EpochReporter` for `trial` trained on the fraction
+        `fidelity` of the files
+        """
+        return EpochReporter(self, trial, fidelity)
+
+    def promote(self, trial, fidelity, loss):
+        """
+        Record the final `loss` of `trial` evaluated on the fraction
+        `fidelity` of the files and return True if it is among the best
+        `1 / eta` of the trials with the same fidelity, so that it should be
+        evaluated on more files.
+        """
+        self._write({'type': 'rung', 'trial': trial, 'fidelity': fidelity,
+                     'loss': float(loss)})
+        self.update()
+        losses = [l for t, l in self.rungs.get(fidelity, {}).items()
+                  if t != trial]
+        if len(losses) < self.min_trials:
+            return True
+        # the rank of this trial among all the others
+        rank = sum(l < loss for l in losses)
+        return rank < (len(losses) + 1) / float(self.eta)
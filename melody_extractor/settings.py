@@ -57,20 +57,71 @@ MAX_LOSS_ACCEPTED = 0.5
 EVALS = 300000
 # the algorithm used to optimize: `hyperopt.tpe.suggest` or `hyperopt.rand.suggest`
 SUGGEST = hyperopt.rand.suggest
+# the number of evaluations performed at the same time in different processes;
+# processes are forked, so if theano already uses a GPU in the main process
+# trials are evaluated one at a time (see `trainer.hyperopt`)
+HYPEROPT_WORKERS = 1
+# each completed evaluation is appended to this file, from which the
+# hyper-optimization is resumed
+HYPEROPT_JOURNAL = "trials.jsonl"
+# if True, hyperopt trials are pruned (see `melody_extractor.pruning`): each
+# trial is trained on `PRUNING_SUBSET` of the files first and only the best
+# 1 / `PRUNING_ETA` of them are evaluated on all the files; moreover, the
+# training stops when the validation loss is worse than the median of the
+# other trials at the same epoch. Decisions are taken only after
+# `PRUNING_MIN_EPOCHS` epochs and when at least `PRUNING_MIN_TRIALS` other
+# trials can be compared. Pruned trials are recorded as failed.
+PRUNING = False
+PRUNING_SUBSET = 0.25
+PRUNING_ETA = 3
+PRUNING_MIN_EPOCHS = 5
+PRUNING_MIN_TRIALS = 5
+# the losses of all trials are appended to this file, shared by all workers
+PRUNING_FILE = "pruning.jsonl"
 DATA_PATH = "./data/mcleod_comparison/"
 HYPEROPT_PATH = "../data/hyper-opt"
 WIN_HEIGHT = 128
 WIN_WIDTH = 64
+# if True, runs of empty columns longer than `REST_GUARD_WIDTH` are collapsed
+# before extracting the melody of a piece with `terminal_client.py --extract`
+# (see `utils.pianoroll_utils.compress_rests`); inspections, training and
+# crossvalidation always use the whole pianoroll. The guard width must be at
+# least the kernel width, which is never larger than the window width
+COMPRESS_RESTS = False
+REST_GUARD_WIDTH = WIN_WIDTH
 # the maximum time allowed for an epoch in seconds. if time needed for an epoch
 # is bigger than this, nn_models.cnn.fit(...) launches a RuntimeError, the
 # training is interrupted and the parameters with the best loss are used,
 # eventually the initial ones
 MAX_TIME = 120
 
+# overall budget of a `--train`, crossvalidation or hyper-optimization run,
+# in wall-clock seconds and in CPU hours (None means unlimited); it is divided
+# among folds and trials, the training stops before the deadline keeping the
+# best parameters and checkpointing its state, and a report of the time spent
+# is written to BUDGET_REPORT (see `melody_extractor.budget`)
+BUDGET_SECONDS = None
+BUDGET_CPU_HOURS = None
+BUDGET_REPORT = "budget.json"
+
 # this is the maximum number of epochs, but training uses early-stopping
 NUM_EPOCHS = 5000
+
+# when training with a checkpoint file (see `nn_models.cnn.CNN.fit`), its state
+# is saved every `CHECKPOINT_EVERY` epochs
+CHECKPOINT_EVERY = 10
 NONLINEARITY = lasagne.nonlinearities.sigmoid
 
+# on the first epoch, `nn_models.cnn.CNN.fit` trains with and without
+# switching targets and keeps the best mode; if `SWITCH_PROBE_BATCHES` is not
+# None, the two modes are compared on this number of training and validation
+# minibatches spread over the data, and only the best one is trained on the
+# whole first epoch. If `SWITCH_PROBE_CHECK` is True, the comparison on the
+# whole data is still performed and used, and the agreement of the two
+# decisions is logged and written to `TELEMETRY_FILE`
+SWITCH_PROBE_BATCHES = None
+SWITCH_PROBE_CHECK = False
+
 # the loss function used to train and validate
 LOSS = lasagne.objectives.squared_error
 
@@ -80,18 +131,94 @@ UPDATE = lasagne.updates.adadelta
 # the batch size
 BATCH_SIZE = 100 # (100, 0.05)
 
+# the number of windows predicted at a time by `trainer.predict` (CNN only);
+# windows of different pieces are packed in the same batch
+PREDICT_BATCH_SIZE = 256
+
+# crossvalidation and `--validate` store the predicted pianorolls with values
+# of this type (see `prediction_store`), so that `--rescore` can rerun the
+# graph stage on them in RESCORE_WORKERS processes (one per core if None);
+# use np.float32 to rescore exactly the same probabilities
+PREDICTIONS_DTYPE = np.float16
+RESCORE_WORKERS = None
+
 # use this for debugging purposes: load just this percentage of the dataset
 DATASET_PERC = 1.0
 
+# if True, windows are computed on demand from the note arrays instead of
+# being loaded all in memory (see `misc_tools.Dataset`)
+LAZY_DATASET = False
+
+# the maximum number of windows kept in memory by `misc_tools.Dataset`
+DATASET_CACHE_SIZE = 20000
+
+# the number of minibatches prepared in a background thread while training;
+# set to 0 to prepare them synchronously
+PREFETCH_DEPTH = 2
+
+# if True, `nn_models.cnn.CNN` keeps the training windows in theano shared
+# variables instead of passing them at each minibatch; if windows take more
+# than `SHARED_DATASET_BUDGET` bytes, they are loaded in chunks of that size
+SHARED_DATASET = False
+SHARED_DATASET_BUDGET = 2 ** 30
+
+# if True, before training a CNN the training and validation windows are
+# copied in new arrays in the order of their (shuffled) indices, so that
+# minibatches are slices of them instead of copies; this needs memory for
+# the copy and it is skipped if less than twice that memory is available,
+# or if windows are memory mapped or computed on demand
+CONTIGUOUS_LAYOUT = True
+
+# the number of processes among which each training minibatch of a CNN is
+# split (see `nn_models.data_parallel`); 1 trains in this process only. The
+# functions needed are compiled when the CNN is built, and it falls back to
+# 1 in worker processes of hyper-optimization and crossvalidation, which
+# cannot start other processes, and if theano uses a GPU, whose context
+# cannot be shared by forked processes. If `DATA_PARALLEL_DETERMINISTIC` is
+# True, gradients are summed in a fixed order, so that trainings are
+# reproducible. If `DATA_PARALLEL_REPORT` is True, `trainer.train` first
+# times some steps with 1 to `DATA_PARALLEL_WORKERS` processes and logs the
+# scaling efficiency
+DATA_PARALLEL_WORKERS = 1
+DATA_PARALLEL_DETERMINISTIC = True
+DATA_PARALLEL_REPORT = False
+
+# if not None, `nn_models.cnn.CNN.fit` appends the metrics of each epoch (time
+# spent waiting for data and in the training and validation functions, number
+# of batches, windows per second, peak RSS) to this file as JSON lines; if
+# `TELEMETRY_STEP_SAMPLE` > 0, one step every `TELEMETRY_STEP_SAMPLE` is
+# recorded too
+TELEMETRY_FILE = None
+TELEMETRY_STEP_SAMPLE = 0
+
 # set to False to skip data augmentation
 DATA_AUGMENTATION = True
 
+# the fraction of windows of each training minibatch which are added again
+# with the melody transposed when `DATA_AUGMENTATION` is True; with 0.5, as
+# many augmented windows are trained as when half of the training windows
+# were added transposed before training
+AUGMENTATION_RATE = 0.5
+
 # set to false to skip the masking with the input
 MASKED = True
 
 # set to false to skip the initialization through autoencoders
 AUTOENCODERS = False
 
+# the number of processes running the folds of
+# `melody_extractor.crossvalidation.crossvalidation` in parallel; it is capped
+# by the number of cores and by the available memory, assuming that each
+# process needs `CROSSVALIDATION_WORKER_MEMORY` bytes besides the windows,
+# which are shared
+CROSSVALIDATION_WORKERS = 1
+CROSSVALIDATION_WORKER_MEMORY = 4 * 2 ** 30
+
+# the number of compiled CNN models kept in memory by
+# `melody_extractor.trainer.get_CNN_model`, so that hyperopt trials with an
+# architecture already seen do not compile it again; 0 disables the cache
+MODEL_CACHE_SIZE = 8
+
 # if the following is True, then during hyperparameter optimization will be
 # used 10-fold cross validation
 HYPERPARAMS_CROSS_VALIDATION = False # True
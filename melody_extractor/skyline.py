@@ -143,7 +143,7 @@ def my_skyline_notelists(notelist):
     """
     perform a variation a the skyline algorithm by taking always the highest pitch
     at each time.
-    *notelist* must be in the form returned by misc_tools.load_files
+    *notelist* must be in the form returned by misc_tools.load_notelists
 
     RETURNS :
         the list of predicted labels, where 1 is for melody note and 0 is for
@@ -180,7 +180,7 @@ def skyline_notelists(notelist):
     """
     performs the skyline algorithm in its original formulation over
     the *notelist* in input.
-    *notelist* is in the form returned by misc_tools.load_files
+    *notelist* is in the form returned by misc_tools.load_notelists
 
     Reference paper:
     A. L. Uitdenbogerd and J. Zobel, "Melodic matching techniques for large
@@ -220,9 +220,7 @@ def test_skyline_notelists(PATH=settings.DATA_PATH, variation=False):
     if *variation* is True, then *my_skyline_notelists* is used, otherwise
     *skyline_notelists* is used.
     """
-    X, Y, map_sw, notelists = misc_tools.load_files(
-        PATH, 128, return_notelists=True)
-    del X, Y, map_sw
+    notelists = misc_tools.load_notelists(PATH)
 
     fmeasure_list = []
     precision_list = []
@@ -1,21 +1,30 @@
 import argparse
 import os
 import json
+import time
+from collections import OrderedDict
 
 import lasagne
 import numpy as np
 import sklearn.metrics
 import theano.tensor as T
-from hyperopt import STATUS_OK, STATUS_FAIL, fmin, Trials
+from hyperopt import STATUS_OK, STATUS_FAIL
 from sklearn.model_selection import train_test_split, GroupShuffleSplit
 
 import misc_tools
 import settings
 import graph_tools
-from nn_models import helper
+from nn_models import helper, data_parallel
 from nn_models.rnn import RNN
 from nn_models.cnn import CNN
+from nn_models.telemetry import Telemetry
+from utils.pianoroll_utils import SparseRoll
 import crossvalidation as cv
+import trial_executor
+import pruning
+import budget
+import prediction_store
+from extra.utils.os_utils import available_memory, init_worker
 
 
 try:
@@ -24,30 +33,33 @@ except Exception:
     import pickle
 
 OUT_FILE = "global variable to contain output path of intermediate results"
+# the `budget.Budget` of the hyper-optimization, shared by all its trials
+BUDGET = None
+# the GPU used by the processes evaluating hyperopt trials (e.g. 'cuda1'), see
+# `init_hyperopt_worker`; None to compute on the CPU
+GPU_DEVICE = None
 
+# data loaded by `load_data` and models built by `get_CNN_model`, kept in
+# memory across hyperopt trials
+_DATA_CACHE = OrderedDict()
+_MODEL_CACHE = OrderedDict()
+# the `pruning.Pruner` of this process, see `get_pruner`
+_PRUNER = []
 
-def run_trials(objective, trials):
 
-    if settings.MODEL_TYPE == 'cnn':
-        space = settings.CNN_SPACE
-    else:
-        space = settings.RNN_SPACE
-
-    best = 1
-    max_trials = len(trials.trials) + 1
-    try:
-        best = fmin(fn=objective, space=space, algo=settings.SUGGEST,
-                    max_evals=max_trials, trials=trials)
-    except Exception:
-        import traceback
-        traceback.print_exc()
-
-    # save the trials object
-    with open("trials.hyperopt", "wb") as f:
-        pickle.dump(trials, f)
-    print("saved trials object")
-
-    return best
+def init_hyperopt_worker():
+    """
+    Setup a process evaluating hyperopt trials: it ignores keyboard
+    interrupts (handled by the main process), appends its results to
+    'hyperoptimization.txt' and initializes `GPU_DEVICE`, since the CUDA
+    context of the main process cannot be used after forking
+    """
+    global OUT_FILE
+    init_worker()
+    OUT_FILE = open("hyperoptimization.txt", "a")
+    if GPU_DEVICE is not None:
+        import theano.gpuarray
+        theano.gpuarray.use(GPU_DEVICE)
 
 
 def hyperopt(parameters_path='parameters.json'):
@@ -57,94 +69,145 @@ def hyperopt(parameters_path='parameters.json'):
     `settings.FILE_EXTENSIONS` are considered. Save best parameters on each evaluation
     in 'parameters.json' by default, otherwise to the path specified as argument.
 
-    Moreover, saves 'trials.hyperopt' object containing the evaluation records to be re-used
-    if the hyper-optimization stops for any cause.
+    Trials are evaluated by `settings.HYPEROPT_WORKERS` processes (see
+    `trial_executor.run_trials`). Moreover, each evaluation is appended to the
+    `settings.HYPEROPT_JOURNAL` file, so that the hyper-optimization can be
+    resumed if it stops for any cause; a 'trials.hyperopt' object saved by
+    previous versions is imported in the journal.
+
+    The hyper-optimization ends when the budget of `settings.BUDGET_SECONDS`
+    and `settings.BUDGET_CPU_HOURS` is over (see `trial_executor.run_trials`
+    and `budget.Budget`).
+
+    Worker processes are forked, so if theano already uses a GPU in this
+    process (see `misc_tools.gpu_in_use`) trials are evaluated one at a time
+    here; to evaluate them in parallel on a GPU, leave this process on the CPU
+    and set `GPU_DEVICE`, which each worker initializes.
     """
 
-    global OUT_FILE
-    OUT_FILE = open("hyperoptimization.txt", "w")
+    global OUT_FILE, BUDGET
+    OUT_FILE = open("hyperoptimization.txt", "a")
+    workers = settings.HYPEROPT_WORKERS
+    if workers > 1 and misc_tools.gpu_in_use():
+        print("Theano uses a GPU in this process, which forked workers cannot "
+              "share: evaluating one trial at a time")
+        workers = 1
+    BUDGET = budget.from_settings(workers)
 
     # settings.DATASET_PERC = 0.15
     print("HYPER-OPTIMIZATION")
-    try:  # try to load an already saved trials object, and increase the max
-        trials = pickle.load(open("trials.hyperopt", "rb"))
-        print("Found saved Trials! Loading...")
-    except Exception:  # create a new trials object and start searching
-        trials = Trials()
-
-    for i in range(settings.EVALS - len(trials.trials)):
-        print("Evaluation number " + str(i + 1))
-        best = run_trials(objective, trials)
-        # saving the best parameters
-        if best != 1:
-            print("BEST PARAMETERS FOOUND: " + str(best))
-            json.dump(best, open(parameters_path, 'w'))
+    if settings.MODEL_TYPE == 'cnn':
+        space = settings.CNN_SPACE
+    else:
+        space = settings.RNN_SPACE
+
+    journal_fn = settings.HYPEROPT_JOURNAL
+    if not os.path.exists(journal_fn) and os.path.exists("trials.hyperopt"):
+        print("Found saved Trials! Importing them in " + journal_fn)
+        with open(journal_fn, 'a') as f:
+            for record in trial_executor.records_from_trials("trials.hyperopt"):
+                trial_executor.append_journal(f, record)
+
+    best = trial_executor.run_trials(
+        objective, space, settings.SUGGEST, settings.EVALS, journal_fn,
+        parameters_path, workers=workers,
+        initializer=init_hyperopt_worker, budget=BUDGET)
+    if BUDGET.limited:
+        BUDGET.write_report()
 
     print("________________")
     print("BEST  PARAMETERS")
     print(best)
 
 
-def data_augmentation(indices, X, Y):
-    """ Perform data augmentation by lowering down the melody in the 50% of the windows
-    listed in *indices*.
+def augment_batch(inputs, targets, rng):
+    """ Perform data augmentation on a minibatch by adding copies of a random
+    subset of its windows (each one taken with probability
+    `settings.AUGMENTATION_RATE`) with the melody lowered down by 0, 1 or 2
+    octaves (chosen for each melody pixel). The original windows are all
+    kept, so that the batch grows at most to twice its size.
 
     PARAMETERS :
-        X : numpy.ndarray with shape (num_of_windows, 1, window_height, window_length)
-            this is the array containing the input windows (melodies + accompaniment)
-        Y : numpy.ndarray with shape (num_of_windows, 1, window_height, window_length)
-            this is the array containing the output windows (melodies, ground truth)
-        indices : an array-like containing the indices from which the 50% will be
-            randomly extracted and used for data augmentation
+        inputs : numpy.ndarray with shape (batch_size, 1, window_height, window_length)
+            the input windows of the batch (melodies + accompaniment)
+        targets : numpy.ndarray with shape (batch_size, 1, window_height, window_length)
+            the output windows of the batch (melodies, ground truth)
+        rng : numpy.random.RandomState
+            the random generator used to choose windows and shifts
 
     RETURNS :
-        numpy.ndarray with shape (int(len(indices) / 2), 1, window_height, window_length)
-            a numpy array containing the generated windows
+        a tuple of two numpy.ndarray containing the windows of *inputs* and
+        *targets* followed by the augmented ones; *inputs* and *targets* are
+        not modified
     """
+    extracted_indices = np.flatnonzero(
+        rng.rand(len(inputs)) < settings.AUGMENTATION_RATE)
+    if len(extracted_indices) == 0:
+        return inputs, targets
 
-    # taking the 50% of windows
-    np.random.seed(1992)
-    # extracted_indices = np.random.randint(
-    #     len(indices), size=int(len(indices)))
-    extracted_indices = np.random.randint(
-        len(indices), size=int(len(indices) / 2))
+    pianorolls = inputs[extracted_indices]
+    melodies = targets[extracted_indices]
 
-    Xreturned = []
-    Yreturned = []
+    # take melody indices
+    w, c, pitch, time = np.nonzero(melodies > 0.5)
 
-    for i in extracted_indices:
-        # for each extracted window
-        pianoroll = X[i].copy()
-        melody = Y[i].copy()
+    # remove the melody...
+    melodies[w, c, pitch, time] = 0
+    pianorolls[w, c, pitch, time] = 0
 
-        # take melody_indices
-        idx = np.argwhere(melody > 0.5)
+    # ...and re-add it 0, 1 or 2 octaves lower
+    new_pitch = np.maximum(pitch - rng.randint(0, 3, size=len(pitch)) * 12, 0)
+    melodies[w, c, new_pitch, time] = 1
+    pianorolls[w, c, new_pitch, time] = 1
 
-        # for each melody index
-        for j in idx:
-            # remove the melody
-            melody[j[0], j[1], j[2]] = 0
-            pianoroll[j[0], j[1], j[2]] = 0
+    return (np.concatenate((inputs, pianorolls)),
+            np.concatenate((targets, melodies)))
 
-            # re-add the melody 1 or 2 octaves lower or 1 octave higher
-            k = np.random.randint(0, 3)
-            # if k == 0:
-            #     new_pitch = min(j[2] + 12, 255)
-            # else:
-            new_pitch = max(j[2] - k * 12, 0)
-            melody[j[0], j[1], new_pitch] = 1
-            pianoroll[j[0], j[1], new_pitch] = 1
 
-        Xreturned.append(pianoroll)
-        Yreturned.append(pianoroll)
+def contiguous_layout(X, Y, training, validation):
+    """
+    Copy the windows of *X* and *Y* indexed by *training* and *validation*
+    in new arrays, in this order, so that the minibatches taken by
+    `nn_models.cnn.CNN.fit` from consecutive indices are slices instead of
+    copies (see `nn_models.cnn.contiguous_slice`). The order of the indices,
+    i.e. their shuffling, is kept.
+
+    Returns the new X, Y, training and validation indices, or the arguments
+    themselves if *X* or *Y* are not arrays in memory (lazy datasets and
+    memory maps shared among processes) or if less than twice the memory of
+    the copy is available.
+    """
+    if type(X) is not np.ndarray or type(Y) is not np.ndarray:
+        return X, Y, training, validation
 
-    return np.array(Xreturned), np.array(Yreturned)
+    order = np.concatenate([training, validation])
+    nbytes = len(order) * (X[0].nbytes + Y[0].nbytes)
+    memory = available_memory()
+    if memory is not None and 2 * nbytes > memory:
+        print("Not enough memory to reorder windows, using indices")
+        return X, Y, training, validation
 
+    print("Reordering " + str(len(order)) + " windows for training")
+    X = np.take(X, order, axis=0)
+    Y = np.take(Y, order, axis=0)
+    n = len(training)
+    return X, Y, np.arange(n), np.arange(n, len(order))
 
-def train(training, validation, X, Y, NN_model, nan_exception=False):
+
+def train(training, validation, X, Y, NN_model, nan_exception=False,
+          checkpoint=None, resume=False, epoch_callback=None, deadline=None):
     """ trains a NN_model
     If `settings.DATA_AUGMENTATION` is *True*, then a data augmentation is performed
-    by transposing down the melody in the 50% of the windows.
+    on each minibatch by transposing down the melody in a part of its windows
+    (see `augment_batch`).
+    If `settings.CONTIGUOUS_LAYOUT` is *True*, the windows of a CNN are
+    reordered after the shuffling (see `contiguous_layout`).
+    If `settings.DATA_PARALLEL_REPORT` is *True* and
+    `settings.DATA_PARALLEL_WORKERS` > 1, the speedup and the efficiency of
+    splitting minibatches of a CNN among 1 to `DATA_PARALLEL_WORKERS`
+    processes are measured before training (see
+    `nn_models.data_parallel.scaling_report`) and written to
+    `settings.TELEMETRY_FILE` too.
 
     PARAMETERS :
     ------------
@@ -154,6 +217,14 @@ def train(training, validation, X, Y, NN_model, nan_exception=False):
         *Y * is a 4D array containing output windows(ground truth)
         *NN_model * the model that should be trained, with `fit` method
             compliant to the one of nn_models.cnn.CNN and nn_models.rnn.RNN
+        *checkpoint * if not None, the path where the state of the training
+            is saved, so that it can be resumed (only CNN)
+        *resume * if True, the training restarts from *checkpoint * if it
+            exists
+        *epoch_callback * if not None, it is called after each epoch and can
+            stop the training (only CNN, see `nn_models.cnn.CNN.fit`)
+        *deadline * if not None, the time by which the training must end
+            (only CNN, see `nn_models.cnn.CNN.fit`)
     """
 
     if len(training) <= len(validation):
@@ -161,13 +232,9 @@ def train(training, validation, X, Y, NN_model, nan_exception=False):
         return 'error'
 
     if settings.DATA_AUGMENTATION:
-        addedX, addedY = data_augmentation(training, X, Y)
-        added_indices = range(X.shape[0], addedX.shape[0] + X.shape[0])
-
-        # adding the augmented windows
-        training = np.concatenate((training, added_indices))
-        X = np.concatenate((X, addedX))
-        Y = np.concatenate((Y, addedY))
+        augment = augment_batch
+    else:
+        augment = None
 
     # if settings.MODEL_TYPE == 'cnn':
     #     BATCH_PERC = 0.05
@@ -182,6 +249,21 @@ def train(training, validation, X, Y, NN_model, nan_exception=False):
     np.random.seed(78)
     np.random.shuffle(validation)
 
+    if settings.CONTIGUOUS_LAYOUT and isinstance(NN_model, CNN):
+        X, Y, training, validation = contiguous_layout(
+            X, Y, training, validation)
+
+    if settings.DATA_PARALLEL_REPORT and settings.DATA_PARALLEL_WORKERS > 1 \
+            and isinstance(NN_model, CNN) and data_parallel.can_fork():
+        print("Measuring the scaling of data-parallel training")
+        report = data_parallel.scaling_report(
+            NN_model, X, Y, training, BATCHSIZE,
+            settings.DATA_PARALLEL_WORKERS, masked=settings.MASKED,
+            deterministic=settings.DATA_PARALLEL_DETERMINISTIC)
+        telemetry = Telemetry(settings.TELEMETRY_FILE)
+        for record in report:
+            telemetry.write('scaling', record)
+
     # only CNN for now...
     if settings.AUTOENCODERS:
         print("Looking for initial parameters through autoencoders")
@@ -194,6 +276,14 @@ def train(training, validation, X, Y, NN_model, nan_exception=False):
     print("And now train the network...")
     print("...sorry, this could take a while...")
     # train(training, validation, X, Y, val_fn, train_fn)
+    kwargs = {}
+    if checkpoint is not None:
+        kwargs['checkpoint'] = checkpoint
+        kwargs['resume'] = resume
+    if epoch_callback is not None:
+        kwargs['epoch_callback'] = epoch_callback
+    if deadline is not None:
+        kwargs['deadline'] = deadline
     NN_model.fit(
         X=X,
         Y=Y,
@@ -202,7 +292,9 @@ def train(training, validation, X, Y, NN_model, nan_exception=False):
         NUM_EPOCHS=settings.NUM_EPOCHS,
         BATCHSIZE=BATCHSIZE,
         nan_exception=nan_exception,
-        masked=settings.MASKED
+        masked=settings.MASKED,
+        augment=augment,
+        **kwargs
     )
 
 
@@ -277,6 +369,34 @@ def build_CNN_model(args, WIN_HEIGHT=settings.WIN_HEIGHT, NONLINEARITY=settings.
     return cnn
 
 
+def get_CNN_model(args):
+    """ same as `build_CNN_model`, but the last `settings.MODEL_CACHE_SIZE`
+    models are kept in memory, so that a model with the same architecture
+    (`kernel_h0`, `kernel_w0` and `num_kernel0`) is not compiled again: its
+    initial weights and training state are restored instead (see
+    `nn_models.cnn.CNN.reset_training_state`)"""
+
+    if settings.MODEL_CACHE_SIZE < 1:
+        return build_CNN_model(args)
+
+    key = (int(args['kernel_h0']), int(args['kernel_w0']), int(args['num_kernel0']),
+           settings.WIN_HEIGHT, settings.WIN_WIDTH, settings.SHARED_DATASET)
+    if key in _MODEL_CACHE:
+        print("Using an already compiled network")
+        NN_model, initial_params = _MODEL_CACHE.pop(key)
+        NN_model.set_params(initial_params)
+        NN_model.reset_training_state()
+    else:
+        NN_model = build_CNN_model(args)
+        initial_params = NN_model.get_params()
+
+    # most recently used as last
+    _MODEL_CACHE[key] = (NN_model, initial_params)
+    while len(_MODEL_CACHE) > settings.MODEL_CACHE_SIZE:
+        _MODEL_CACHE.popitem(last=False)
+    return NN_model
+
+
 def build_RNN_model(args, WIN_HEIGHT=settings.WIN_HEIGHT, NONLINEARITY=settings.NONLINEARITY):
     """
     returns a nn_models.models.RNN object built with
@@ -314,52 +434,109 @@ def build_RNN_model(args, WIN_HEIGHT=settings.WIN_HEIGHT, NONLINEARITY=settings.
 
 
 def predict(testing, groups, X, NN_model):
+    """
+    Returns the pianorolls predicted by *NN_model* for each piece, in the
+    order of the piece indices in *groups*, whose windows are the indices in
+    *testing* of *X* (*groups* contains the piece of each window in
+    *testing*). Only pixels of the input notes are kept; with a CNN, the
+    pianorolls are `SparseRoll` objects (see `predict_cnn`).
+    """
     # Reordering testing and groups according to groups
-    f = np.rec.fromarrays([groups, testing])
-    f.sort()
-    groups = f.f0
-    testing = f.f1
+    order = np.lexsort((testing, groups))
+    groups = groups[order]
+    testing = testing[order]
+
+    if settings.MODEL_TYPE == 'cnn':
+        return predict_cnn(testing, groups, X, NN_model)
 
     predictions = []
     prediction = []
     for i, w_index in enumerate(testing):
         x = X[w_index]
-        if settings.MODEL_TYPE == 'cnn':
-            p = NN_model.predict(x[np.newaxis])[0, 0]
-        else:
-            p = NN_model.predict(x[np.newaxis, np.newaxis])[0, 0]
+        p = NN_model.predict(x[np.newaxis, np.newaxis])[0, 0]
         prediction.append(p * x[0])
 
         if i + 1 == len(testing) or groups[i] != groups[i + 1]:
-            if settings.MODEL_TYPE == 'cnn':
-                prediction = np.array(prediction)[:, np.newaxis, :, :]
-                t = misc_tools.recreate_pianorolls(
-                    prediction, overlap=True)
-            else:
-                prediction = np.array(prediction)
-                t = misc_tools.recreate_pianorolls(
-                    prediction, overlap=False)
+            prediction = np.array(prediction)
+            t = misc_tools.recreate_pianorolls(
+                prediction, overlap=False)
             predictions.append(t)
             prediction = []
     return predictions
 
 
-def simple_validation(args):
+def predict_cnn(testing, groups, X, NN_model, batchsize=None):
+    """
+    `predict` for a CNN and overlapping windows, with *testing* and
+    *groups* sorted by piece.
+
+    Windows are predicted *batchsize* (default `settings.PREDICT_BATCH_SIZE`)
+    at a time, also packing windows of different pieces in the same batch.
+    The stored pixels of all batches are then moved to their columns in the
+    pianoroll of their piece and summed at once, as
+    `misc_tools.recreate_pianorolls` does for each piece.
+    """
+    if batchsize is None:
+        batchsize = settings.PREDICT_BATCH_SIZE
+    if len(testing) == 0:
+        return []
+    WIN_HEIGHT, WIN_WIDTH = X.shape[2:]
+    hop = WIN_WIDTH / 2
+
+    # the piece of each window (counted from 0) and its position in it
+    first = np.ones(len(groups), dtype=bool)
+    first[1:] = groups[1:] != groups[:-1]
+    piece = np.cumsum(first) - 1
+    position = np.arange(len(groups)) - np.flatnonzero(first)[piece]
+
+    pieces, rows, cols, values = [], [], [], []
+    for start in range(0, len(testing), batchsize):
+        x = X[testing[start:start + batchsize]]
+        p = NN_model.predict(x)
+        # only pixels of the input notes are kept
+        masked = p[:, 0] * x[:, 0]
+        w, r, c = np.nonzero(masked)
+        values.append(masked[w, r, c] * 0.5)
+        w += start
+        pieces.append(piece[w])
+        rows.append(r)
+        cols.append(c + position[w] * hop)
+
+    pieces, rows, cols, values = [
+        np.concatenate(a) for a in (pieces, rows, cols, values)]
+    order = np.argsort(pieces, kind='mergesort')
+    bounds = np.searchsorted(pieces[order], np.arange(piece[-1] + 2))
+    n_windows = np.bincount(piece)
+
+    predictions = []
+    for k in range(len(n_windows)):
+        sl = order[bounds[k]:bounds[k + 1]]
+        width = WIN_WIDTH * n_windows[k] / 2 + WIN_WIDTH / 2
+        predictions.append(SparseRoll.from_coords(
+            rows[sl], cols[sl], values[sl], (WIN_HEIGHT, width)))
+    return predictions
+
+
+def simple_validation(args, epoch_callback=None):
     """
     This performs a training and testing over the * perc * of the whole
     dataset. It saves intermediate results in the global `OUT_FILE` file object.
     It uses a fixed random seed, so that successive calls will produce the same
     results. Returns the average fmeasure.
 
+    *epoch_callback * is passed to `train`; the training ends by the end of
+    the hyper-optimization budget, if any.
     """
 
     nan_exception = 'nan_exception' in args
+    deadline = BUDGET.end() if BUDGET is not None else None
 
     hyperparameters_set, remaining, groups, X, Y, NN_model, testing, notelists = setup_train_and_test(
         args, random_state=1992)
 
     fmeasures, precisions, recalls = train_and_test(
-        hyperparameters_set, remaining, groups, X, Y, NN_model, testing, notelists, OUT_FILE=OUT_FILE, nan_exception=nan_exception)
+        hyperparameters_set, remaining, groups, X, Y, NN_model, testing, notelists, OUT_FILE=OUT_FILE, nan_exception=nan_exception,
+        epoch_callback=epoch_callback, deadline=deadline)
     print("F-measures: " + str(fmeasures))
     print("Precisions: " + str(precisions))
     print("Recalls: " + str(recalls))
@@ -373,9 +550,57 @@ def simple_validation(args):
     return average_fmeasure
 
 
+def load_data(WIN_WIDTH=settings.WIN_WIDTH, overlap=True):
+    """
+    Returns scores, melodies, map of windows and notelists of the files in
+    `settings.DATA_PATH` as returned by `misc_tools.load_files` (or
+    `misc_tools.load_dataset` if `settings.LAZY_DATASET` is True) and the
+    groups built by `misc_tools.build_groups`.
+
+    The last loaded data are kept in memory and returned again by the
+    following calls with the same settings, so they must not be modified.
+    If `settings.PRUNING` is True, both the subset of the files used by the
+    first evaluation of trials and all the files are kept.
+    """
+    return _load_data_entry(WIN_WIDTH, overlap)['data']
+
+
+def _load_data_entry(WIN_WIDTH, overlap):
+    # the entry of `_DATA_CACHE` with the data and their splits
+    key = (settings.DATA_PATH, settings.FILE_EXTENSIONS, settings.DATASET_PERC,
+           settings.LAZY_DATASET, WIN_WIDTH, overlap)
+    if key in _DATA_CACHE:
+        print("Using already loaded files")
+        entry = _DATA_CACHE.pop(key)
+        _DATA_CACHE[key] = entry
+        return entry
+
+    # release the previous data before loading the new ones
+    size = 2 if settings.PRUNING else 1
+    while len(_DATA_CACHE) >= size:
+        _DATA_CACHE.popitem(last=False)
+    print("Ok, we're ready to load files, let's start!")
+    if settings.LAZY_DATASET:
+        X, Y, map_sw, notelists = misc_tools.load_dataset(
+            settings.DATA_PATH, WIN_WIDTH, overlap=overlap)
+    else:
+        X, Y, map_sw, notelists = misc_tools.load_files(
+            settings.DATA_PATH, WIN_WIDTH, extensions=settings.FILE_EXTENSIONS,
+            return_notelists=True, overlap=overlap)
+
+    dataset, groups = misc_tools.build_groups(map_sw)
+    _DATA_CACHE[key] = {'data': (X, Y, map_sw, notelists, dataset, groups),
+                        'splits': {}}
+    return _DATA_CACHE[key]
+
+
 def setup_train_and_test(args, random_state=1992):
     """
     Returns variables to be used in train_and_test function
+
+    Files are loaded through `load_data` and CNN models are built through
+    `get_CNN_model`, so that successive calls (e.g. hyperopt trials) do not
+    load and compile them again.
     """
     if settings.MODEL_TYPE == 'cnn':
         OVERLAP = True
@@ -383,33 +608,39 @@ def setup_train_and_test(args, random_state=1992):
         OVERLAP = False
 
     WIN_WIDTH = settings.WIN_WIDTH
-    print("Ok, we're ready to load files, let's start!")
-    X, Y, map_sw, notelists = misc_tools.load_files(
-        settings.DATA_PATH, WIN_WIDTH, return_notelists=True, overlap=OVERLAP)
+    entry = _load_data_entry(WIN_WIDTH, OVERLAP)
+    X, Y, map_sw, notelists, hyperparameters_set, groups = entry['data']
 
     print("Separating training, validation and test set...")
 
     if settings.MODEL_TYPE == 'cnn':
-        NN_model = build_CNN_model(args)
+        NN_model = get_CNN_model(args)
     else:
         args['gradient_steps'] = int(min([len(i) for i in map_sw])) / 2
         NN_model = build_RNN_model(args)
 
-    # building groups
-    hyperparameters_set, groups = misc_tools.build_groups(map_sw)
-    test_size = max(0.2, 30.0 / len(np.unique(groups)))
-    # if data are very very little, use 0.2
-    if test_size >= 0.5:
-        test_size = 0.2
-    print("using test_size = " + str(test_size))
-    remaining, testing = GroupShuffleSplit(test_size=test_size, random_state=random_state).split(
-        hyperparameters_set, groups=groups).next()
+    splits = entry['splits']
+    if random_state not in splits:
+        test_size = max(0.2, 30.0 / len(np.unique(groups)))
+        # if data are very very little, use 0.2
+        if test_size >= 0.5:
+            test_size = 0.2
+        print("using test_size = " + str(test_size))
+        splits[random_state] = GroupShuffleSplit(test_size=test_size, random_state=random_state).split(
+            hyperparameters_set, groups=groups).next()
+    # copies, since callers shuffle them
+    remaining, testing = [np.copy(split) for split in splits[random_state]]
     return hyperparameters_set, remaining, groups, X, Y, NN_model, testing, notelists
 
 
-def train_and_test(dataset, remaining, groups, X, Y, NN_model, testing, notelists, OUT_FILE=None, nan_exception=False):
+def train_and_test(dataset, remaining, groups, X, Y, NN_model, testing, notelists, OUT_FILE=None, nan_exception=False,
+                   checkpoint=None, resume=False, epoch_callback=None, deadline=None,
+                   store=None, fold=0):
     """
     Perform a training and a test. Returns fmeasures precisions and recalls on each group.
+    *checkpoint *, *resume *, *epoch_callback * and *deadline * are passed to `train`.
+    If *store * is not None, the predictions of the test pieces are saved in
+    that directory as *fold * (see `prediction_store.save_fold`).
     """
     val_size = max(0.2, 30.0 / len(np.unique(groups[remaining])))
     # if data are very very little, use 0.2
@@ -420,7 +651,9 @@ def train_and_test(dataset, remaining, groups, X, Y, NN_model, testing, notelist
         dataset[remaining], groups=groups[remaining]).next()
 
     train(dataset[training],
-          dataset[validation], X, Y, NN_model, nan_exception)
+          dataset[validation], X, Y, NN_model, nan_exception,
+          checkpoint=checkpoint, resume=resume, epoch_callback=epoch_callback,
+          deadline=deadline)
     print("And test!")
 
     groups_testing = groups[testing]
@@ -431,6 +664,9 @@ def train_and_test(dataset, remaining, groups, X, Y, NN_model, testing, notelist
         pieces_indices = None
 
     prediction_list = predict(testing, groups_testing, X, NN_model)
+    if store is not None:
+        prediction_store.save_fold(store, fold, np.unique(groups_testing),
+                                   prediction_list)
     fmeasures, precisions, recalls = graph_tools.test_shortest_path(test_notelists,
                                                                     prediction_list,
                                                                     pieces_indices,
@@ -438,6 +674,54 @@ def train_and_test(dataset, remaining, groups, X, Y, NN_model, testing, notelist
     return fmeasures, precisions, recalls
 
 
+def get_pruner():
+    """
+    Return the `pruning.Pruner` of this process, reading the losses of all
+    trials from `settings.PRUNING_FILE`
+    """
+    if len(_PRUNER) == 0:
+        _PRUNER.append(pruning.Pruner(
+            settings.PRUNING_FILE, eta=settings.PRUNING_ETA,
+            min_epochs=settings.PRUNING_MIN_EPOCHS,
+            min_trials=settings.PRUNING_MIN_TRIALS))
+    return _PRUNER[0]
+
+
+def pruned_validation(args):
+    """
+    Like `simple_validation`, but the trial is evaluated on
+    `settings.PRUNING_SUBSET` of the files first and then on all of them only
+    if it is among the best trials evaluated on the subset. In both cases,
+    the training is stopped if the validation loss is worse than the median
+    of the other trials (see `pruning.Pruner`). Returns the result for
+    hyperopt: pruned trials are failed, with the loss reached so far in
+    'pruned_loss'.
+    """
+    pruner = get_pruner()
+    trial = "{}-{}".format(os.getpid(), time.time())
+    full_perc = settings.DATASET_PERC
+    fidelities = [1.0]
+    if settings.PRUNING_SUBSET < 1:
+        fidelities.insert(0, settings.PRUNING_SUBSET)
+
+    try:
+        for fidelity in fidelities:
+            settings.DATASET_PERC = full_perc * fidelity
+            callback = pruner.epoch_callback(trial, fidelity)
+            loss = 1 - simple_validation(args, epoch_callback=callback)
+            if callback.pruned:
+                OUT_FILE.write("\nTrial pruned during training\n")
+                return {'loss': 2, 'status': STATUS_FAIL,
+                        'pruned_loss': loss, 'fidelity': fidelity}
+            if fidelity < 1 and not pruner.promote(trial, fidelity, loss):
+                OUT_FILE.write("\nTrial not promoted to all the files\n")
+                return {'loss': 2, 'status': STATUS_FAIL,
+                        'pruned_loss': loss, 'fidelity': fidelity}
+        return {'loss': loss, 'status': STATUS_OK}
+    finally:
+        settings.DATASET_PERC = full_perc
+
+
 def objective(args):
     """ This function can be used with hyperopt module to optimize
     the hyperparameters of the model
@@ -452,7 +736,9 @@ def objective(args):
 
     try:
         if settings.HYPERPARAMS_CROSS_VALIDATION:
-            loss = 1 - cv.crossvalidation(args, OUT_FILE=OUT_FILE)
+            loss = 1 - cv.crossvalidation(args, OUT_FILE=OUT_FILE, budget=BUDGET)
+        elif settings.PRUNING:
+            return pruned_validation(args)
         else:
             loss = 1 - simple_validation(args)
         return {'loss': loss, 'status': STATUS_OK}
@@ -465,7 +751,9 @@ def objective(args):
 
 
 if __name__ == '__main__':
-    import theano.gpuarray
-    theano.gpuarray.use('cuda1')
+    GPU_DEVICE = 'cuda1'
+    if settings.HYPEROPT_WORKERS <= 1:
+        import theano.gpuarray
+        theano.gpuarray.use(GPU_DEVICE)
 
     hyperopt()
@@ -0,0 +1,257 @@
+"""
+Run hyperopt trials concurrently in local worker processes, without a MongoDB
+server. Each completed trial is appended to a journal (one JSON object per
+line), from which an interrupted search can be resumed, and the best
+parameters are rewritten atomically after each improvement.
+"""
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+from hyperopt import (JOB_STATE_DONE, JOB_STATE_RUNNING, STATUS_FAIL,
+                      STATUS_OK, Trials)
+from hyperopt.base import Domain, spec_from_misc
+from hyperopt.fmin import space_eval
+
+from extra.utils.os_utils import atomic_open
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# seconds between two checks of the running trials
+POLL_INTERVAL = 0.5
+
+
+def _builtin(obj):
+    # numpy scalars used by the suggestion algorithms
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(repr(obj) + " is not JSON serializable")
+
+
+def read_journal(fn):
+    """
+    Return the list of records written in the journal `fn` by
+    `append_journal`; a last line truncated by an interruption is ignored.
+    """
+    records = []
+    if not os.path.exists(fn):
+        return records
+    with open(fn) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                print("Skipping an incomplete line in " + fn)
+    return records
+
+
+def drop_incomplete_line(fn):
+    """
+    Remove from the journal `fn` a last line truncated by an interruption,
+    which would otherwise be joined to the next record appended.
+    """
+    if not os.path.exists(fn):
+        return
+    with open(fn, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith('\n'):
+            f.truncate(data.rfind('\n') + 1)
+
+
+def append_journal(f, record):
+    """
+    Append `record` to the journal opened in `f` and make sure that it is
+    written on disk.
+    """
+    f.write(json.dumps(record, default=_builtin) + '\n')
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def records_from_trials(fn):
+    """
+    Return the journal records of the completed trials in the pickled
+    `hyperopt.Trials` object saved in `fn`, so that a search started with a
+    previous version can be continued.
+    """
+    with open(fn, 'rb') as f:
+        trials = pickle.load(f)
+    return [{'vals': t['misc']['vals'], 'result': t['result']}
+            for t in trials.trials if t['state'] == JOB_STATE_DONE]
+
+
+def trials_from_journal(records, domain):
+    """
+    Build a `hyperopt.Trials` object containing the completed trials in
+    `records`. Trials are numbered in the order of the journal, since the ids
+    of the trials that were running when the search was interrupted are
+    missing.
+    """
+    trials = Trials()
+    for tid, record in enumerate(records):
+        vals = record['vals']
+        misc = {'tid': tid, 'cmd': domain.cmd, 'workdir': domain.workdir,
+                'idxs': dict((k, [tid] if v else []) for k, v in vals.items()),
+                'vals': vals}
+        docs = trials.new_trial_docs([tid], [None], [record['result']], [misc])
+        docs[0]['state'] = JOB_STATE_DONE
+        trials.insert_trial_docs(docs)
+    trials.refresh()
+    return trials
+
+
+def best_parameters(trials):
+    """
+    Return the loss and the parameters (as returned by `hyperopt.fmin`) of
+    the best completed trial, or (None, None) if no trial succeeded.
+    """
+    ok = [t for t in trials.trials
+          if t['state'] == JOB_STATE_DONE and t['result']['status'] == STATUS_OK]
+    if len(ok) == 0:
+        return None, None
+    best = min(ok, key=lambda t: t['result']['loss'])
+    params = dict((k, v[0]) for k, v in best['misc']['vals'].items() if v)
+    return best['result']['loss'], params
+
+
+def run_trials(objective, space, algo, max_evals, journal_fn, parameters_path,
+               workers=1, initializer=None, budget=None):
+    """
+    Minimize `objective` over `space` with the suggestion algorithm `algo`
+    (e.g. `hyperopt.tpe.suggest`) until the journal contains `max_evals`
+    trials.
+
+    Parameters
+    ----------
+    objective : callable
+        The function evaluated by the trials, returning a dictionary with the
+        fields `loss` and `status` as requested by hyperopt; it must be
+        picklable (i.e. defined at module level) if `workers` > 1
+    space : hyperopt search space
+    algo : callable
+        A hyperopt suggestion algorithm
+    max_evals : int
+        The total number of trials, including the ones already in the journal
+    journal_fn : str
+        The path of the journal; if it exists, the search is resumed from the
+        trials in it
+    parameters_path : str
+        The path of the JSON file where the best parameters are written
+    workers : int
+        The number of trials evaluated at the same time; if 1, they are
+        evaluated in this process
+    initializer : callable or None
+        Called by each worker process when it starts
+    budget : `budget.Budget` or None
+        If not None, no trial is started when the remaining budget is
+        shorter than the median duration of the trials completed so far, and
+        the duration of each trial is recorded in it. The trials themselves
+        should stop at the end of the budget.
+
+    Returns
+    -------
+    dict
+        The best parameters found, or None if no trial succeeded
+    """
+    domain = Domain(objective, space)
+    records = read_journal(journal_fn)
+    print("Found " + str(len(records)) + " trials in " + journal_fn)
+    trials = trials_from_journal(records, domain)
+    # loss and parameters of the best trial
+    best = list(best_parameters(trials))
+    rstate = np.random.RandomState()
+
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer)
+    # tid -> (trial document, async result, start time)
+    running = {}
+    # durations of the trials completed by this call
+    durations = []
+
+    def out_of_budget():
+        if budget is None:
+            return False
+        expected = np.median(durations) if durations else 0
+        return budget.exhausted() or budget.remaining() < expected
+
+    def complete(doc, result, start):
+        # store the result of a trial in the journal and in `trials`
+        durations.append(time.time() - start)
+        if budget is not None:
+            budget.record('trial ' + str(doc['tid']), durations[-1])
+        doc['result'] = result
+        doc['state'] = JOB_STATE_DONE
+        append_journal(journal, {'vals': doc['misc']['vals'],
+                                 'result': result, 'time': time.time()})
+        if result['status'] == STATUS_OK and \
+                (best[0] is None or result['loss'] < best[0]):
+            best[:] = best_parameters(trials)
+            print("BEST PARAMETERS FOUND: " + str(best[1]))
+            with atomic_open(parameters_path, 'w') as f:
+                json.dump(best[1], f, default=_builtin)
+
+    drop_incomplete_line(journal_fn)
+    with open(journal_fn, 'a') as journal:
+        over = False
+        try:
+            while True:
+                # submit new trials until all workers are busy
+                exhausted = over
+                while not over and len(running) < workers and \
+                        len(trials) < max_evals:
+                    if out_of_budget():
+                        print("Budget over, not starting new trials")
+                        exhausted = over = True
+                        break
+                    new_ids = trials.new_trial_ids(1)
+                    trials.refresh()
+                    docs = algo(new_ids, domain, trials,
+                                rstate.randint(2 ** 31 - 1))
+                    if len(docs) == 0:
+                        exhausted = True
+                        break
+                    docs[0]['state'] = JOB_STATE_RUNNING
+                    trials.insert_trial_docs(docs)
+                    trials.refresh()
+                    # the document stored in `trials` is a copy
+                    doc = trials.trials[-1]
+                    params = space_eval(space, spec_from_misc(doc['misc']))
+                    start = time.time()
+                    if pool is None:
+                        complete(doc, objective(params), start)
+                    else:
+                        running[doc['tid']] = (
+                            doc, pool.apply_async(objective, (params,)), start)
+
+                if len(running) == 0:
+                    if exhausted or len(trials) >= max_evals:
+                        break
+                    continue
+
+                # collect the trials which ended
+                done = [tid for tid, (_doc, res, _start) in running.items()
+                        if res.ready()]
+                if len(done) == 0:
+                    time.sleep(POLL_INTERVAL)
+                    continue
+                for tid in done:
+                    doc, res, start = running.pop(tid)
+                    try:
+                        result = res.get()
+                    except Exception as e:
+                        print("Trial " + str(tid) + " failed: " + str(e))
+                        result = {'loss': 2, 'status': STATUS_FAIL}
+                    complete(doc, result, start)
+        finally:
+            if pool is not None:
+                # running trials are lost, but the journal is consistent
+                pool.terminate()
+                pool.join()
+
+    return best[1]
@@ -2,8 +2,16 @@
 """
 Classes defining methods to iterate batches for training neural networks
 """
+import threading
+import time
+
 import numpy as np
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
 
 class RecurrentBatchProvider(object):
     """A class to load data from files and serve it in batches
@@ -249,6 +257,103 @@ class RecurrentBatchProvider(object):
                                segment_length, batch_arrays)
 
 
+class BatchPrefetcher(object):
+    """Iterate over batches which are prepared in a background thread while
+       the previous ones are used for training.
+
+    Parameters
+    ----------
+
+    jobs : iterable
+        One item for each batch, passed to `make_batch`
+
+    make_batch : callable
+        `make_batch(job, buffers)` returns the batch for `job`; `buffers` is
+        an object returned by `make_buffers` (or None) which can be filled
+        in place and returned, so that arrays are not allocated at each batch
+
+    depth : int
+        The number of batches prepared in advance; if 0, batches are
+        prepared synchronously when they are requested
+
+    make_buffers : callable, optional
+        Returns a new set of buffers; `depth + 1` sets are created, so that a
+        batch is never overwritten while it is being used
+
+    Attributes
+    ----------
+
+    wait_time : float
+        The seconds spent waiting for batches (i.e. for data preparation if
+        `depth` is 0)
+    """
+
+    _END = object()
+
+    def __init__(self, jobs, make_batch, depth=2, make_buffers=None):
+        self.jobs = jobs
+        self.make_batch = make_batch
+        self.depth = depth
+        self.make_buffers = make_buffers
+        self.wait_time = 0.0
+
+    def _new_buffers(self):
+        if self.make_buffers is None:
+            return None
+        return self.make_buffers()
+
+    def __iter__(self):
+        if self.depth < 1:
+            buffers = self._new_buffers()
+            for job in self.jobs:
+                start = time.time()
+                batch = self.make_batch(job, buffers)
+                self.wait_time += time.time() - start
+                yield batch
+            return
+
+        free = queue.Queue()
+        ready = queue.Queue()
+        for i in range(self.depth + 1):
+            free.put(self._new_buffers())
+        stop = threading.Event()
+
+        def worker():
+            try:
+                for job in self.jobs:
+                    buffers = free.get()
+                    if stop.is_set():
+                        return
+                    ready.put((buffers, self.make_batch(job, buffers)))
+                ready.put(self._END)
+            except Exception as e:
+                ready.put(e)
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+        in_use = None
+        try:
+            while True:
+                start = time.time()
+                item = ready.get()
+                self.wait_time += time.time() - start
+                if item is self._END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                # the previous batch has been used, its buffers are free
+                if in_use is not None:
+                    free.put(in_use[0])
+                in_use = item
+                yield item[1]
+        finally:
+            # unblock the worker if the iteration was interrupted
+            stop.set()
+            free.put(None)
+
+
 if __name__ == '__main__':
     n_inputs = 2
     n_outputs = 2
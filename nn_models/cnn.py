@@ -10,6 +10,10 @@ import theano
 import theano.tensor as T
 
 from melody_extractor import settings, misc_tools
+from nn_models.batch_provider import BatchPrefetcher
+from nn_models.data_parallel import DataParallel, can_fork
+from nn_models.telemetry import Telemetry
+from extra.utils.os_utils import load_piece_blob, save_piece_blob_atomic
 
 
 # from utils import (delete_if_exists,
@@ -81,14 +85,20 @@ class GuidedBackprop(ModifiedBackprop):
         return (grd * (inp > 0).astype(dtype) * (grd > 0).astype(dtype),)
 
 
-def iterate_minibatches(arr, batchsize):
+def iterate_minibatches(arr, batchsize, X=None):
     """
     iterator on arr. At each iteration returns an excerpt of arr of size
     *batchsize*
+
+    If *X* has a `prefetch` method (see `melody_extractor.misc_tools.Dataset`),
+    the windows of the next batch are requested in advance.
     """
+    prefetch = getattr(getattr(X, 'dataset', None), 'prefetch', None)
     start_idx = 0
     for start_idx in range(0, len(arr) - batchsize + 1, batchsize):
         excerpt = slice(start_idx, start_idx + batchsize)
+        if prefetch is not None:
+            prefetch(arr[start_idx + batchsize: start_idx + 2 * batchsize])
         yield arr[excerpt]
 
     # put remaining data in a last mini-batch
@@ -98,6 +108,70 @@ def iterate_minibatches(arr, batchsize):
         yield arr[excerpt]
 
 
+def contiguous_slice(indices):
+    """
+    Return the slice selecting the same elements as the array *indices* if
+    they are consecutive and increasing, so that an array can be indexed
+    without copying; None otherwise.
+    """
+    if len(indices) == 0:
+        return None
+    start = int(indices[0])
+    if indices[-1] - start != len(indices) - 1 or \
+            np.any(np.diff(indices) != 1):
+        return None
+    return slice(start, start + len(indices))
+
+
+def probe_subset(index_map, batchsize, max_batches):
+    """
+    Return the windows of at most *max_batches* minibatches of *index_map*
+    of size *batchsize*, taken at evenly spaced positions so that they span
+    the whole map. If *index_map* does not contain more minibatches, it is
+    returned as it is.
+    """
+    n_batches = len(index_map) // batchsize
+    if n_batches <= max_batches:
+        return index_map
+    chosen = np.linspace(0, n_batches - 1, max_batches).round().astype(int)
+    return np.concatenate([index_map[b * batchsize:(b + 1) * batchsize]
+                           for b in chosen])
+
+
+def plan_shared_chunks(batches, max_windows):
+    """
+    Group consecutive *batches* in chunks of at most *max_windows* windows
+    (a batch is never split), so that each chunk can be loaded in the shared
+    buffers of a `CNN` at once.
+
+    *batches* is a list of tuples (kind, indices), where *kind* is any label
+    (e.g. 'train' or 'val') and *indices* are the indices of the windows.
+
+    RETURNS :
+        a list of tuples (indices, steps), one for each chunk, where
+        *indices* are the indices of all the windows in the chunk and *steps*
+        is a list of (kind, start, end) for each batch, with *start* and *end*
+        referred to the chunk
+    """
+    chunks = []
+    indices = []
+    steps = []
+    size = 0
+    for kind, batch in batches:
+        if size > 0 and size + len(batch) > max_windows:
+            chunks.append((np.concatenate(indices), steps))
+            indices = []
+            steps = []
+            size = 0
+        indices.append(batch)
+        steps.append((kind, size, size + len(batch)))
+        size += len(batch)
+
+    if len(steps) > 0:
+        chunks.append((np.concatenate(indices), steps))
+    return chunks
+
+
 class CNN(object):
     """
     Base class for training convolutional neural networks, with same size in
@@ -199,10 +273,22 @@ class CNN(object):
             valid_loss_masked = T.sqrt(valid_loss_fn_name(
                 self.valid_output_masked, target).sum() / l_in.input_var.sum())
 
+            # gradients are explicit so that the same updates can be applied
+            # to gradients computed elsewhere (see
+            # `compile_data_parallel_functions`)
+            grads = T.grad(train_loss, params)
+            grads_masked = T.grad(train_loss_masked, params)
             updates = updates_fn_name(
-                train_loss, params, learning_rate=LEARNING_RATE)
+                grads, params, learning_rate=LEARNING_RATE)
             updates_masked = updates_fn_name(
-                train_loss_masked, params, learning_rate=LEARNING_RATE)
+                grads_masked, params, learning_rate=LEARNING_RATE)
+
+            # shared variables of the optimizer (e.g. adadelta accumulators),
+            # saved in checkpoints
+            param_ids = set(id(p) for p in params)
+            self.optimizer_state = [
+                v for v in list(updates.keys()) + list(updates_masked.keys())
+                if id(v) not in param_ids]
 
             # y_fun = theano.function([l_in.input_var], y)
             self.train_fn = theano.function(
@@ -218,41 +304,359 @@ class CNN(object):
             self.output = theano.function(
                 [l_in.input_var], self.predict_output)
 
+            if settings.SHARED_DATASET:
+                self.compile_shared_functions(
+                    l_in.input_var, target,
+                    [(train_loss, updates), (train_loss_masked, updates_masked),
+                     (valid_loss, None), (valid_loss_masked, None)])
+
+            if settings.DATA_PARALLEL_WORKERS > 1:
+                self.compile_data_parallel_functions(
+                    l_in.input_var, target, params,
+                    [(train_loss_fn_name(self.train_output, target).sum(),
+                      grads, updates),
+                     (train_loss_fn_name(self.train_output_masked,
+                                         target).sum(),
+                      grads_masked, updates_masked)])
+
             self.saliency = self.compile_saliency_function()
 
+            # used by `reset_training_state`
+            self.initial_training_state = [
+                v.get_value() for v in self.training_state_variables()]
+
+    def compile_data_parallel_functions(self, input_var, target, params,
+                                        losses):
+        """
+        Compile the functions used by `nn_models.data_parallel.DataParallel`
+        for the unmasked and the masked training losses, which have the form
+        `sqrt(S / N)`, where `N` is the sum of the input:
+            * `grad_fns[masked]` returns `S`, `N` and the gradients of `S`
+              with respect to `parallel_params` on a batch
+            * `apply_fns[masked]` takes the gradients of the loss and applies
+              the updates of `train_fn` (or `train_fn_masked`) with them, so
+              that the state of the optimizer is shared
+
+        Parameters
+        ----------
+        input_var : theano variable
+        The input of the network.
+        target : theano variable
+        The target used in the losses.
+        params : list
+        The parameters updated by the training functions.
+        losses : list
+        A list of tuples (S, grads, updates) for the unmasked and the masked
+        loss, where `grads` are the gradients of the loss used in `updates`.
+        """
+        self.parallel_params = params
+        self.grad_fns = []
+        self.apply_fns = []
+        for S, grads, updates in losses:
+            self.grad_fns.append(theano.function(
+                [input_var, target],
+                [S, input_var.sum()] + T.grad(S, params)))
+            grad_inputs = [g.type() for g in grads]
+            self.apply_fns.append(theano.function(
+                grad_inputs, [], updates=updates,
+                givens=list(zip(grads, grad_inputs))))
+
+    def compile_shared_functions(self, input_var, target, losses):
+        """
+        Compile versions of `train_fn`, `train_fn_masked`, `val_fn` and
+        `val_fn_masked` which take the windows from the shared buffers
+        `X_shared` and `Y_shared`. The compiled functions only take the
+        first and the last index of the batch in the buffers.
+
+        Parameters
+        ----------
+        input_var : theano variable
+        The input of the network.
+        target : theano variable
+        The target used in the losses.
+        losses : list
+        A list of tuples (loss, updates) in the order of the functions above;
+        `updates` is None for validation functions.
+        """
+        shape = (0, 1, 0, 0)
+        self.X_shared = theano.shared(np.zeros(shape, dtype=floatX))
+        self.Y_shared = theano.shared(np.zeros(shape, dtype=floatX))
+        self.switch_shared = theano.shared(np.int8(0))
+
+        start = T.lscalar('start')
+        end = T.lscalar('end')
+        inputs = T.cast(self.X_shared[start:end], input_var.dtype)
+        targets = T.cast(self.Y_shared[start:end], target.dtype)
+        givens = {input_var: inputs,
+                  target: T.switch(self.switch_shared, inputs - targets, targets)}
+
+        (self.train_fn_shared,
+         self.train_fn_masked_shared,
+         self.val_fn_shared,
+         self.val_fn_masked_shared) = [
+            theano.function([start, end], loss, updates=updates, givens=givens)
+            for loss, updates in losses]
+
     def fit(self, X, Y, tr_map, val_map=None,
             NUM_EPOCHS=100, BATCHSIZE=10,
             max_epochs_from_best=20,
             keep_training=False,
             nan_exception=False,
-            masked=False):
+            masked=False,
+            augment=None,
+            checkpoint=None,
+            resume=False,
+            epoch_callback=None,
+            deadline=None):
+        """
+        Train the network on the windows of `X` and `Y` whose indices are
+        in `tr_map`, using the windows in `val_map` for early-stopping.
 
+        Parameters
+        ----------
+        augment : callable or None
+        If not None, it is called on each training minibatch as
+        `augment(inputs, targets, rng)` and returns the new inputs and
+        targets, at most twice as many as the given ones (see
+        `melody_extractor.trainer.augment_batch`). `rng` is a
+        `numpy.random.RandomState` seeded with the epoch number, so that
+        the augmentation is reproducible.
+
+        If `settings.SHARED_DATASET` is True, the windows are copied in
+        theano shared buffers and the functions compiled by
+        `compile_shared_functions` are used, so that only indices are passed
+        at each step. Windows are loaded once if they take less than
+        `settings.SHARED_DATASET_BUDGET` bytes, otherwise they are loaded in
+        chunks of that size at each epoch. This mode is not used together
+        with `augment`, since augmentation changes windows on the host.
+
+        On the first epoch, the network is trained with and without
+        switching targets and the best mode is kept; the comparison can
+        also be performed on a subset of the windows, to measure how often
+        it leads to the same choice (see `settings.SWITCH_PROBE_BATCHES`).
+
+        If `settings.DATA_PARALLEL_WORKERS` > 1, each training minibatch
+        passed from the host is split among that number of processes (see
+        `nn_models.data_parallel.DataParallel`); shared buffers are not used
+        in this case.
+
+        If `settings.TELEMETRY_FILE` is not None, the timings of each epoch
+        are appended to it (see `nn_models.telemetry.Telemetry`).
+
+        checkpoint : str or None
+        If not None, the state of the training (see `save_checkpoint`) is
+        written to this path every `settings.CHECKPOINT_EVERY` epochs, when
+        training is interrupted by the user and when it ends.
+
+        resume : bool
+        If True and `checkpoint` exists, the training restarts from the
+        state stored in it; if that training had already ended, its best
+        parameters are loaded and returned.
+
+        epoch_callback : callable or None
+        If not None, it is called after each epoch as
+        `epoch_callback(epoch, train_loss, val_loss)`; if it returns True,
+        the training stops as with early-stopping (see
+        `melody_extractor.pruning.EpochReporter`).
+
+        deadline : float or None
+        If not None, the time (as returned by `time.time()`) by which the
+        training must end: no epoch is started if the previous one suggests
+        that it would not end in time. In that case, `stopped_at_deadline`
+        is set to True and the checkpoint is saved as not finished, so that
+        the training can be resumed later.
+
+        Returns
+        -------
+        list
+        The parameters of the best epoch, as returned by `get_params`.
+        """
+
+        self.stopped_at_deadline = False
         start_epoch = 0
         best_epoch = 0
         best_loss = np.inf
-        best_params = self.get_params()
+        # the best parameters are copied in these buffers, allocated once
+        best_params = self.snapshot_params()
         validate = val_map is not None
-        firstRun = True
 
-        def epoch_train():
-            # In each epoch, we do a full pass over the training data:
-            train_err = 0
-            train_samples = 0
+        if checkpoint is not None and resume and os.path.exists(checkpoint):
+            state = self.load_checkpoint(checkpoint)
+            best_epoch = state['best_epoch']
+            best_loss = state['best_loss']
+            best_params = state['best_params']
+            if state['finished']:
+                LOGGER.info("Training already finished, loading " + checkpoint)
+                self.set_params(best_params)
+                return self.get_params()
+            start_epoch = state['epoch'] + 1
+            LOGGER.info("Resuming training from epoch {}".format(start_epoch + 1))
+        # the state after the last completed epoch
+        last_epoch = start_epoch - 1
+
+        telemetry = Telemetry(settings.TELEMETRY_FILE,
+                              settings.TELEMETRY_STEP_SAMPLE)
+        # seconds spent waiting for data ('data') and in the theano functions
+        # ('train', 'val'), number of batches and of windows in the current
+        # epoch
+        timing = {}
+        workers = settings.DATA_PARALLEL_WORKERS
+        if workers > 1 and not can_fork():
+            LOGGER.info("Training in a worker process or on a GPU, not "
+                        "splitting minibatches among processes")
+            workers = 1
+        shared = settings.SHARED_DATASET and augment is None and workers == 1
+        if settings.SHARED_DATASET and augment is not None:
+            LOGGER.info("Data augmentation is on, not using shared buffers")
+        elif settings.SHARED_DATASET and not shared:
+            LOGGER.info("Training in parallel, not using shared buffers")
+        if shared:
+            batches = [('train', b) for b in iterate_minibatches(tr_map, BATCHSIZE)]
+            if validate:
+                batches += [('val', b)
+                            for b in iterate_minibatches(val_map, BATCHSIZE)]
+            window_size = int(np.prod(X.shape[1:]))
+            # X and Y windows
+            window_bytes = 2 * np.dtype(floatX).itemsize * window_size
+            chunks = plan_shared_chunks(
+                batches, max(1, settings.SHARED_DATASET_BUDGET // window_bytes))
+            LOGGER.info("Using {} chunk(s) of shared data".format(len(chunks)))
+            loaded = [None]
+
+        def run_step(kind, fn, args, windows, wait=0.0):
+            # call *fn* keeping track of the time spent
             start_time = time.time()
-
-            for batch in iterate_minibatches(tr_map, BATCHSIZE):
-                # batch are the indices of the windows
-                inputs = X[batch, :, :, :]
-                targets = Y[batch, :, :, :]
+            err = fn(*args)
+            fn_time = time.time() - start_time
+            timing[kind] += fn_time
+            timing[kind + '_batches'] += 1
+            timing[kind + '_windows'] += windows
+            if telemetry.sample_step():
+                telemetry.step(epoch=epoch + 1, switch=bool(self.switch),
+                               kind=kind, batch=timing[kind + '_batches'],
+                               windows=windows, fn_time=fn_time,
+                               data_wait=wait)
+            return err
+
+        def shared_pass(kind):
+            # a pass over the batches of *kind* using the shared buffers
+            err = 0
+            samples = 0
+            if masked:
+                fn = {'train': self.train_fn_masked_shared,
+                      'val': self.val_fn_masked_shared}[kind]
+            else:
+                fn = {'train': self.train_fn_shared,
+                      'val': self.val_fn_shared}[kind]
+            self.switch_shared.set_value(np.int8(self.switch))
+
+            for c, (indices, steps) in enumerate(chunks):
+                steps = [step for step in steps if step[0] == kind]
+                if len(steps) == 0:
+                    continue
+                wait = 0.0
+                if loaded[0] != c:
+                    start_time = time.time()
+                    window_slice = contiguous_slice(indices)
+                    if window_slice is not None:
+                        indices = window_slice
+                    self.X_shared.set_value(X[indices, :, :, :], borrow=True)
+                    self.Y_shared.set_value(Y[indices, :, :, :], borrow=True)
+                    loaded[0] = c
+                    wait = time.time() - start_time
+                    timing['data'] += wait
+                for _kind, start, end in steps:
+                    err += run_step(kind, fn, (start, end), end - start, wait)
+                    wait = 0.0
+                    if masked:
+                        samples += 1
+                    else:
+                        samples += (end - start) * window_size
+            return err, samples
+
+        def host_batches(index_map, rng=None):
+            # batches of (inputs, targets) prepared in background
+            def make_batch(batch, buffers):
+                # batch are the indices of the windows; consecutive windows
+                # (see `melody_extractor.trainer.contiguous_layout`) are
+                # taken without copies
+                window_slice = contiguous_slice(batch)
+                if window_slice is not None:
+                    inputs = X[window_slice]
+                    targets = Y[window_slice]
+                elif buffers is None:
+                    inputs = X[batch, :, :, :]
+                    targets = Y[batch, :, :, :]
+                else:
+                    inputs = np.take(X, batch, axis=0,
+                                     out=buffers[0][:len(batch)])
+                    targets = np.take(Y, batch, axis=0,
+                                      out=buffers[1][:len(batch)])
+                if rng is not None:
+                    inputs, targets = augment(inputs, targets, rng)
                 if self.switch:
                     targets = inputs - targets
-
+                return inputs, targets
+
+            make_buffers = None
+            if isinstance(X, np.ndarray) and isinstance(Y, np.ndarray):
+                def make_buffers():
+                    return (np.empty((BATCHSIZE,) + X.shape[1:], X.dtype),
+                            np.empty((BATCHSIZE,) + Y.shape[1:], Y.dtype))
+
+            # without background preparation, `X` can still prefetch windows
+            batches = iterate_minibatches(
+                index_map, BATCHSIZE,
+                X if settings.PREFETCH_DEPTH < 1 else None)
+            return BatchPrefetcher(batches, make_batch,
+                                   settings.PREFETCH_DEPTH, make_buffers)
+
+        def host_pass(kind, index_map, rng=None):
+            # a pass over the batches of *kind* passing windows from the host
+            err = 0
+            samples = 0
+            if masked:
+                fn = {'train': self.train_fn_masked,
+                      'val': self.val_fn_masked}[kind]
+            else:
+                fn = {'train': self.train_fn,
+                      'val': self.val_fn}[kind]
+            if kind == 'train' and parallel is not None:
+                fn = parallel.train_fn(masked)
+
+            batches = host_batches(index_map, rng)
+            waited = 0.0
+            for inputs, targets in batches:
+                wait = batches.wait_time - waited
+                waited = batches.wait_time
+                err += run_step(kind, fn, (inputs, targets), len(inputs), wait)
                 if masked:
-                    train_err += self.train_fn_masked(inputs, targets)
-                    train_samples += 1  # inputs[inputs == 1].size
+                    samples += 1  # inputs[inputs == 1].size
                 else:
-                    train_err += self.train_fn(inputs, targets)
-                    train_samples += inputs.size
+                    samples += inputs.size
+            timing['data'] += batches.wait_time
+            return err, samples
+
+        def epoch_train(tr=None, val=None):
+            # In each epoch, we do a full pass over the training data; *tr*
+            # and *val* are used instead of `tr_map` and `val_map` to train
+            # on a subset of the windows
+            subset = tr is not None
+            if not subset:
+                tr, val = tr_map, val_map
+            train_err = 0
+            train_samples = 0
+            start_time = time.time()
+            rng = np.random.RandomState(1992 + epoch)
+            timing.update(data=0.0, train=0.0, val=0.0,
+                          train_batches=0, val_batches=0,
+                          train_windows=0, val_windows=0)
+
+            if shared and not subset:
+                train_err, train_samples = shared_pass('train')
+            else:
+                train_err, train_samples = host_pass(
+                    'train', tr, rng if augment is not None else None)
 
             if np.isnan(train_err).any():
                 if nan_exception or epoch == 0:
@@ -264,21 +668,10 @@ class CNN(object):
                         "nan in training, breaking training")
 
             # And a full pass over the validation data:
-            if validate:
-                val_err = 0
-                val_samples = 0
-                for batch in iterate_minibatches(val_map, BATCHSIZE):
-                    inputs = X[batch, :, :, :]
-                    targets = Y[batch, :, :, :]
-                    if self.switch:
-                        targets = inputs - targets
-
-                    if masked:
-                        val_err += self.val_fn_masked(inputs, targets)
-                        val_samples += 1  # inputs[inputs == 1].size
-                    else:
-                        val_err += self.val_fn(inputs, targets)
-                        val_samples += inputs.size
+            if validate and shared and not subset:
+                val_err, val_samples = shared_pass('val')
+            elif validate:
+                val_err, val_samples = host_pass('val', val)
             else:
                 val_err = 0
                 val_samples = 1
@@ -288,47 +681,113 @@ class CNN(object):
             val_loss = val_err / val_samples
             LOGGER.info(
                 (
-                    "Epoch {} of {} took {:.3f}s"
+                    "Epoch {} of {} took {:.3f}s ({:.3f}s waiting for data, "
+                    "{:.3f}s training, {:.3f}s validating)"
                     "  training loss:\t{:.6f}"
                     "  validation loss:\t{:.6f}"
                 ).format(
-                    epoch + 1, NUM_EPOCHS, epoch_time,
-                    train_loss, val_loss)
+                    epoch + 1, NUM_EPOCHS, epoch_time, timing['data'],
+                    timing['train'], timing['val'], train_loss, val_loss)
             )
+            windows = timing['train_windows'] + timing['val_windows']
+            telemetry.epoch(
+                epoch=epoch + 1, switch=bool(self.switch), shared=shared,
+                subset=subset, workers=workers,
+                epoch_time=epoch_time, data_wait=timing['data'],
+                train_time=timing['train'], val_time=timing['val'],
+                train_batches=timing['train_batches'],
+                val_batches=timing['val_batches'],
+                windows=windows, windows_per_s=windows / epoch_time,
+                train_loss=float(train_loss), val_loss=float(val_loss))
 
             return train_loss, val_loss, epoch_time
 
+        def probe_switch(tr=None, val=None):
+            # an epoch without and one with switching, both starting from the
+            # parameters copied in `best_params`; the network is left in the
+            # best mode and the arrays of the other one are returned
+            LOGGER.info("Starting epoch without switching..")
+            self.switch = False
+            switch_false_train_loss, switch_false_val_loss, epoch_time = epoch_train(tr, val)
+            # restart from the initial parameters, keeping the
+            # arrays trained without switching
+            switch_false_params = self.swap_params(best_params)
+            LOGGER.info("Starting epoch with switching..")
+            self.switch = True
+            switch_true_train_loss, switch_true_val_loss, _epoch_time = epoch_train(tr, val)
+            epoch_time = (epoch_time + _epoch_time) / 2
+            if switch_true_val_loss < switch_false_val_loss:
+                LOGGER.info("Using switching...")
+                self.switch = True
+                # the discarded arrays become the new buffers
+                return (switch_true_train_loss, switch_true_val_loss,
+                        epoch_time, switch_false_params)
+            else:
+                LOGGER.info("Not using switching")
+                buffers = self.swap_params(switch_false_params)
+                self.switch = False
+                return (switch_false_train_loss, switch_false_val_loss,
+                        epoch_time, buffers)
+
+        # the windows used to choose whether to switch on the first epoch
+        probe_tr = probe_val = None
+        if settings.SWITCH_PROBE_BATCHES is not None:
+            probe_tr = probe_subset(tr_map, BATCHSIZE,
+                                    settings.SWITCH_PROBE_BATCHES)
+            if validate:
+                probe_val = probe_subset(val_map, BATCHSIZE,
+                                         settings.SWITCH_PROBE_BATCHES)
+            if len(probe_tr) == len(tr_map):
+                # the subset would be the whole data
+                probe_tr = probe_val = None
+
+        parallel = None
+        if workers > 1:
+            LOGGER.info("Splitting minibatches among {} processes"
+                        .format(workers))
+            # augmentation adds windows to the batches
+            capacity = BATCHSIZE if augment is None else 2 * BATCHSIZE
+            parallel = DataParallel(self, workers, capacity, X.shape[1:],
+                                    settings.DATA_PARALLEL_DETERMINISTIC)
+
         try:
             for epoch in xrange(start_epoch,
                                 NUM_EPOCHS):
 
-                if epoch == 0:
+                if epoch == 0 and probe_tr is not None:
+                    # let's try if it's better switching or not on a few
+                    # batches, then on the whole data, which decides
+                    LOGGER.info("Probing switching on {} batches"
+                                .format(len(probe_tr) // BATCHSIZE))
+                    initial_params = self.get_params()
+                    initial_optimizer = [
+                        v.get_value() for v in
+                        getattr(self, 'optimizer_state', [])]
+                    _train_loss, _val_loss, _epoch_time, best_params = \
+                        probe_switch(probe_tr, probe_val)
+                    probe_decision = self.switch
+                    self.set_params(initial_params)
+                    for v, value in zip(getattr(self, 'optimizer_state', []),
+                                        initial_optimizer):
+                        v.set_value(value)
+                    self.snapshot_params(best_params)
+                    train_loss, val_loss, epoch_time, best_params = \
+                        probe_switch()
+                    LOGGER.info(
+                        "Switching on the subset: {}, on the whole data: {}"
+                        .format(probe_decision, self.switch))
+                    telemetry.write('probe', {
+                        'probe_batches': len(probe_tr) // BATCHSIZE,
+                        'subset_switch': bool(probe_decision),
+                        'full_switch': bool(self.switch),
+                        'agree': bool(probe_decision) == bool(self.switch)})
+                elif epoch == 0:
                     # let's try if it's better switching or not
-                    LOGGER.info("Starting epoch without switching..")
-                    self.switch = False
-                    switch_false_train_loss, switch_false_val_loss, epoch_time = epoch_train()
-                    switch_false_params = self.get_params()
-                    self.set_params(best_params)
-                    LOGGER.info("Starting epoch with switching..")
-                    self.switch = True
-                    switch_true_train_loss, switch_true_val_loss, _epoch_time = epoch_train()
-                    epoch_time = (epoch_time + _epoch_time) / 2
-                    if switch_true_val_loss < switch_false_val_loss:
-                        LOGGER.info("Using switching...")
-                        train_loss = switch_true_train_loss
-                        val_loss = switch_true_val_loss
-                        self.switch = True
-                    else:
-                        LOGGER.info("Not using switching")
-                        train_loss = switch_false_train_loss
-                        val_loss = switch_false_val_loss
-                        self.set_params(switch_false_params)
-                        self.switch = False
+                    train_loss, val_loss, epoch_time, best_params = \
+                        probe_switch()
                 else:
                     train_loss, val_loss, epoch_time = epoch_train()
 
-                params = self.get_params()
-
                 # Early stopping
                 if validate:
                     es_loss = val_loss
@@ -337,9 +796,15 @@ class CNN(object):
                     es_loss = train_loss
 
                 if es_loss < best_loss:
-                    best_params = params
+                    self.snapshot_params(best_params)
                     best_loss = es_loss
                     best_epoch = epoch
+                last_epoch = epoch
+
+                if checkpoint is not None and \
+                        (epoch + 1) % settings.CHECKPOINT_EVERY == 0:
+                    self.save_checkpoint(checkpoint, epoch, best_epoch,
+                                         best_loss, best_params)
 
                 early_stop = (
                     epoch > (best_epoch + max_epochs_from_best))
@@ -349,19 +814,80 @@ class CNN(object):
                         'too much time needed for an epoch, breaking training')
                 elif early_stop:
                     break
+                elif epoch_callback is not None and \
+                        epoch_callback(epoch, train_loss, val_loss):
+                    break
+                elif deadline is not None and \
+                        time.time() + epoch_time > deadline:
+                    LOGGER.info("Stopping training, the next epoch would end "
+                                "after the deadline")
+                    self.stopped_at_deadline = True
+                    if checkpoint is not None:
+                        self.save_checkpoint(checkpoint, last_epoch,
+                                             best_epoch, best_loss,
+                                             best_params)
+                        checkpoint = None
+                    break
 
         except (RuntimeError, KeyboardInterrupt) as e:
             print('Training interrupted: ' + str(e))
+            if checkpoint is not None and isinstance(e, KeyboardInterrupt):
+                # the updates of the interrupted epoch are kept, but the
+                # resumed training restarts from the next epoch
+                if last_epoch >= 0:
+                    self.save_checkpoint(checkpoint, last_epoch, best_epoch,
+                                         best_loss, best_params)
+                checkpoint = None
+        finally:
+            if parallel is not None:
+                parallel.close()
 
         if best_loss < np.inf:
             print('Reloading best self (epoch = {0}, {2} loss = {1:.3f})'
                   .format(best_epoch + 1, best_loss,
                           'validation' if validate else 'training'))
 
-            self.set_params(best_params)
+            # the current parameters are not needed anymore
+            self.swap_params(best_params)
+
+        if checkpoint is not None:
+            self.save_checkpoint(checkpoint, last_epoch, best_epoch,
+                                 best_loss, best_params, finished=True)
 
         return self.get_params()
 
+    def save_checkpoint(self, fn, epoch, best_epoch, best_loss, best_params,
+                        finished=False):
+        """
+        Atomically write to `fn` the current parameters (including the
+        'switch' field), the state of the optimizer and the bookkeeping of
+        `fit` after `epoch`, so that `fit` can be resumed from there.
+        """
+        state = {
+            'params': self.get_params(),
+            'optimizer': [v.get_value() for v in
+                          getattr(self, 'optimizer_state', [])],
+            'epoch': epoch,
+            'best_epoch': best_epoch,
+            'best_loss': best_loss,
+            'best_params': best_params,
+            'finished': finished
+        }
+        save_piece_blob_atomic(state, fn)
+        LOGGER.info("Checkpoint written to " + fn)
+
+    def load_checkpoint(self, fn):
+        """
+        Restore the parameters and the optimizer state saved in `fn` by
+        `save_checkpoint` and return the whole saved state.
+        """
+        state = load_piece_blob(fn)
+        self.set_params(state['params'])
+        for v, value in zip(getattr(self, 'optimizer_state', []),
+                            state['optimizer']):
+            v.set_value(value)
+        return state
+
     def get_params(self):
         """
         Get the parameters of the network.
@@ -376,6 +902,82 @@ class CNN(object):
         params.append(self.switch)
         return params
 
+    def training_state_variables(self):
+        """
+        Return the shared variables changed by the training besides the
+        parameters: the state of the optimizer and of the random streams of
+        the layers (e.g. dropout).
+        """
+        variables = list(getattr(self, 'optimizer_state', []))
+        for layer in lasagne.layers.get_all_layers(self.l_out):
+            srng = getattr(layer, '_srng', None)
+            if srng is not None:
+                variables += [update[0] for update in srng.state_updates]
+        return variables
+
+    def reset_training_state(self):
+        """
+        Restore the state of the optimizer and of the random streams that
+        the network had when it was built. Together with `set_params` with
+        the initial parameters, this makes the network equivalent to a newly
+        built one, without compiling it again.
+        """
+        for v, value in zip(self.training_state_variables(),
+                            getattr(self, 'initial_training_state', [])):
+            v.set_value(value)
+
+    def snapshot_params(self, buffers=None):
+        """
+        Copy the parameters of the network in `buffers`, without
+        allocating new arrays.
+
+        Parameters
+        ----------
+        buffers : list or None
+        A list as returned by `get_params`, overwritten in place. If None, a
+        new list is allocated.
+
+        Returns
+        -------
+        list
+        `buffers`, with the same layout as the output of `get_params`.
+        """
+        values = [p.get_value(borrow=True)
+                  for p in lasagne.layers.get_all_params(self.l_out)]
+        if buffers is None:
+            buffers = [np.array(v) for v in values]
+            buffers.append(self.switch)
+        else:
+            for b, v in zip(buffers, values):
+                np.copyto(b, v)
+            buffers[-1] = self.switch
+        return buffers
+
+    def swap_params(self, params):
+        """
+        Set the parameters of the network to the arrays in `params` without
+        copying them, so they must not be modified afterwards.
+
+        Parameters
+        ----------
+        params : list
+        A list as returned by `get_params` or `snapshot_params`.
+
+        Returns
+        -------
+        list
+        The arrays used by the network before of the call, with the layout
+        of `get_params`; they can be reused as buffers for
+        `snapshot_params`.
+        """
+        variables = lasagne.layers.get_all_params(self.l_out)
+        old = [p.get_value(borrow=True) for p in variables]
+        old.append(self.switch)
+        for p, v in zip(variables, params[:-1]):
+            p.set_value(v, borrow=True)
+        self.switch = params[-1]
+        return old
+
     def set_params(self, params):
         """
         Set the parameters of the neural network
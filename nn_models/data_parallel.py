@@ -0,0 +1,283 @@
+"""
+Synchronous data-parallel training of a `nn_models.cnn.CNN` in several
+processes of the same machine.
+
+Each minibatch is split among the processes (this one included), which hold
+a copy of the compiled network obtained by forking. The losses of the CNN
+have the form `sqrt(S / N)`, where `S` and `N` are sums over the windows, so
+each process returns `S`, `N` and the gradients of `S` on its share, and
+their sums give exactly the gradients of the whole minibatch. The updates of
+the optimizer are then applied in this process, which shares the new
+parameters with the others through shared memory.
+
+Processes are forked, so this works only if theano computes on the CPU: a
+forked process cannot use the CUDA context of its parent (see `can_fork`).
+"""
+import multiprocessing
+import time
+import zlib
+
+import lasagne
+import numpy as np
+
+from melody_extractor import settings, misc_tools
+from extra.utils.os_utils import init_worker
+
+
+def _shared_array(shape, dtype):
+    # an array in shared memory, inherited by forked processes
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape)) * dtype.itemsize
+    return np.frombuffer(multiprocessing.RawArray('b', max(1, size)),
+                         dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def shard_bounds(n, workers):
+    """
+    Return the first and last (excluded) index of the windows of each of
+    *workers* processes in a minibatch of *n* windows
+    """
+    bounds = np.linspace(0, n, workers + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class DataParallel(object):
+    """Train `net` in `workers` processes, started at the creation.
+
+    Parameters
+    ----------
+
+    net : `nn_models.cnn.CNN`
+        The network, built with `settings.DATA_PARALLEL_WORKERS` > 1 so that
+        `nn_models.cnn.CNN.compile_data_parallel_functions` was called
+
+    workers : int
+        The number of processes computing gradients, this one included
+
+    batchsize : int
+        The maximum number of windows of a minibatch
+
+    window_shape : tuple
+        The shape of a window, e.g. `X.shape[1:]`
+
+    deterministic : bool
+        If True, each process writes its gradients in its own buffer and
+        they are summed in the order of the processes, so that the training
+        is reproducible. Otherwise, processes add their gradients to a single
+        buffer as soon as they end, in an order that changes the last bits of
+        the sums.
+
+    The random streams of the network (e.g. for dropout) go on in this
+    process; the other processes seed theirs from the state of those
+    streams and their rank (see `_worker_seeds`), so that they draw
+    different numbers, which are the same if the training is repeated.
+
+    `train_fn(masked)` returns the callable which replaces `net.train_fn`
+    (or `net.train_fn_masked`); `close` stops the processes.
+    """
+
+    def __init__(self, net, workers, batchsize, window_shape,
+                 deterministic=True):
+        if getattr(net, 'grad_fns', None) is None:
+            raise RuntimeError("The data-parallel functions were not compiled, "
+                               "set settings.DATA_PARALLEL_WORKERS > 1 before "
+                               "building the network")
+        if not can_fork():
+            raise RuntimeError("Cannot train in other processes from a "
+                               "worker process or with theano on a GPU")
+        self.net = net
+        self.workers = workers
+        self.deterministic = deterministic
+        self.params = net.parallel_params
+        self.shapes = [p.get_value(borrow=True).shape for p in self.params]
+        self.sizes = [int(np.prod(s)) for s in self.shapes]
+        n_values = sum(self.sizes)
+
+        floatX = settings.floatX
+        self.inputs = _shared_array((batchsize,) + tuple(window_shape), floatX)
+        self.targets = _shared_array((batchsize,) + tuple(window_shape), floatX)
+        self.param_values = _shared_array((n_values,), floatX)
+        # S, N and the gradients of S, for each process if deterministic
+        rows = workers if deterministic else 1
+        self.grads = _shared_array((rows, n_values + 2), np.float64)
+        self.lock = multiprocessing.Lock()
+        self.seeds = self._worker_seeds()
+
+        self.connections = []
+        self.processes = []
+        for rank in range(1, workers):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=self._worker_loop, args=(rank, child))
+            process.daemon = True
+            process.start()
+            # so that the end of the worker is noticed by `recv`
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+
+    def _streams(self):
+        # the random streams of the layers of the network
+        return [layer._srng
+                for layer in lasagne.layers.get_all_layers(self.net.l_out)
+                if getattr(layer, '_srng', None) is not None]
+
+    def _worker_seeds(self):
+        # a seed for each process but this one, drawn from the current state
+        # of the random streams of this process, which is reproducible and
+        # changes as they are used
+        streams = self._streams()
+        if len(streams) == 0:
+            return None
+        state = ''.join(update[0].get_value().tostring()
+                        for srng in streams for update in srng.state_updates)
+        rng = np.random.RandomState(zlib.crc32(state) & 0x7fffffff)
+        return rng.randint(1, 2 ** 30, size=self.workers)
+
+    def _unflatten(self, flat):
+        # the arrays of each parameter in the flat vector *flat*
+        arrays = []
+        start = 0
+        for shape, size in zip(self.shapes, self.sizes):
+            arrays.append(flat[start:start + size].reshape(shape))
+            start += size
+        return arrays
+
+    def _gradients(self, rank, n, masked):
+        # compute S, N and the gradients of S on the share of *rank* of the
+        # minibatch in the shared buffers and store them
+        start, end = shard_bounds(n, self.workers)[rank]
+        out = np.zeros(self.grads.shape[1])
+        if end > start:
+            results = self.net.grad_fns[masked](
+                self.inputs[start:end], self.targets[start:end])
+            out[0] = results[0]
+            out[1] = results[1]
+            out[2:] = np.concatenate([np.ravel(g) for g in results[2:]])
+        if self.deterministic:
+            self.grads[rank] = out
+        else:
+            with self.lock:
+                self.grads[0] += out
+
+    def _worker_loop(self, rank, connection):
+        init_worker()
+        if self.seeds is not None:
+            for srng in self._streams():
+                srng.seed(int(self.seeds[rank]))
+        while True:
+            message = connection.recv()
+            if message is None:
+                break
+            n, masked = message
+            # the parameters updated by the main process
+            for p, value in zip(self.params, self._unflatten(self.param_values)):
+                p.set_value(value)
+            self._gradients(rank, n, masked)
+            connection.send(True)
+
+    def step(self, inputs, targets, masked):
+        """
+        Perform a training step on the minibatch (*inputs*, *targets*) and
+        return its loss, as `train_fn` does.
+        """
+        n = len(inputs)
+        self.inputs[:n] = inputs
+        self.targets[:n] = targets
+        start = 0
+        for p, size in zip(self.params, self.sizes):
+            self.param_values[start:start + size] = \
+                p.get_value(borrow=True).ravel()
+            start += size
+        if not self.deterministic:
+            self.grads[:] = 0
+
+        for connection in self.connections:
+            connection.send((n, masked))
+        self._gradients(0, n, masked)
+        for connection in self.connections:
+            connection.recv()
+
+        # summed in the order of the processes if deterministic
+        total = self.grads.sum(axis=0) if self.deterministic else self.grads[0]
+        S, N = total[0], total[1]
+        loss = np.sqrt(S / N)
+        if loss > 0:
+            # d sqrt(S / N) = dS / (2 * sqrt(S / N) * N)
+            grads = total[2:] / (2 * loss * N)
+        else:
+            grads = np.zeros_like(total[2:])
+        grads = grads.astype(settings.floatX)
+        self.net.apply_fns[masked](*self._unflatten(grads))
+        return np.array(loss, dtype=settings.floatX)
+
+    def train_fn(self, masked):
+        """
+        Return a function with the signature of `net.train_fn` (or
+        `net.train_fn_masked` if *masked*) training in all the processes.
+        """
+        return lambda inputs, targets: self.step(inputs, targets, masked)
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+
+def can_fork():
+    """
+    Return False if this process cannot start other processes running theano
+    functions: if it is a worker of a `multiprocessing.Pool`
+    (hyper-optimization or crossvalidation), which cannot have children, or
+    if theano uses a GPU (see `melody_extractor.misc_tools.gpu_in_use`).
+    """
+    if multiprocessing.current_process().daemon:
+        return False
+    return not misc_tools.gpu_in_use()
+
+
+def scaling_report(net, X, Y, tr_map, batchsize, max_workers, masked=False,
+                   batches=20, deterministic=True):
+    """
+    Time *batches* training steps on the first minibatches of *tr_map* with
+    1, 2, ... *max_workers* processes and return, for each number of
+    processes, a dictionary with the `workers`, the `seconds` taken, the
+    `speedup` over one process and the `efficiency` (speedup / workers).
+    The parameters and the state of the optimizer of *net* are restored
+    afterwards, and a line for each number of processes is printed.
+    """
+    params = net.get_params()
+    state = [v.get_value() for v in net.training_state_variables()]
+    steps = [tr_map[i:i + batchsize]
+             for i in range(0, len(tr_map), batchsize)][:batches]
+    steps = [(X[b], Y[b]) for b in steps]
+    fn = net.train_fn_masked if masked else net.train_fn
+
+    report = []
+    for workers in range(1, max_workers + 1):
+        parallel = None
+        if workers > 1:
+            parallel = DataParallel(net, workers, batchsize, X.shape[1:],
+                                    deterministic)
+            fn = parallel.train_fn(masked)
+        try:
+            start = time.time()
+            for inputs, targets in steps:
+                fn(inputs, targets)
+            seconds = time.time() - start
+        finally:
+            if parallel is not None:
+                parallel.close()
+            net.set_params(params)
+            for v, value in zip(net.training_state_variables(), state):
+                v.set_value(value)
+        speedup = report[0]['seconds'] / seconds if report else 1.0
+        report.append({'workers': workers, 'seconds': seconds,
+                       'speedup': speedup, 'efficiency': speedup / workers})
+        print("{} process(es): {:.3f}s for {} steps, speedup {:.2f}, "
+              "efficiency {:.2f}".format(workers, seconds, len(steps),
+                                         speedup, speedup / workers))
+    return report
@@ -7,7 +7,7 @@ import os
 import cPickle
 import bz2
 
-from batch_provider import RecurrentBatchProvider
+from batch_provider import RecurrentBatchProvider, BatchPrefetcher
 from melody_extractor import settings
 
 
@@ -434,11 +434,6 @@ def _train_loss(model, batch_provider, batch_size, seq_length,
 
     train_results = []
 
-    if y_t is not None:
-        inputs = [X_t, y_t]
-    else:
-        inputs = [X_t]
-
     # Select training function
     if mode == 'valid':
         get_batch = batch_provider.get_batch_valid
@@ -466,11 +461,22 @@ def _train_loss(model, batch_provider, batch_size, seq_length,
         else:
             train_fun = model.train_fun
 
-    for i in range(batches_per_epoch):
-        # import pdb
-        # pdb.set_trace()
-        get_batch(*([batch_size, seq_length] + inputs))
-        train_results.append(train_fun(*inputs[0]))
+    def make_batch(i, buffers):
+        return get_batch(batch_size, seq_length, buffers)
+
+    # the first set of buffers is the one given in input
+    buffers = [X_t]
+
+    def make_buffers():
+        if buffers:
+            return buffers.pop()
+        return batch_provider.make_batch_arrays(batch_size, seq_length)
+
+    batches = BatchPrefetcher(range(batches_per_epoch), make_batch,
+                              settings.PREFETCH_DEPTH, make_buffers)
+    for batch_arrays in batches:
+        train_results.append(train_fun(*batch_arrays))
+    LOGGER.info('Waited {0:.3f}s for data'.format(batches.wait_time))
 
     train_loss = np.mean(train_results, axis=0)
     if any(np.isnan(train_loss)):
@@ -0,0 +1,109 @@
+"""
+Structured metrics of the training, written as JSON lines
+"""
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+def peak_rss():
+    """
+    Return the peak resident set size of this process in bytes, or None if
+    it cannot be measured on this platform.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    # kilobytes on Linux
+    return rss * 1024
+
+
+class Telemetry(object):
+    """Append training metrics to a file, one JSON object per line.
+
+    Parameters
+    ----------
+
+    fn : str or None
+        The path of the file; if None, nothing is written
+
+    step_sample : int
+        If larger than 0, one step (i.e. a call to a theano function) every
+        `step_sample` is recorded too
+
+    Each record has a `type` field ('epoch' or 'step'), the time at which it
+    was written (`time`) and the `pid` of the process, so that the records
+    of processes writing to the same file can be told apart.
+    """
+
+    def __init__(self, fn=None, step_sample=0):
+        self.fn = fn
+        self.step_sample = step_sample
+        self.steps = 0
+
+    @property
+    def enabled(self):
+        return self.fn is not None
+
+    def write(self, record_type, record):
+        if self.fn is None:
+            return
+        record = dict(record, type=record_type, time=time.time(),
+                      pid=os.getpid())
+        # a single write of a line is not interleaved with the ones of other
+        # processes appending to the same file
+        with open(self.fn, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def epoch(self, **record):
+        """
+        Record the metrics of an epoch, adding the peak RSS of the process.
+        """
+        record['peak_rss'] = peak_rss()
+        self.write('epoch', record)
+
+    def sample_step(self):
+        """
+        Return True if the next step should be recorded with `step`.
+        """
+        if self.fn is None or self.step_sample < 1:
+            return False
+        self.steps += 1
+        return (self.steps - 1) % self.step_sample == 0
+
+    def step(self, **record):
+        self.write('step', record)
+
+
+def read_records(fn, record_type=None):
+    """
+    Return the list of records written to `fn` by `Telemetry`, only those of
+    type `record_type` if it is not None.
+    """
+    records = []
+    with open(fn) as f:
+        for line in f:
+            record = json.loads(line)
+            if record_type is None or record['type'] == record_type:
+                records.append(record)
+    return records
+
+
+def probe_agreement(fn):
+    """
+    Return the number of first epochs recorded in `fn` where switching was
+    chosen in the same way on a subset of the windows and on the whole data
+    (see `settings.SWITCH_PROBE_BATCHES`), and the number of all recorded
+    first epochs.
+    """
+    probes = read_records(fn, 'probe')
+    return sum(r['agree'] for r in probes), len(probes)
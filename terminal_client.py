@@ -111,6 +111,11 @@ The file types are inferred from the extensions, as in `--extract`.\n')
     Note that the training already uses early stop algorithm. This option is\n\
     particularly useful for RCNNs.\n")
 
+    parser.add_argument('--compress-rests', action='store_true',
+                        help="With `--extract` only, collapse long rests to the window\n\
+    width before running the network, which is faster for scores with many\n\
+    silent sections. Inspections always use the whole pianoroll.\n")
+
     parser.add_argument('--mono', action='store_true',
                         help="Find a strictly monophonic solo part.\n")
 
@@ -129,13 +134,44 @@ The file types are inferred from the extensions, as in `--extract`.\n')
     files in this directory. Use parameters contained in FILE as\n\
     exported with `--hyper-opt`. At each fold, it save a pickled object\n\
     containing the kernels of the network; you can use these to rebuild\n\
-    the network on a different architecture (`--rebuild` option)\n")
+    the network on a different architecture (`--rebuild` option).\n\
+    The predictions of the test pieces are saved in the directory\n\
+    `predictions_crossvalidation` (see `--rescore`).\n")
+
+    parser.add_argument('--resume', action='store_true',
+                        help="With `--train` or `--crossvalidation`, resume an\n\
+    interrupted training from the checkpoint files written in this\n\
+    directory (`checkpoint_trained.pyc.bz`, `checkpoint_fold_k.pyc.bz`)\n\
+    and skip the folds already completed.\n")
+
+    parser.add_argument('--budget', metavar='SECONDS', type=float,
+                        default=None,
+                        help="With `--train`, `--crossvalidation` or `--hyper-opt`, the\n\
+    wall-clock time available for the whole run. It is divided among folds\n\
+    and trials; the training stops before the deadline keeping the best\n\
+    parameters and a checkpoint that `--resume` can continue. A report of\n\
+    the time spent is written to `budget.json`.\n")
+
+    parser.add_argument('--cpu-hours', metavar='HOURS', type=float,
+                        default=None,
+                        help="Like `--budget`, but in CPU hours, counting all the\n\
+    processes used.\n")
 
     parser.add_argument('--validate', metavar=('DIR', '.EXT', 'MODEL'),
                         type=str, nargs=3, default=[],
                         help='Validate the MODEL on files in DIR and sub-dir\n\
 of type .EXT. Writes the results in a file in the current directory\n\
-called `results.txt`. This only works with CNN.\n')
+called `results.txt`. This only works with CNN.\n\
+The predictions are saved in the directory `predictions_validation`\n\
+(see `--rescore`).\n')
+
+    parser.add_argument('--rescore', metavar=('STORE', 'DIR', '.EXT'),
+                        type=str, nargs=3, default=[],
+                        help='Test again the predictions saved by `--crossvalidation`\n\
+or `--validate` in the directory STORE for files in DIR and sub-dir of\n\
+type .EXT (the same used for predicting) with the current settings of\n\
+the graph stage (e.g. `--mono`), without running the network. Writes\n\
+the results in a file called `rescore.txt`.\n')
 
     parser.add_argument('--rebuild', metavar=('KERNELS', 'PARAMETERS', 'OUTPUT'),
                         default=[], nargs=3,
@@ -151,9 +187,10 @@ called `results.txt`. This only works with CNN.\n')
                         help="Perform hyper-parameter optimization on files in DIR\n\
     (and subdirectories) having extension .EXT. This write the best parameters\n\
     FILE at each new evaluation. If for any reason the hyper-optimization\n\
-    should stop, then you should take care that `trials.hyperopt` is still\n\
+    should stop, then you should take care that `trials.jsonl` is still\n\
     in the working directory, so that the already performed evaluations will\n\
-    not be lost.\n\
+    not be lost. Set `HYPEROPT_WORKERS` in the settings to run several\n\
+    evaluations at the same time.\n\
     \n\
     N.B. Be careful about the output parameters because something seems to be\n\
     written wrong (maybe an hyper-opt bug?)\n")
@@ -239,6 +276,38 @@ def prediction(pr_windows, args, network, func=None):
     return misc_tools.recreate_pianorolls(prediction, settings.OVERLAP)
 
 
+def rest_compressed_prediction(notelist, length, args, network):
+    """
+    Compute the output pianoroll of *network* after having collapsed long
+    rests of the pianoroll of *length* columns containing *notelist*.
+    The output is expanded back to the layout that `prediction` gives for
+    the original pianoroll, so that it can be used with the original
+    notelist.
+    """
+    WIN_WIDTH = network.win_width
+    compressed, column_map = pianoroll_utils.compress_rests(
+        notelist, length, settings.REST_GUARD_WIDTH)
+    print("Compressed " + str(length) + " columns to " + str(len(column_map)))
+
+    pianoroll = pianoroll_utils.rasterize_indices(
+        compressed, (settings.WIN_HEIGHT, len(column_map)))
+    pr_windows = misc_tools.split_windows(
+        pianoroll, WIN_WIDTH, settings.OVERLAP)
+    out_pianoroll = prediction(pr_windows, args, network)
+
+    # padding added by `split_windows` before the first column
+    offset = -misc_tools.window_starts(
+        len(column_map), WIN_WIDTH, settings.OVERLAP)[0]
+    out_pianoroll = pianoroll_utils.expand_columns(
+        out_pianoroll, column_map, length, offset)
+
+    # same padding that the original pianoroll would have had
+    starts = misc_tools.window_starts(length, WIN_WIDTH, settings.OVERLAP)
+    pad_before = -starts[0]
+    pad_after = starts[-1] + WIN_WIDTH - length
+    return np.pad(out_pianoroll, [(0, 0), (pad_before, pad_after)], 'constant')
+
+
 def insert_userdir(path):
     """
     this is a utility which returns a new path
@@ -271,7 +340,7 @@ def insert_userdir(path):
     return path
 
 
-def prepare_prediction(args, option):
+def prepare_prediction(args, option, split=True):
     """
     Prepare stuffs used for prediction.
 
@@ -279,6 +348,9 @@ def prepare_prediction(args, option):
         * `args`: args arrriving from main (command line argument parser)
         * `option`: the name of the option calling this function (`extract`,
         `inspect` or `inspect_masking`)
+        * `split`: if False, the pianorolls are not split in windows and
+        `pr_windows` and `mel_windows` are None (e.g. when the windows are
+        computed by `rest_compressed_prediction`)
 
     RETURNS:
         * `pr_windows`: list of pianoroll windows
@@ -313,22 +385,28 @@ def prepare_prediction(args, option):
 
     WIN_WIDTH = network.win_width
 
-    print("Splitting the input in windows")
-    pr_windows = misc_tools.split_windows(
-        pianoroll, WIN_WIDTH, settings.OVERLAP)
-    mel_windows = misc_tools.split_windows(
-        melody, WIN_WIDTH, settings.OVERLAP)
+    pr_windows = mel_windows = None
+    if split:
+        print("Splitting the input in windows")
+        pr_windows = misc_tools.split_windows(
+            pianoroll, WIN_WIDTH, settings.OVERLAP)
+        mel_windows = misc_tools.split_windows(
+            melody, WIN_WIDTH, settings.OVERLAP)
 
     return (pr_windows, mel_windows), network, notelist, note_array, pianoroll, melody
 
 
 def extract_solo_part(args):
-    windows, network, notelist, note_array, _pianoroll, _melody = prepare_prediction(
-        args, 'extract')
+    windows, network, notelist, note_array, pianoroll, _melody = prepare_prediction(
+        args, 'extract', split=not settings.COMPRESS_RESTS)
     pr_windows = windows[0]
 
     print("Computing probabilities...")
-    out_pianoroll = prediction(pr_windows, args, network)
+    if settings.COMPRESS_RESTS:
+        out_pianoroll = rest_compressed_prediction(
+            notelist, pianoroll.shape[1], args, network)
+    else:
+        out_pianoroll = prediction(pr_windows, args, network)
 
     _true_labels, predicted_labels = graph_tools.predict_labels(
         out_pianoroll, notelist)
@@ -418,21 +496,30 @@ def inspect(args):
 
 
 def train(args):
-    from melody_extractor import trainer
+    from melody_extractor import trainer, budget
     settings.DATA_PATH = insert_userdir(args['train'][0])
     settings.FILE_EXTENSIONS = args['train'][1]
     parameters = json.load(open(insert_userdir(args['train'][2])))
 
+    run_budget = budget.from_settings()
+    start = budget.clock()
     setup = trainer.setup_train_and_test(parameters)
     _hyperparameters_set, remaining, _groups, X, Y, NN_model, validation, _notelists = setup
-    trainer.train(remaining, validation, X, Y, NN_model)
+    trainer.train(remaining, validation, X, Y, NN_model,
+                  checkpoint='checkpoint_trained.pyc.bz', resume=args['resume'],
+                  deadline=run_budget.end())
     kernels = NN_model.get_params()
     pickle.dump(kernels, open('nn_kernels_trained.pkl', 'wb'))
     print("Kernels written to file!")
+    if run_budget.limited:
+        wall, cpu = budget.usage(start)
+        run_budget.record('train', wall, cpu,
+                          stopped=getattr(NN_model, 'stopped_at_deadline', False))
+        run_budget.write_report()
 
 
 def validate(args):
-    from melody_extractor import misc_tools, trainer, graph_tools
+    from melody_extractor import misc_tools, trainer, graph_tools, prediction_store
     settings.DATA_PATH = insert_userdir(args['validate'][0])
     settings.FILE_EXTENSIONS = args['validate'][1]
     with open(args['validate'][2], 'rb') as f:
@@ -446,6 +533,8 @@ def validate(args):
     pieces_indices = np.unique(groups)
 
     prediction_list = trainer.predict(data, groups, X, model)
+    prediction_store.save_fold('predictions_validation', 0, pieces_indices,
+                               prediction_list)
 
     graph_tools.test_shortest_path(notelists,
                                    prediction_list,
@@ -457,11 +546,29 @@ def validate(args):
 
 def crossvalidate(args):
     import melody_extractor.crossvalidation as cv
+    from melody_extractor import budget
     settings.DATA_PATH = insert_userdir(args['crossvalidation'][0])
     settings.FILE_EXTENSIONS = args['crossvalidation'][1]
     parameters = json.load(open(insert_userdir(args['crossvalidation'][2])))
 
-    cv.crossvalidation(parameters)
+    run_budget = budget.from_settings()
+    try:
+        cv.crossvalidation(parameters, resume=args['resume'], budget=run_budget,
+                           store='predictions_crossvalidation')
+    finally:
+        if run_budget.limited:
+            run_budget.write_report()
+
+
+def rescore(args):
+    from melody_extractor import prediction_store
+    settings.DATA_PATH = insert_userdir(args['rescore'][1])
+    settings.FILE_EXTENSIONS = args['rescore'][2]
+    notelists = misc_tools.load_notelists(settings.DATA_PATH)
+    with open("rescore.txt", "w") as f:
+        fmeasure = prediction_store.rescore(
+            insert_userdir(args['rescore'][0]), notelists, f)
+    print("Average fmeasure: " + str(fmeasure))
 
 
 def rebuild(args):
@@ -503,6 +610,9 @@ def main():
     if args['mono']:
         settings.MONOPHONIC = True
 
+    if args['compress_rests']:
+        settings.COMPRESS_RESTS = True
+
     if args['rnn']:
         settings.MODEL_TYPE = 'rnn'
         settings.OVERLAP = False
@@ -514,6 +624,12 @@ def main():
 
     settings.MAX_TIME = args['time_limit']
 
+    if args['budget'] is not None:
+        settings.BUDGET_SECONDS = args['budget']
+
+    if args['cpu_hours'] is not None:
+        settings.BUDGET_CPU_HOURS = args['cpu_hours']
+
     if len(args['extract']) == 2:
         extract_solo_part(args)
         return
@@ -542,6 +658,10 @@ def main():
         validate(args)
         return
 
+    if len(args['rescore']) == 3:
+        rescore(args)
+        return
+
     if len(args['inspect_masking']) == 2:
         inspect_masking(args)
         return
@@ -12,10 +12,13 @@ floatX = settings.floatX
 
 
 def make_pianorolls(piece, beat_div=8,
-                    output_idxs=False):
+                    output_idxs=False, output='dense'):
     """
     Generate score and melody piano rolls.
 
+    Both piano rolls are rasterized from the same note indices, which are
+    computed only once (see `get_piece_indices`).
+
     Parameters
     ----------
     piece : dict
@@ -25,6 +28,9 @@ def make_pianorolls(piece, beat_div=8,
         Default is 8.
     output_idxs: bool
         If `True`, returns indices of the notes in the piano roll.
+    output : str
+        Type of the returned piano rolls, see `rasterize_indices`.
+        Default is 'dense'.
 
     Returns
     -------
@@ -50,43 +56,63 @@ def make_pianorolls(piece, beat_div=8,
             - ending time index
             - is soprano or not (0 or 1)
     """
+    idx_score, idx_melody, length = get_piece_indices(piece, beat_div)
+
+    # Compute piano rolls
+    shape = (128, length)
+    pr_score = rasterize_indices(idx_score, shape, output)
+    pr_melody = rasterize_indices(idx_melody, shape, output)
+
+    assert pr_melody.shape == pr_score.shape
+
+    if output_idxs:
+        return pr_score, pr_melody, idx_score, idx_melody
+    else:
+        return pr_score, pr_melody
+
+
+def get_piece_indices(piece, beat_div=8):
+    """
+    Compute the piano roll indices of score and melody of *piece* without
+    building the piano rolls.
+
+    Parameters
+    ----------
+    piece : dict
+        Structured array as returned by data_handling.parse_data.load_piece(...)
+    beat_div : int
+        Resolution for the beat (number of pixels for a beat).
+
+    Returns
+    -------
+    idx_score : ndarray
+        Indices of the notes of the score, the same as returned by
+        `make_pianorolls` with `output_idxs=True`
+    idx_melody : ndarray
+        Indices of the notes of the melody, the same as returned by
+        `make_pianorolls` with `output_idxs=True`
+    length : int
+        The number of columns of the piano rolls built by `make_pianorolls`
+    """
     # Creating indices of notes not graces
     not_grace_idx = np.argwhere(piece['duration']).reshape(-1)
 
-    # Get info from the score
     pitch = piece['pitch'][not_grace_idx]
     onset = piece['onset'][not_grace_idx]
     offset = onset + piece['duration'][not_grace_idx]
     soprano = piece['soprano'][not_grace_idx]
 
-    # indices of the melody
-    melody_idx = np.where(soprano == 1)[0]
-
-    # note_to_pianoroll requires onset, offset and pitch
-    score_info = np.column_stack([onset, offset, pitch])
-    melody_info = np.column_stack([onset[melody_idx],
-                                   offset[melody_idx],
-                                   pitch[melody_idx]])
-    # Compute piano rolls
-    pr_score, idx_score = _notes_to_pianoroll(
-        notes=score_info, onset_only=False,
-        neighbour_pitches=-1, neighbour_beats=0,
-        beat_div=beat_div,
-        soprano=soprano)
-
-    pr_melody, idx_melody = _notes_to_pianoroll(
-        notes=melody_info, onset_only=False,
-        min_time=np.min(onset),
-        max_time=np.max(offset),
-        neighbour_pitches=-1, neighbour_beats=0,
-        beat_div=beat_div)
+    min_time = np.min(onset)
+    max_time = np.max(offset)
 
-    assert pr_melody.shape == pr_score.shape
+    idx_score = get_pianoroll_indices(pitch, onset - min_time,
+                                      offset - min_time, soprano, beat_div)
+    # melody indices have no soprano information, as in `make_pianorolls`
+    idx_melody = idx_score[soprano == 1]
+    idx_melody[:, 3] = 0
 
-    if output_idxs:
-        return pr_score, pr_melody, idx_score, idx_melody
-    else:
-        return pr_score, pr_melody
+    length = int(np.ceil(beat_div * (max_time - min_time)))
+    return idx_score, idx_melody, length
 
 
 def get_onsetwise_pitch(pitch, onset, offset=None, melody=None):
@@ -159,7 +185,8 @@ def _notes_to_pianoroll(notes, onset_only,
                         beat_div,
                         min_time=None,
                         max_time=None,
-                        soprano=None):
+                        soprano=None,
+                        output='dense'):
 
     # columns:
     ONSET = 0
@@ -199,14 +226,360 @@ def _notes_to_pianoroll(notes, onset_only,
                                     notes[:, OFFSET],
                                     soprano,
                                     beat_div)
-    pianoroll = np.zeros((M, N), dtype=floatX)
-
-    for n in pr_idxs:
-        pianoroll[n[0], n[1]:n[2]] = 1
+    pianoroll = rasterize_indices(pr_idxs, (M, N), output)
 
     return pianoroll, pr_idxs
 
 
+def rasterize_indices(pr_idxs, shape, output='dense'):
+    """
+    Build a piano roll from the note indices *pr_idxs* (as returned by
+    `get_pianoroll_indices`) without looping over the notes.
+
+    Each note adds +1 at its first column and -1 after its last column in
+    a difference array; a cumulative sum over time then gives the number of
+    notes sounding in each pixel. Notes falling (partially) outside *shape*
+    are clipped.
+
+    Parameters
+    ----------
+    pr_idxs : array
+        Array with rows (pitch, start_time, end_time, ...)
+    shape : tuple
+        (number of pitches, number of columns) of the piano roll
+    output : str
+        'dense' for a `floatX` ndarray, 'bool' for a boolean ndarray,
+        'sparse' for a `scipy.sparse.csr_matrix` of type `floatX`, 'roll'
+        for a `SparseRoll`.
+        Default is 'dense'.
+
+    Returns
+    -------
+    pianoroll : ndarray, scipy.sparse.csr_matrix or SparseRoll
+        The piano roll with 1 where a note is sounding and 0 elsewhere.
+    """
+    if output == 'roll':
+        return SparseRoll.from_indices(pr_idxs, shape)
+
+    M, N = shape
+    pr_idxs = np.asarray(pr_idxs, dtype=int)
+    pitch = pr_idxs[:, 0]
+    start = np.clip(pr_idxs[:, 1], 0, N)
+    end = np.clip(pr_idxs[:, 2], 0, N)
+    playing = end > start
+    pitch, start, end = pitch[playing], start[playing], end[playing]
+
+    if output == 'sparse':
+        from scipy.sparse import csr_matrix
+        rows, cols = _expand_intervals(pitch, start, end)
+        pianoroll = csr_matrix((np.ones(len(rows), dtype=floatX),
+                                (rows, cols)), shape=(M, N))
+        # overlapping notes are summed by the constructor
+        pianoroll.data[:] = 1
+        return pianoroll
+
+    diff = np.zeros((M, N + 1), dtype=np.int32)
+    np.add.at(diff, (pitch, start), 1)
+    np.add.at(diff, (pitch, end), -1)
+    pianoroll = np.cumsum(diff[:, :N], axis=1) > 0
+
+    if output == 'bool':
+        return pianoroll
+    elif output == 'dense':
+        return pianoroll.astype(floatX)
+    else:
+        raise ValueError("Unknown output type: " + str(output))
+
+
+def _expand_intervals(rows, start, end):
+    """
+    Return the (row, column) coordinates of all the pixels covered by the
+    intervals [*start*, *end*) of *rows*, in the order of the intervals.
+    """
+    # one entry per pixel, built by offsetting an arange of the total
+    # length at the beginning of each interval
+    lengths = end - start
+    rows = np.repeat(rows, lengths)
+    cols = np.arange(lengths.sum()) + \
+        np.repeat(start - np.cumsum(lengths) + lengths, lengths)
+    return rows, cols
+
+
+class SparseRoll(object):
+    """
+    A piano roll stored as runs of sounding pixels, so that its memory
+    scales with the number of notes instead of with the duration.
+
+    The structure is the one of a CSR matrix over pitches, but each stored
+    element is a time interval instead of a single pixel: the intervals of
+    pitch `p` are `starts[indptr[p]:indptr[p + 1]]` (first column) and
+    `ends[indptr[p]:indptr[p + 1]]` (first column after the interval). They
+    are sorted and never overlap nor touch.
+
+    If `data` is None, all the pixels in the intervals are 1 (as in rolls
+    built from notes); otherwise `data` contains the value of each pixel, in
+    the order of the intervals (as in probability maps).
+
+    Rows can be read as dense 1D arrays with `roll[pitch, start:end]`, so that
+    `SparseRoll` can replace a 2D array in `graph_tools.compute_prob`;
+    `toarray` and `window` should be used to build dense network inputs.
+    """
+
+    def __init__(self, shape, indptr, starts, ends, data=None):
+        self.shape = tuple(shape)
+        self.indptr = indptr
+        self.starts = starts
+        self.ends = ends
+        self.data = data
+        self._offsets = None
+
+    @classmethod
+    def from_indices(cls, pr_idxs, shape):
+        """
+        Build a binary roll from the note indices *pr_idxs* (as returned by
+        `get_pianoroll_indices`). Overlapping notes are merged and notes are
+        clipped to *shape*.
+        """
+        M, N = shape
+        pr_idxs = np.asarray(pr_idxs, dtype=int)
+        pitch = pr_idxs[:, 0]
+        start = np.clip(pr_idxs[:, 1], 0, N)
+        end = np.clip(pr_idxs[:, 2], 0, N)
+        playing = end > start
+        pitch, start, end = pitch[playing], start[playing], end[playing]
+
+        order = np.lexsort((start, pitch))
+        pitch, start, end = pitch[order], start[order], end[order]
+
+        # merging: with pitch-major keys, an interval starts a new run if it
+        # begins after the furthest end seen so far
+        run_end = np.maximum.accumulate(pitch * (N + 1) + end)
+        new = np.ones(len(pitch), dtype=bool)
+        new[1:] = pitch[1:] * (N + 1) + start[1:] > run_end[:-1]
+        last = np.ones(len(pitch), dtype=bool)
+        last[:-1] = new[1:]
+
+        pitch = pitch[new]
+        starts = start[new]
+        ends = run_end[last] - pitch * (N + 1)
+        indptr = np.searchsorted(pitch, np.arange(M + 1))
+        return cls(shape, indptr, starts, ends)
+
+    @classmethod
+    def from_coords(cls, rows, cols, values, shape):
+        """
+        Build a roll with *values* at pixels (*rows*, *cols*); values of
+        duplicated pixels are summed.
+        """
+        M, N = shape
+        keys, inverse = np.unique(np.asarray(rows) * N + cols,
+                                  return_inverse=True)
+        data = np.bincount(inverse, weights=values, minlength=len(keys))
+        rows = keys // N
+        cols = keys % N
+
+        # a run breaks where pixels are not adjacent on the same row
+        new = np.ones(len(keys), dtype=bool)
+        new[1:] = (np.diff(keys) != 1) | (np.diff(rows) != 0)
+        first = np.flatnonzero(new)
+        lengths = np.diff(np.append(first, len(keys)))
+
+        starts = cols[first]
+        indptr = np.searchsorted(rows[first], np.arange(M + 1))
+        return cls(shape, indptr, starts, starts + lengths, data)
+
+    @classmethod
+    def from_dense(cls, arr):
+        """
+        Build a roll from the non-zero pixels of the 2D array *arr*.
+        """
+        rows, cols = np.nonzero(arr)
+        return cls.from_coords(rows, cols, arr[rows, cols], arr.shape)
+
+    @property
+    def nnz(self):
+        return int((self.ends - self.starts).sum())
+
+    def interval_rows(self):
+        """
+        The pitch of each interval.
+        """
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+
+    def coords(self):
+        """
+        Returns the rows, the columns and the values of the stored pixels.
+        """
+        rows, cols = _expand_intervals(self.interval_rows(), self.starts,
+                                       self.ends)
+        return rows, cols, self.values()
+
+    def values(self):
+        if self.data is None:
+            return np.ones(self.nnz, dtype=floatX)
+        return self.data
+
+    def toarray(self, dtype=floatX, out=None):
+        """
+        Returns the dense 2D array of this roll; if *out* is given, the roll
+        is written in it.
+        """
+        if out is None:
+            out = np.zeros(self.shape, dtype=dtype)
+        else:
+            out[:] = 0
+        rows, cols, values = self.coords()
+        out[rows, cols] = values
+        return out
+
+    def __array__(self, dtype=None):
+        return self.toarray(dtype=dtype or floatX)
+
+    def sum(self, axis=0):
+        """
+        Sum over pitches (the only supported *axis*), a dense 1D array.
+        """
+        if axis != 0:
+            raise ValueError("SparseRoll can only be summed over axis 0")
+        _rows, cols, values = self.coords()
+        return np.bincount(cols, weights=values, minlength=self.shape[1])
+
+    def window(self, start, end):
+        """
+        Returns a new roll with the columns from *start* to *end*; columns
+        out of the roll are zeros.
+        """
+        if self.data is None:
+            idxs = np.column_stack([self.interval_rows(),
+                                    self.starts - start,
+                                    self.ends - start])
+            return SparseRoll.from_indices(idxs, (self.shape[0], end - start))
+
+        rows, cols, values = self.coords()
+        inside = (cols >= start) & (cols < end)
+        return SparseRoll.from_coords(rows[inside], cols[inside] - start,
+                                      values[inside],
+                                      (self.shape[0], end - start))
+
+    def row(self, pitch, start, end):
+        """
+        Returns the dense 1D array of *pitch* from column *start* to *end*.
+        """
+        start = max(start, 0)
+        end = min(end, self.shape[1])
+        out = np.zeros(max(end - start, 0), dtype=floatX if self.data is None
+                       else self.data.dtype)
+        first, last = self.indptr[pitch], self.indptr[pitch + 1]
+        starts = self.starts[first:last]
+        ends = self.ends[first:last]
+        if self.data is not None:
+            if self._offsets is None:
+                # position in `data` of the first pixel of each interval
+                lengths = self.ends - self.starts
+                self._offsets = np.cumsum(lengths) - lengths
+            offsets = self._offsets[first:last]
+        for i in np.flatnonzero((starts < end) & (ends > start)):
+            s = max(starts[i], start)
+            e = min(ends[i], end)
+            if self.data is None:
+                out[s - start:e - start] = 1
+            else:
+                o = offsets[i] - starts[i]
+                out[s - start:e - start] = self.data[o + s:o + e]
+        return out
+
+    def __getitem__(self, key):
+        pitch, columns = key
+        if not isinstance(columns, slice) or columns.step not in (None, 1):
+            raise IndexError("SparseRoll only supports roll[pitch, a:b] and "
+                             "roll[:, a:b]")
+        if isinstance(pitch, slice):
+            start = columns.start or 0
+            end = self.shape[1] if columns.stop is None else columns.stop
+            return self.window(start, end)
+        # same semantic of numpy slicing (e.g. for negative indices)
+        start, end, _step = columns.indices(self.shape[1])
+        return self.row(pitch, start, end)
+
+
+def compress_rests(pr_idxs, length, guard_width):
+    """
+    Collapse runs of empty columns longer than *guard_width* in the piano
+    roll of *length* columns containing the notes *pr_idxs* (as returned by
+    `get_pianoroll_indices`): only the first *guard_width* columns of each
+    run are kept. *guard_width* should be at least the kernel width of the
+    network, so that the context it sees around a rest does not change.
+
+    Parameters
+    ----------
+    pr_idxs : array
+        Array with rows (pitch, start_time, end_time, ...)
+    length : int
+        The number of columns of the piano roll
+    guard_width : int
+        The number of empty columns kept for each rest
+
+    Returns
+    -------
+    compressed_idxs : array
+        A copy of *pr_idxs* with columns referred to the compressed roll
+    column_map : array
+        For each column of the compressed roll, the corresponding column of
+        the original roll; use it with `expand_columns` and `expand_indices`
+    """
+    pr_idxs = np.asarray(pr_idxs)
+    occupied = np.zeros(length + 1, dtype=int)
+    np.add.at(occupied, np.clip(pr_idxs[:, 1], 0, length), 1)
+    np.add.at(occupied, np.clip(pr_idxs[:, 2], 0, length), -1)
+    occupied = np.cumsum(occupied[:length]) > 0
+
+    # distance of each empty column from the last occupied one
+    columns = np.arange(length)
+    last_occupied = np.maximum.accumulate(np.where(occupied, columns, -1))
+    keep = occupied | (columns - last_occupied <= guard_width)
+    column_map = np.flatnonzero(keep)
+
+    compressed_idxs = pr_idxs.copy()
+    compressed_idxs[:, 1] = np.searchsorted(column_map, pr_idxs[:, 1])
+    compressed_idxs[:, 2] = np.searchsorted(column_map, pr_idxs[:, 2])
+    return compressed_idxs, column_map
+
+
+def expand_indices(pr_idxs, column_map):
+    """
+    Inverse of `compress_rests` for note indices: returns a copy of
+    *pr_idxs* with columns referred to the original roll.
+    """
+    expanded_idxs = np.array(pr_idxs)
+    expanded_idxs[:, 1] = column_map[expanded_idxs[:, 1]]
+    expanded_idxs[:, 2] = column_map[expanded_idxs[:, 2] - 1] + 1
+    return expanded_idxs
+
+
+def expand_columns(roll, column_map, length, offset=0):
+    """
+    Inverse of `compress_rests` for piano rolls (e.g. predictions): returns
+    a roll of *length* columns in which the column `offset + i` of *roll* is
+    moved to `column_map[i]` and collapsed columns are zeros. *offset* is
+    the number of padding columns before the first column of the compressed
+    roll (see `misc_tools.recreate_pianorolls`).
+
+    *roll* can be a 2D array or a `SparseRoll`; the same type is returned.
+    """
+    if isinstance(roll, SparseRoll):
+        rows, cols, values = roll.coords()
+        cols = cols - offset
+        inside = (cols >= 0) & (cols < len(column_map))
+        return SparseRoll.from_coords(rows[inside],
+                                      column_map[cols[inside]],
+                                      values[inside],
+                                      (roll.shape[0], length))
+
+    expanded = np.zeros((roll.shape[0], length), dtype=roll.dtype)
+    expanded[:, column_map] = roll[:, offset:offset + len(column_map)]
+    return expanded
+
+
 def plot_pianorolls(pr_score, pr_melody, out_fn='/tmp/pianorolls.pdf'):
     """
     Plot piano rolls